@@ -0,0 +1,51 @@
+# Benchmark of the "rf-grow" warm start forest against full Random Forest refits.
+# Streams the square dataset from server/test_al.py one labeled point at a time and
+# reports the training latency per iteration and the accuracy on the whole grid.
+# Run from the repository root: python -m al_examples.rf_grow_benchmark [grid sizes, default 20]
+
+import sys, time
+import numpy as np
+from server.active_learning_utils import get_learner
+
+def square_dataset(num_points:int=20):
+  """
+  Grid of points in [0,10]x[0,10], labeled 1 inside the square x<=5, y<=5 and 0 outside.
+  """
+  x1 = x2 = np.linspace(0,10,num_points)
+  X = np.array([[i,j] for i in x1 for j in x2])
+  y = np.array([1 if i<=5.0 and j<=5.0 else 0 for i in x1 for j in x2])
+  return X, y
+
+def run(algo:str, X, y, order, params:dict=None)->dict:
+  """
+  Initializes a learner on the first and last grid points, then teaches it the points in order.
+  Accuracy is measured on the whole grid after 10% of the points and after all of them.
+  """
+  learner = get_learner(X[[0,-1]],y[[0,-1]],algo,params)
+  latencies = []
+  early_accuracy = None
+  for i, idx in enumerate(order):
+    start = time.perf_counter()
+    learner.teach(X[idx:idx+1],y[idx:idx+1])
+    latencies.append(time.perf_counter()-start)
+    if i+1 == len(order)//10:
+      early_accuracy = learner.score(X,y)
+  latencies = np.array(latencies)
+  return {"algorithm":algo,
+          "early_accuracy":early_accuracy,
+          "accuracy":learner.score(X,y),
+          "mean_ms":1000*latencies.mean(),
+          "last_50_mean_ms":1000*latencies[-50:].mean(),
+          "total_s":latencies.sum()}
+
+def benchmark(num_points:int=20, seed:int=0)->list:
+  X, y = square_dataset(num_points)
+  order = np.random.default_rng(seed).permutation(len(X))
+  return [run("rf",X,y,order), run("rf-grow",X,y,order)]
+
+if __name__ == "__main__":
+  for num_points in [int(arg) for arg in sys.argv[1:]] or [20]:
+    print("Square dataset, {} labeled points".format(num_points*num_points))
+    for result in benchmark(num_points):
+      print("  {algorithm:8s} accuracy at 10% {early_accuracy:.3f}  final {accuracy:.3f}  mean teach {mean_ms:7.1f} ms  "
+            "last 50 teaches {last_50_mean_ms:7.1f} ms  total {total_s:6.1f} s".format(**result))
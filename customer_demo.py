@@ -114,7 +114,8 @@ def label(session_id:str,payment_preimage:str,x_label:list):
 def train(session_id:str,payment_preimage:str,x_train:list,y_train:list):
     """ Sends a train request to alsats server """
     train_response_dict={}
-    data = dumps({"algorithm":"rf","x_train":x_train,"y_train":y_train})
+    # Retrain in the background every 5 labels (or 30 seconds) instead of refitting on every label
+    data = dumps({"algorithm":"rf","x_train":x_train,"y_train":y_train,"params":{"retrain_every":5,"retrain_interval":30}})
     headers = {"preimage":payment_preimage}
     response = test_app.post("/train/"+session_id,headers=headers,data=data)
     if response.status_code==200:
@@ -158,12 +159,24 @@ def convert_labels_to_df():
     label_df['label'] = st.session_state.data_labels
     return label_df.to_csv(index=False).encode('utf-8')
 
-def download_model(session_id:str,preimage:str):
-    """ Save and download a valid model """
+def download_model(session_id:str,preimage:str,max_polls:int=60):
+    """ Save and download a valid model. A model still being saved is polled at /save/status until it's uploaded """
     download_result={}
     try:
         response = test_app.get("/download/"+session_id+"/"+preimage)
         download_result = response.json()
+        polls = 0
+        while response.status_code==202 and polls<max_polls:
+            job = test_app.get("/save/status/"+download_result["job_id"]).json()
+            if job.get("status")=="failed":
+                st.write("Model upload failed: {}".format(job.get("error")))
+                return None
+            if job.get("status")=="done":
+                response = test_app.get("/download/"+session_id+"/"+preimage)
+                download_result = response.json()
+            else:
+                sleep(1)
+            polls += 1
     except Exception as e:
         print("Unable to download file.")
         return None
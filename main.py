@@ -1,25 +1,52 @@
+import os
 from typing import Optional, Union
-from fastapi import FastAPI, HTTPException, Header
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Header, Request, Depends, WebSocket, WebSocketDisconnect, status
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import ValidationError
 import uvicorn
 import server.server_utils as server #import Service, initialize_iterations_mode, get_session_validity_info
 import server.active_learning_utils as al#import TrainParams, LabelParams, train_model, fetch_label
+import server.invoice_listener as invoice_listener
+import server.session_tokens as tokens
+import server.candidate_pool as pools
+import server.payloads as payloads
+import server.stream_channel as stream
+from server.cached_models import model_cache_stats
+from server.compute_pool import compute_pool
+from server.retrain_scheduler import retrain_stats
+from server.inference_cache import inference_cache_stats
+from server.sample_log import schedule_compaction, sample_log_stats
 from numpy import array
 
 app = FastAPI()
 
+@app.on_event("startup")
+async def startup():
+  app.state.invoice_listener = invoice_listener.start_invoice_listener()
+
+@app.on_event("shutdown")
+async def shutdown():
+  await invoice_listener.stop_invoice_listener(getattr(app.state,"invoice_listener",None))
+  await server.close_async_service()
+  compute_pool.shutdown()
+
 @app.get("/")
 async def home_page():
   return {"ALsats": "Intelligent labeling. For just a few sats."}
 
 @app.post("/pay/initialize/{num_iterations}")
-async def pay_initialize(num_iterations:int=None)->dict:
+async def pay_initialize(num_iterations:int=None,algorithm:Optional[str]=None)->dict:
   """
   Returns a Lightning payment request that must be fulfilled to initialize a compute session/model.
+  Passing an algorithm prices the iterations with that algorithm's per iteration payment.
+  The session can then train that algorithm or one with a lower price, without it only those priced like the default.
   """
+  if algorithm is not None and algorithm not in al.ALGORITHMS:
+    raise HTTPException(status_code=400, detail="algorithm must be one of {}".format(sorted(al.ALGORITHMS)))
   if num_iterations is not None and num_iterations>0:
     print("Requesting session with {} compute iterations...".format(num_iterations))
-    iter_dict = server.initialize_iterations_mode(num_iterations)
+    iter_dict = await server.async_initialize_iterations_mode(num_iterations,algorithm)
     content = {"session_id": iter_dict["session_id"], "start_time":iter_dict["start_time"]}
     headers = {"payment_request":iter_dict["payment_request"]}
   else:
@@ -27,6 +54,98 @@ async def pay_initialize(num_iterations:int=None)->dict:
   return JSONResponse(content=content,headers=headers)
 
 
+@app.post("/pay/token/{session_id}")
+async def pay_token(session_id:str=None, preimage: Union[str, None] = Header(default=None)):
+  """
+  Returns a signed session token for a paid session.
+  Pass it to /train and /label as "Authorization: Bearer <token>" instead of the preimage.
+  """
+  if session_id is None or bool(session_id.strip())==False:
+    raise HTTPException(status_code=400, detail="Need valid session ID field")
+  if preimage is None:
+    raise HTTPException(status_code=400, detail="Need preimage in header")
+  session_validity_info = await server.async_session_validity_info(session_id,preimage)
+  if session_validity_info["valid_session"]==True:
+    session = server.get_session_info(session_id)
+    token_dict = tokens.mint_session_token(session_id,session["payment_hash"],session["num_iterations"])
+    return JSONResponse(content=token_dict,status_code=200)
+  else:
+    raise HTTPException(status_code=400, detail="Invalid Session. Either the session has no iterations remaining or payment preimage is not valid ")
+
+
+async def authorize(session_id:str,preimage:str=None,token:str=None)->dict:
+  """
+  Validates a compute request. A session token only needs a local signature check,
+  the iteration quota is then enforced when the iteration is reserved.
+  The session is still read for its completed iterations, which failure messages report.
+  Without a token the preimage is checked against the session.
+  """
+  if token is not None:
+    claims = tokens.verify_session_token(token,session_id)
+    session_validity_info, _ = server.lookup_session_validity(session_id)
+    session_validity_info["valid_session"] = claims is not None
+    return session_validity_info
+  return await server.async_session_validity_info(session_id,preimage)
+
+
+def body_params(model:type):
+  """
+  Dependency parsing a request body into model. Besides JSON, bodies can be .npy arrays (application/x-npy)
+  or msgpack maps, whose arrays are decoded with numpy.frombuffer, or Arrow IPC streams. See server/payloads.py.
+  """
+  async def parse(request:Request):
+    try:
+      return payloads.parse_body(model,await request.body(),request.headers.get("content-type"),dict(request.query_params))
+    except ValidationError as e:
+      raise RequestValidationError(e.errors())
+    except payloads.PayloadError as e:
+      raise HTTPException(status_code=415 if e.unsupported else 400, detail=str(e))
+  return parse
+
+
+def is_empty(values)->bool:
+  """ True for a missing or zero length list or array """
+  return values is None or len(values)==0
+
+
+def check_pool_indices(session_id:str,indices:list=None):
+  """ Raises a 400 if indices don't refer to rows of the session's uploaded pool """
+  if indices is None:
+    return
+  try:
+    num_rows = pools.candidate_pools.get(session_id).shape[0]
+  except pools.PoolError as e:
+    raise HTTPException(status_code=400, detail=str(e))
+  if len(indices)==0 or not all(isinstance(i,int) and not isinstance(i,bool) and 0<=i<num_rows for i in indices):
+    raise HTTPException(status_code=400, detail="Pool indices must be integers between 0 and {}".format(num_rows-1))
+
+
+@app.post("/pool/{session_id}")
+async def upload_pool(session_id:str, request:Request, preimage: Union[str, None] = Header(default=None),\
+  authorization: Union[str, None] = Header(default=None)):
+  """
+  Uploads the session's unlabeled candidate pool as the body of the request, a .npy file of an N x d array
+  (e.g. numpy.save to a BytesIO). The pool is stored memory mapped on the server and replaces any earlier pool.
+  /train, /label and /label/batch then accept "indices" into the pool, and /query without "x_pool" returns
+  the next best pool indices. Uploading doesn't use compute iterations.
+  """
+  if session_id is None or bool(session_id.strip())==False:
+    raise HTTPException(status_code=400, detail="Need valid session ID field")
+
+  token = tokens.bearer_token(authorization)
+  if preimage is None and token is None:
+    raise HTTPException(status_code=400, detail="Need preimage in header")
+
+  session_validity_info = await authorize(session_id,preimage,token)
+  if session_validity_info["valid_session"]!=True:
+    raise HTTPException(status_code=400, detail="Invalid Session. Either the session has no iterations remaining or payment preimage is not valid ")
+  try:
+    pool_info = await pools.save_pool(session_id,request.stream())
+  except pools.PoolError as e:
+    raise HTTPException(status_code=400, detail=str(e))
+  return JSONResponse(content=pool_info,status_code=200)
+
+
 @app.get("/pay/save")
 async def pay_save():
   """
@@ -35,8 +154,35 @@ async def pay_save():
   pass
 
 
+@app.post("/admin/reload_params")
+async def reload_params(admin_token: Union[str, None] = Header(default=None)):
+  """
+  Reloads system_params.json (pricing) without waiting for the file change to be picked up.
+  """
+  if not server.is_admin(admin_token):
+    raise HTTPException(status_code=403, detail="Need valid admin token in header")
+  return JSONResponse(content=server.reload_system_params(),status_code=200)
+
+
+@app.get("/admin/stats")
+async def admin_stats(admin_token: Union[str, None] = Header(default=None)):
+  """
+  Returns model cache counters (hits, misses, evictions, rehydrations, resident bytes),
+  retrain scheduler, candidate pool and inference cache counters of every compute worker.
+  """
+  if not server.is_admin(admin_token):
+    raise HTTPException(status_code=403, detail="Need valid admin token in header")
+  return JSONResponse(content={"model_cache":await compute_pool.run_on_all(model_cache_stats),\
+                               "retrain":await compute_pool.run_on_all(retrain_stats),\
+                               "pools":await compute_pool.run_on_all(pools.candidate_pool_stats),\
+                               "inference_cache":await compute_pool.run_on_all(inference_cache_stats),\
+                               "sample_log":await compute_pool.run_on_all(sample_log_stats),\
+                               "uploads":await compute_pool.run_on_all(server.model_upload_stats)},status_code=200)
+
+
 @app.post("/train/{session_id}")
-async def train(session_id:str=None,train_params:al.TrainParams=None, preimage: Union[str, None] = Header(default=None)):
+async def train(session_id:str=None,train_params:al.TrainParams=Depends(body_params(al.TrainParams)), preimage: Union[str, None] = Header(default=None),\
+  authorization: Union[str, None] = Header(default=None)):
   """
   Trains an Active Learning model for a valid compute session. Initializes a learner if not initialized.
   Expects a JSON data payload (in the "data" field of the HTTP request).
@@ -44,21 +190,31 @@ async def train(session_id:str=None,train_params:al.TrainParams=None, preimage:
                         "x_train":[[0.0,1.0],[1.0,2.0]],
                         "y_train":[0,1]
                         })
+  x_train and y_train can also be sent as two concatenated .npy arrays (Content-Type: application/x-npy),
+  an Arrow IPC stream with a "y" column, or a msgpack map, with the other fields in the URL query (?algorithm=rf).
+  Optional "params":{"retrain_every":k,"retrain_interval":seconds,"retrain_uncertainty":bound} buffers the
+  labels and retrains in the background when any of the conditions is met, so the request returns without a refit.
   """
   print('Session ID is {}'.format(session_id))
   if session_id is None or bool(session_id.strip())==False:
     raise HTTPException(status_code=400, detail="Need valid session ID field")
   
-  if preimage is None:
+  token = tokens.bearer_token(authorization)
+  if preimage is None and token is None:
     raise HTTPException(status_code=400, detail="Need preimage in header")
 
-  if train_params is None or train_params.x_train is None or train_params.y_train is None:
-    raise HTTPException(status_code=400, detail="Pass a JSON containing all following fields:\"x_train\", \"y_train\" ")
+  if train_params is None or (train_params.x_train is None and train_params.indices is None) or train_params.y_train is None:
+    raise HTTPException(status_code=400, detail="Pass a JSON containing all following fields:\"x_train\" (or pool \"indices\"), \"y_train\" ")
+  check_pool_indices(session_id,train_params.indices)
   
-  session_validity_info = server.session_validity_info(session_id,preimage)
-  if bool(session_validity_info) and session_validity_info["valid_session"]==True:
-    # If model hasn't been initialized, initialize it. Else train.
-    response_dict = al.train_model(train_params,session_id,session_validity_info["completed_iterations"])
+  session_validity_info = await authorize(session_id,preimage,token)
+  # Reserve the iteration before compute so concurrent requests can't overrun the paid quota
+  if bool(session_validity_info) and session_validity_info["valid_session"]==True and server.reserve_iterations(session_id):
+    # If model hasn't been initialized, initialize it. Else train. Runs on the session's compute worker.
+    response_dict = await server.run_reserved(session_id,1,al.train_model,train_params,session_id,session_validity_info["completed_iterations"],reserved=True)
+    schedule_compaction(session_id,response_dict)
+    if response_dict and "error" in response_dict:
+      raise HTTPException(status_code=400, detail=response_dict["error"])
     if response_dict:
       return JSONResponse(content=response_dict)
     else:
@@ -68,24 +224,34 @@ async def train(session_id:str=None,train_params:al.TrainParams=None, preimage:
 
 
 @app.post("/label/{session_id}")
-async def label(session_id:str=None,label_params:al.LabelParams=None, preimage: Union[str, None] = Header(default=None)):
+async def label(session_id:str=None,label_params:al.LabelParams=Depends(body_params(al.LabelParams)), preimage: Union[str, None] = Header(default=None),\
+  authorization: Union[str, None] = Header(default=None)):
   """
   Returns a "Label"/"Do not Label" categorization for an inbound feature "x_label" passed in HTTP request params json.
   e.g. "x_label":["1.0,2.0,3.0,4.0","5.0,6.0,7.0,8.0","1.0,2.0,3.0,5.0"]
+  "query_criterion" (least_confidence, margin or entropy) and "uncertainty_threshold" decide when a label is needed.
+  The response carries all three measures from a single predict_proba pass.
   """
   if session_id is None or bool(session_id.strip())==False:
     raise HTTPException(status_code=400, detail="Need valid session ID field")
   
-  if preimage is None:
+  token = tokens.bearer_token(authorization)
+  if preimage is None and token is None:
     raise HTTPException(status_code=400, detail="Need preimage in header")
 
-  if label_params is None or label_params.x_label is None:
-    raise HTTPException(status_code=400, detail="Pass a JSON containing all following fields:\"x_label\"")
+  if label_params is None or (label_params.x_label is None and label_params.indices is None):
+    raise HTTPException(status_code=400, detail="Pass a JSON containing all following fields:\"x_label\" (or pool \"indices\")")
+  if label_params.indices is not None and len(label_params.indices)!=1:
+    raise HTTPException(status_code=400, detail="/label takes a single pool index, label several with /label/batch/{}".format(session_id))
+  check_pool_indices(session_id,label_params.indices)
+
+  if label_params.query_criterion not in al.QUERY_CRITERIA:
+    raise HTTPException(status_code=400, detail="query_criterion must be one of {}".format(sorted(al.QUERY_CRITERIA)))
   
-  session_validity_info = server.session_validity_info(session_id,preimage)
-  if session_validity_info["valid_session"]==True:
+  session_validity_info = await authorize(session_id,preimage,token)
+  if session_validity_info["valid_session"]==True and server.reserve_iterations(session_id):
     # Fetch labels
-    response_dict = al.fetch_label(label_params,session_id,session_validity_info["completed_iterations"])
+    response_dict = await server.run_reserved(session_id,1,al.fetch_label,label_params,session_id,session_validity_info["completed_iterations"],reserved=True)
     if response_dict:
       return JSONResponse(content=response_dict)
     else:
@@ -93,6 +259,133 @@ async def label(session_id:str=None,label_params:al.LabelParams=None, preimage:
   else:
     raise HTTPException(status_code=400, detail="Invalid Session. Either the session has no iterations remaining or payment preimage is not valid ")
  
+@app.post("/label/batch/{session_id}")
+async def label_batch(session_id:str=None,label_params:al.BatchLabelParams=Depends(body_params(al.BatchLabelParams)), preimage: Union[str, None] = Header(default=None),\
+  authorization: Union[str, None] = Header(default=None)):
+  """
+  Returns "Label"/"Do not Label" decisions, uncertainties and predicted labels for every row of an N x d "x_label" matrix.
+  e.g. "x_label":[[1.0,2.0],[3.0,4.0]], "query_criterion":"margin", "uncertainty_threshold":0.2
+  A batch costs one compute iteration per label_batch_rows rows (system params), or one iteration if label_batch_rows is 0.
+  """
+  if session_id is None or bool(session_id.strip())==False:
+    raise HTTPException(status_code=400, detail="Need valid session ID field")
+
+  token = tokens.bearer_token(authorization)
+  if preimage is None and token is None:
+    raise HTTPException(status_code=400, detail="Need preimage in header")
+
+  if label_params is None or (is_empty(label_params.x_label) and is_empty(label_params.indices)):
+    raise HTTPException(status_code=400, detail="Pass a JSON containing all following fields:\"x_label\" (or pool \"indices\")")
+  check_pool_indices(session_id,label_params.indices)
+
+  if label_params.query_criterion not in al.QUERY_CRITERIA:
+    raise HTTPException(status_code=400, detail="query_criterion must be one of {}".format(sorted(al.QUERY_CRITERIA)))
+
+  num_iterations = server.label_batch_iterations(len(label_params.indices if label_params.indices is not None else label_params.x_label))
+  session_validity_info = await authorize(session_id,preimage,token)
+  if session_validity_info["valid_session"]==True and server.reserve_iterations(session_id,num_iterations):
+    response_dict = await server.run_reserved(session_id,num_iterations,al.fetch_label_batch,label_params,session_id,\
+                                              session_validity_info["completed_iterations"],reserved=True,num_iterations=num_iterations)
+    if response_dict:
+      return JSONResponse(content=response_dict)
+    else:
+      raise HTTPException(status_code=500, detail="Compute failed. You still have {} compute iterations remaining".format(session_validity_info["completed_iterations"]))
+  else:
+    raise HTTPException(status_code=400, detail="Invalid Session. Either the session doesn't have {} iterations remaining or payment preimage is not valid ".format(num_iterations))
+
+@app.post("/query/{session_id}")
+async def query(session_id:str=None,query_params:al.QueryParams=Depends(body_params(al.QueryParams)), preimage: Union[str, None] = Header(default=None),\
+  authorization: Union[str, None] = Header(default=None)):
+  """
+  Returns the indices of the k most informative rows of an N x d candidate pool "x_pool".
+  e.g. "x_pool":[[1.0,2.0],[3.0,4.0],[5.0,6.0]], "k":2, "query_criterion":"entropy", "diversity":"ranked"
+  "diversity" ("ranked" or "cluster") spreads the k rows over the pool so several labelers can take one each.
+  Without "x_pool" the session's uploaded pool is queried for the next best indices, skipping rows it has trained on.
+  A query is billed like a batch label request of N rows, or of k rows for the uploaded pool. The uploaded pool's
+  scores are cached per model version, the first query after a training is billed like labeling every pool row.
+  """
+  if session_id is None or bool(session_id.strip())==False:
+    raise HTTPException(status_code=400, detail="Need valid session ID field")
+
+  token = tokens.bearer_token(authorization)
+  if preimage is None and token is None:
+    raise HTTPException(status_code=400, detail="Need preimage in header")
+
+  if query_params is None or (query_params.x_pool is not None and len(query_params.x_pool)==0) or query_params.k<1:
+    raise HTTPException(status_code=400, detail="Pass a JSON containing all following fields:\"x_pool\" (or upload a pool), \"k\" (at least 1)")
+  if query_params.x_pool is None and not os.path.exists(pools.pool_path(session_id)):
+    raise HTTPException(status_code=400, detail="Session has no uploaded pool. Pass \"x_pool\" or upload a pool to /pool/{}".format(session_id))
+
+  if query_params.query_criterion not in al.QUERY_CRITERIA or query_params.diversity not in al.DIVERSITY_MODES:
+    raise HTTPException(status_code=400, detail="query_criterion must be one of {} and diversity one of {}".format(sorted(al.QUERY_CRITERIA),al.DIVERSITY_MODES))
+
+  # Uploaded pool scores are cached per model version, so a next best query is billed like labeling its k rows.
+  # When the pool has to be scored for a new version query_model reserves the rest of its rows
+  num_iterations = server.label_batch_iterations(len(query_params.x_pool) if query_params.x_pool is not None else query_params.k)
+  session_validity_info = await authorize(session_id,preimage,token)
+  if session_validity_info["valid_session"]==True and server.reserve_iterations(session_id,num_iterations):
+    response_dict = await server.run_reserved(session_id,num_iterations,al.query_model,query_params,session_id,\
+                                              session_validity_info["completed_iterations"],reserved=True,num_iterations=num_iterations)
+    if response_dict and "error" in response_dict:
+      raise HTTPException(status_code=400, detail=response_dict["error"])
+    if response_dict:
+      return JSONResponse(content=response_dict)
+    else:
+      raise HTTPException(status_code=500, detail="Compute failed. You still have {} compute iterations remaining".format(session_validity_info["completed_iterations"]))
+  else:
+    raise HTTPException(status_code=400, detail="Invalid Session. Either the session doesn't have {} iterations remaining or payment preimage is not valid ".format(num_iterations))
+
+@app.websocket("/stream/{session_id}")
+async def stream_socket(websocket:WebSocket, session_id:str, preimage: Union[str, None] = Header(default=None),\
+  authorization: Union[str, None] = Header(default=None), token: Optional[str] = None):
+  """
+  A persistent channel for the label/train loop of a session, authenticated once when it opens
+  with the preimage or token header (or ?token=<session token>).
+  Every text message is a JSON object with an "op" ("label", "label_batch" or "train") and the fields
+  of the matching HTTP request, e.g. {"op":"label","x_label":[1.0,2.0]} or {"op":"train","x_train":[[1.0,2.0]],"y_train":[1]}.
+  Replies are the HTTP responses plus the message's "seq" and "op", or an "error", sent in message order.
+  Each message is billed from the session's iterations like its HTTP request.
+  """
+  token = token or tokens.bearer_token(authorization)
+  if bool(session_id.strip())==False or (preimage is None and token is None):
+    await websocket.close(code=status.WS_1008_POLICY_VIOLATION,reason="Need valid session ID and preimage or token")
+    return
+  session_validity_info = await authorize(session_id,preimage,token)
+  if session_validity_info["valid_session"]!=True:
+    await websocket.close(code=status.WS_1008_POLICY_VIOLATION,reason="Invalid Session. Either the session has no iterations remaining or payment preimage is not valid")
+    return
+  await websocket.accept()
+  try:
+    async for reply in stream.serve(session_id,session_validity_info["completed_iterations"],websocket.iter_text()):
+      await websocket.send_json(reply)
+    await websocket.close()
+  except WebSocketDisconnect:
+    # The client went away, replies to its last messages have nowhere to go
+    pass
+
+
+@app.post("/stream/{session_id}")
+async def stream_ndjson(session_id:str, request:Request, preimage: Union[str, None] = Header(default=None),\
+  authorization: Union[str, None] = Header(default=None)):
+  """
+  The /stream channel over plain HTTP: the body is newline delimited JSON messages (application/x-ndjson),
+  authenticated once for all of them, and the replies are streamed back one line per message as they are computed.
+  """
+  if session_id is None or bool(session_id.strip())==False:
+    raise HTTPException(status_code=400, detail="Need valid session ID field")
+
+  token = tokens.bearer_token(authorization)
+  if preimage is None and token is None:
+    raise HTTPException(status_code=400, detail="Need preimage in header")
+
+  session_validity_info = await authorize(session_id,preimage,token)
+  if session_validity_info["valid_session"]!=True:
+    raise HTTPException(status_code=400, detail="Invalid Session. Either the session has no iterations remaining or payment preimage is not valid ")
+  # The body is read before replying since a plain HTTP response can't be interleaved with reading its request
+  messages = stream.ndjson_messages(await request.body())
+  replies = stream.serve(session_id,session_validity_info["completed_iterations"],messages)
+  return StreamingResponse(stream.ndjson_replies(replies),media_type="application/x-ndjson")
+
 @app.get("/session_info/{session_id}/{preimage}")
 async def session_validity(session_id:str,preimage:str):
   """ Returns session info. Valid sessions show completed iterations. """
@@ -100,7 +393,7 @@ async def session_validity(session_id:str,preimage:str):
     raise HTTPException(status_code=400, detail="Need valid session ID field")
   if preimage is None or bool(preimage.strip())==False:
     raise HTTPException(status_code=400, detail="Need valid preimage field")
-  session_validity_info = server.session_validity_info(session_id,preimage)
+  session_validity_info = await server.async_session_validity_info(session_id,preimage)
   if session_validity_info and session_validity_info["valid_session"]==True:
     return JSONResponse(content=session_validity_info,status_code=200)
   else:
@@ -109,41 +402,54 @@ async def session_validity(session_id:str,preimage:str):
 @app.post("/save/{session_id}/{preimage}")
 async def save(session_id:str,preimage:str):
   """
-  Saves an Active Learning model versus the session ID and preimage for a valid session
+  Saves an Active Learning model versus the session ID and preimage for a valid session.
+  The upload runs in the background: the response carries a "job_id" to poll at /save/status/{job_id}.
   """
   if session_id is None or bool(session_id.strip())==False:
     raise HTTPException(status_code=400, detail="Need valid session ID field")
   if preimage is None or bool(preimage.strip())==False:
     raise HTTPException(status_code=400, detail="Need valid preimage field")
-  session_validity_info = server.session_validity_info(session_id,preimage)
+  session_validity_info = await server.async_session_validity_info(session_id,preimage)
   if session_validity_info and session_validity_info["valid_session"]==True:
-    save_result = server.save_model(session_id,preimage)
+    save_result = await compute_pool.run(session_id,server.save_model,session_id,preimage)
     if "Exception" in save_result["Status"] or save_result["Status"]==None:
        raise HTTPException(status_code=500, detail="Internal Server Error. Contact alsats admin.")
     else:
-      return JSONResponse(content=save_result,status_code=200)
+      return JSONResponse(content=save_result,status_code=202 if save_result["Status"]=="Queued" else 200)
   else:
     raise HTTPException(status_code=400, detail="Invalid Session. Either the session has no iterations remaining or payment preimage is not valid ")
 
 @app.get("/download/{session_id}/{preimage}")
 async def download(session_id:str,preimage:str):
   """
-  Downloads an Active Learning model versus the session ID and preimage for a valid session
+  Downloads an Active Learning model versus the session ID and preimage for a valid session.
+  A model that isn't uploaded yet is saved in the background: the response has Status "Pending" and a "job_id",
+  retry once /save/status/{job_id} reports it done.
   """
   if session_id is None or bool(session_id.strip())==False:
     raise HTTPException(status_code=400, detail="Need valid session ID field")
   if preimage is None or bool(preimage.strip())==False:
     raise HTTPException(status_code=400, detail="Need valid preimage field")
-  session_validity_info = server.session_validity_info(session_id,preimage)
+  session_validity_info = await server.async_session_validity_info(session_id,preimage)
   if session_validity_info and session_validity_info["valid_session"]==True:
-    download_result = server.download_model(session_id,preimage)
+    download_result = await compute_pool.run(session_id,server.download_model,session_id,preimage)
     if "Exception" in download_result["Status"] or download_result["Status"]==None:
        raise HTTPException(status_code=500, detail="Internal Server Error. Contact alsats admin.")
     else:
-      return JSONResponse(content=download_result,status_code=200)
+      return JSONResponse(content=download_result,status_code=202 if download_result["Status"]=="Pending" else 200)
   else:
     raise HTTPException(status_code=400, detail="Invalid Session. Either the session has no iterations remaining or payment preimage is not valid ")
 
+@app.get("/save/status/{job_id}")
+async def save_status(job_id:str):
+  """
+  Status of a background save: queued, uploading, done or failed (with an "error")
+  """
+  job = server.job_status(job_id)
+  if job is None:
+    raise HTTPException(status_code=404, detail="No such job")
+  return JSONResponse(content=job,status_code=200)
+
 
 
   
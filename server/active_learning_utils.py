@@ -1,39 +1,82 @@
 from typing import Optional
 from pydantic import BaseModel
-from numpy import array
+from numpy import arange, array, asarray, full, random, setdiff1d
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.ensemble import GradientBoostingClassifier
+from sklearn.linear_model import SGDClassifier
+from sklearn.naive_bayes import GaussianNB
 from modAL.models import ActiveLearner
-from modAL.uncertainty import classifier_uncertainty
-from .server_utils import update_session
+from .server_utils import algorithm_paid, label_batch_iterations, reserve_iterations, update_session
 from .cached_models import models
+from .model_registry import bump_model_version, model_version
+from .retrain_scheduler import RetrainPolicy, retrain_scheduler
+from .incremental_learners import GrowingForestClassifier, HoeffdingTreeClassifier, IncrementalActiveLearner
+from .training_buffer import BufferedActiveLearner
+from .inference import QUERY_CRITERIA, infer, label_decisions
+from .inference_cache import inference_cache
+from .pool_query import DIVERSITY_MODES, query_pool
+from .candidate_pool import candidate_pools, labeled_indices, mark_labeled
 from traceback import print_exc
 
 class TrainParams(BaseModel):
     algorithm:str = "rf"
     x_train:list = None
     y_train:list = None
+    indices:list = None # rows of the session's uploaded pool, instead of x_train
     params:Optional[dict] = None
 
 class LabelParams(BaseModel):
     algorithm:str = "rf"
     x_label:list = None
+    indices:list = None # rows of the session's uploaded pool, instead of x_label
+    query_criterion:str = "least_confidence" # least_confidence, margin or entropy
+    uncertainty_threshold:float = 0.5
     params:Optional[dict] = None
 
+class BatchLabelParams(LabelParams):
+    x_label:list = None # N x d matrix, one candidate per row
+
+class QueryParams(BaseModel):
+    algorithm:str = "rf"
+    x_pool:list = None # N x d matrix of unlabeled candidates. None queries the session's uploaded pool
+    exclude_labeled:bool = True # skip uploaded pool rows the session has trained on
+    k:int = 1
+    query_criterion:str = "least_confidence"
+    diversity:Optional[str] = None # None, "ranked" or "cluster"
+    params:Optional[dict] = None
+
+# Algorithms whose estimators support partial_fit. Their learners only train on new samples by default.
+ALGORITHMS = {"rf","gbc","sgd","nb","ht","rf-grow"}
+INCREMENTAL_ALGORITHMS = {"sgd","nb","ht","rf-grow"}
+# Keys of TrainParams.params passed on to the rf-grow forest
+GROWING_FOREST_PARAMS = ("n_estimators","n_new_estimators","max_estimators","window")
+# Algorithms whose estimators take sparse input, so their training data can be stored as CSR rows
+SPARSE_ALGORITHMS = {"rf","gbc","sgd"}
+
 def get_classifier(algo:str="rf",params:dict=None):
   """
   Maps a algorithm string to sklearn classifier.
-  Returns a Gradient Boosted Classifier or a Random Forest classifier.
+  Returns a Random Forest, Gradient Boosted, SGD (logistic loss), Gaussian naive Bayes,
+  Hoeffding tree or growing (warm start) Random Forest classifier.
   """
-  algo_to_classifier_map = {"rf":RandomForestClassifier(),\
-                        "gbc":GradientBoostingClassifier()}
+  algo_to_classifier_map = {"rf":RandomForestClassifier,\
+                        "gbc":GradientBoostingClassifier,\
+                        "sgd":lambda: SGDClassifier(loss="log_loss"),\
+                        "nb":GaussianNB,\
+                        "ht":HoeffdingTreeClassifier,\
+                        "rf-grow":lambda: GrowingForestClassifier(**{k:v for k,v in (params or {}).items() if k in GROWING_FOREST_PARAMS})}
+  if algo not in algo_to_classifier_map:
+    raise ValueError("Unknown algorithm {}. Use one of {}".format(algo,sorted(algo_to_classifier_map)))
 
-  return algo_to_classifier_map[algo]
+  return algo_to_classifier_map[algo]()
 
 def get_learner(X_train:array=None,y_train:array=None,algo="rf",params:dict=None)->ActiveLearner:
   """
   Returns an initially trained modAL Active Learner given initial training inputs
-  and classifier options
+  and classifier options.
+  Incremental algorithms take params {"classes":[...], "only_new":bool}. classes defaults to the labels in y_train.
+  params {"storage":policy} sets how the session's features are stored (see training_buffer.STORAGE_POLICIES).
+  It defaults to "auto", uint8, float32 or CSR rows, whichever is smallest for the first batch.
   """
 
   classifier = get_classifier(algo,params)
@@ -43,10 +86,20 @@ def get_learner(X_train:array=None,y_train:array=None,algo="rf",params:dict=None
     raise ValueError("X or y is None. X and y need to be Numpy ndarrays")
     
   # initialize the learner
-  learner = ActiveLearner(
-      estimator=classifier,
-      X_training=X_train, y_training=y_train
-  )
+  params = params or {}
+  storage = params.get("storage","auto")
+  if algo in INCREMENTAL_ALGORITHMS:
+    learner = IncrementalActiveLearner(
+        estimator=classifier, classes=params.get("classes"), only_new=params.get("only_new",True),
+        storage=storage, allow_sparse=algo in SPARSE_ALGORITHMS,
+        X_training=X_train, y_training=y_train
+    )
+  else:
+    # Labeled samples are appended to growable buffers, see training_buffer
+    learner = BufferedActiveLearner(
+        estimator=classifier, storage=storage, allow_sparse=algo in SPARSE_ALGORITHMS,
+        X_training=X_train, y_training=y_train
+    )
   return learner
 
 def get_learner_score(learner:ActiveLearner,X:array=None,y:array=None)->float:
@@ -57,21 +110,21 @@ def get_learner_score(learner:ActiveLearner,X:array=None,y:array=None)->float:
 
 def streamed_sampling_iteration(learner:ActiveLearner=None,
                                 X_candidate:array=None,
-                                uncertainty_threshold:float=0.5)->dict:
+                                uncertainty_threshold:float=0.5,
+                                query_criterion:str="least_confidence",
+                                inference:dict=None)->dict:
   """
-  Computes classifier uncertainty for a single candidate feature vector/input.
-  Compares this uncertainty to a threshold passed by the user to determine if labeling is needed.
+  Computes classifier uncertainty for a single candidate feature vector/input with one predict_proba pass.
+  Compares the query criterion's value to a threshold passed by the user to determine if labeling is needed.
+  A precomputed inference of X_candidate (e.g. from the inference cache) skips predict_proba.
 
-  Returns: {"classifier_uncertainty":float,"label":"Yes"}
+  Returns: {"uncertainty":array,"label":"label","inference":dict}, see inference.infer
   """
-  label = "label" # By default ask for a label
-                                  
-  uncertainty = classifier_uncertainty(learner, X_candidate.reshape(1, -1)) 
-                                  
-  if uncertainty is not None and uncertainty < uncertainty_threshold:
-      label = "do not label"
+  if inference is None:
+    inference = infer(learner, X_candidate.reshape(1, -1))
+  label = label_decisions(inference, query_criterion, uncertainty_threshold)[0]
 
-  return {"uncertainty":uncertainty,"label":label}
+  return {"uncertainty":inference[query_criterion],"label":str(label),"inference":inference}
   
 def train_learner_single_sample(learner:ActiveLearner=None,
                                 X_sample:array=None,
@@ -83,68 +136,237 @@ def train_learner_single_sample(learner:ActiveLearner=None,
   return learner
 
 
-def train_model(train_params:TrainParams=None,session_id:str=None,completed_iterations:int=None):
+def log_batch(session_id:str,learner:ActiveLearner,x_train:array,y_train:array,train_params:TrainParams,created:bool,buffered:bool)->bool:
+  """
+  Appends an accepted batch to the session's sample log, so the learner can be rebuilt after a restart.
+  Returns True if the log should be compacted, which sample_log.schedule_compaction does after the response.
+  """
+  if models.sample_log is None:
+    return False
+  try:
+    models.sample_log.append(session_id,"init" if created else "teach",x_train,y_train,\
+                             train_params.algorithm,train_params.params,model_version(learner),buffered)
+    return retrain_scheduler.idle(session_id) and models.sample_log.compaction_due(session_id)
+  except Exception as e:
+    # The learner is trained in memory, a failed append only loses the batch on a restart
+    print_exc()
+    return False
+
+def train_model(train_params:TrainParams=None,session_id:str=None,completed_iterations:int=None,reserved:bool=False):
   """
   Train an active learner. Existing active learner trains only on new data.
   New active learner gets initialized. Session gets updated. 
+  Sessions with a retrain policy (retrain_every, retrain_interval or retrain_uncertainty in params)
+  buffer the new data and are retrained in the background, see retrain_scheduler.
+  If an iteration was reserved for this call it is committed on success and refunded on failure.
   """
   response_dict = {"message":"Train unsuccessful. Internal error. {} compute iterations completed in this session".format(completed_iterations),\
     "score":None}
   
+  if session_id not in models.keys() and not algorithm_paid(session_id,train_params.algorithm):
+    # The learner's algorithm is fixed when it's created, and must not cost more than the session paid per iteration
+    if reserved:
+      update_session(session_id,success=False,reserved=reserved)
+    return {**response_dict,"error":"Session wasn't paid for algorithm {}. Pass it to /pay/initialize".format(train_params.algorithm)}
+
+  committed = False
   try:
     #TODO - Check for dimension consistency of inputs and outputs.
-    x_train = array(train_params.x_train)
-    y_train = array(train_params.y_train).ravel()
-    if session_id not in models.keys():
-      learner = get_learner(x_train,y_train,train_params.algorithm)
+    if train_params.indices is not None:
+      x_train = candidate_pools.rows(session_id,train_params.indices)
+    else:
+      x_train = asarray(train_params.x_train)
+    y_train = asarray(train_params.y_train).ravel()
+    policy = RetrainPolicy.from_params(train_params.params)
+    buffered_samples = 0
+    created = session_id not in models.keys()
+    if created:
+      # A new learner is fitted on the first batch when it is created
+      learner = get_learner(x_train,y_train,train_params.algorithm,train_params.params)
+      learner.retrain_policy = policy
+      bump_model_version(learner)
       models[session_id] = learner
     else:
       learner = models[session_id]
-    learner.teach(x_train,y_train)
-    predicted_class = float(learner.predict(x_train.reshape(1,-1)))
-    session = update_session(session_id,success=True)
+      policy = policy or getattr(learner,'retrain_policy',None)
+      if policy is None:
+        learner.teach(x_train,y_train)
+        bump_model_version(learner)
+        models[session_id] = learner # Updates the learner's size and version in the model cache
+      else:
+        learner.retrain_policy = policy
+        inference = infer(learner,x_train)
+        buffered_samples = retrain_scheduler.buffer(session_id,policy,x_train,y_train,inference["least_confidence"])
+    compact_sample_log = log_batch(session_id,learner,x_train,y_train,train_params,created,buffered_samples>0)
+    predicted_classes = inference["predicted"] if buffered_samples else learner.predict(x_train)
+    predicted_class = float(predicted_classes[0]) if len(predicted_classes)==1 else predicted_classes.tolist()
+    if train_params.indices is not None:
+      mark_labeled(session_id,train_params.indices)
+    session = update_session(session_id,success=True,reserved=reserved)
+    committed = True
     score = learner.score(x_train,y_train)
     remaining_iterations = int(session["num_iterations"]-session["completed_iterations"])
-    response_dict = {"message":"Train successful, {} compute iterations completed,\
-                      {} iterations remaining".format(session["completed_iterations"],remaining_iterations),\
+    message = "Train successful, {} compute iterations completed,\
+                      {} iterations remaining".format(session["completed_iterations"],remaining_iterations)
+    if buffered_samples:
+      message += ". {} samples buffered for the next retrain".format(buffered_samples)
+    response_dict = {"message":message,\
                       "score":score,"remaining_iterations":[remaining_iterations],\
-                      "predicted_label":predicted_class}
+                      "predicted_label":predicted_class,"model_version":model_version(learner),\
+                      "buffered_samples":buffered_samples}
+    if compact_sample_log:
+      response_dict["compact_sample_log"] = True
   except Exception as e:
-    print_exc(e)
+    print_exc()
+  if reserved and not committed:
+    update_session(session_id,success=False,reserved=reserved)
   
   return response_dict
 
-def fetch_label(label_params:LabelParams=None,session_id:str=None,completed_iterations:int=None):
+def fetch_label(label_params:LabelParams=None,session_id:str=None,completed_iterations:int=None,reserved:bool=False):
   """
   Label an incoming feature vector.
+  If an iteration was reserved for this call it is committed on success and refunded on failure.
   """
   response_dict={"message":"Label unsuccessful. Internal error. You still have {} compute iterations in this session".format(completed_iterations)}
+  committed = False
   try:
     #TODO - Check for dimension consistency of inputs
-    x_label = array([label_params.x_label])
+    if label_params.indices is not None:
+      if len(label_params.indices)!=1:
+        raise ValueError("A label request takes a single pool index, batches go to fetch_label_batch")
+      x_label = candidate_pools.rows(session_id,label_params.indices)
+    else:
+      x_label = asarray(label_params.x_label,dtype=float).reshape(1,-1)
     # Currently labeling is allowed only after training for at least one iteration
     if session_id in models.keys(): # ==> you have a pre-trained model, need to return error otherwise
       learner = models[session_id]
-      predicted_class = float(learner.predict(x_label.reshape(1,-1)))
-      label_dict = streamed_sampling_iteration(learner, x_label, 0.5) # TODO make uncertainty threshold a parameter and remove hardcoding.
+      # Repeated candidates are answered from the cache until the learner is trained again
+      inference = inference_cache.infer(session_id,learner,x_label)
+      label_dict = streamed_sampling_iteration(learner, x_label, label_params.uncertainty_threshold, label_params.query_criterion, inference)
+      inference = label_dict["inference"]
+      predicted_class = float(inference["predicted"][0])
       if label_dict:
-        session = update_session(session_id,success=True)
-        remaining_iterations = int(session["completed_iterations"]-session["num_iterations"])
+        session = update_session(session_id,success=True,reserved=reserved)
+        committed = True
+        remaining_iterations = int(session["num_iterations"]-session["completed_iterations"])
         response_dict = {"message":"Label request successful, {} compute iterations completed,\
         {} iterations remaining in session.".format(session["completed_iterations"],remaining_iterations),\
-        "decision":label_dict["label"], "uncertainty":list(label_dict["uncertainty"]),\
+        "decision":label_dict["label"], "uncertainty":label_dict["uncertainty"].tolist(),\
+        "query_criterion":label_params.query_criterion,"least_confidence":inference["least_confidence"].tolist(),\
+        "margin":inference["margin"].tolist(),"entropy":inference["entropy"].tolist(),\
         "remaining_iterations":[remaining_iterations],\
-        "predicted_label":predicted_class}
+        "predicted_label":predicted_class,"model_version":model_version(learner)}
     else:
-        session = update_session(session_id,success=True)
-        remaining_iterations = int(session["completed_iterations"]-session["num_iterations"])
+        session = update_session(session_id,success=True,reserved=reserved)
+        committed = True
+        remaining_iterations = int(session["num_iterations"]-session["completed_iterations"])
         response_dict = {"message":"Data point needs labeling, {} compute iterations completed,\
         {} iterations remaining in session.".format(session["completed_iterations"],remaining_iterations),\
         "decision":"label", "uncertainty":[1.0],\
         "remaining_iterations":[remaining_iterations],\
-        "predicted_label":["None"]}      
+        "predicted_label":["None"],"model_version":0}      
   except Exception as e:
-    print_exc(e)
+    print_exc()
+  if reserved and not committed:
+    update_session(session_id,success=False,reserved=reserved)
   
   return response_dict
 
+def fetch_label_batch(label_params:BatchLabelParams=None,session_id:str=None,completed_iterations:int=None,\
+                      reserved:bool=False,num_iterations:int=1):
+  """
+  Label a batch of feature vectors (an N x d matrix) with one predict_proba call.
+  Returns per row decisions, uncertainties (the query criterion's values) and predicted labels as arrays.
+  The request costs num_iterations iterations. If they were reserved they are committed on success and refunded on failure.
+  """
+  response_dict={"message":"Label unsuccessful. Internal error. You still have {} compute iterations in this session".format(completed_iterations)}
+  committed = False
+  try:
+    if label_params.indices is not None:
+      x_label = candidate_pools.rows(session_id,label_params.indices)
+    else:
+      x_label = asarray(label_params.x_label,dtype=float)
+    if x_label.ndim==1:
+      x_label = x_label.reshape(1,-1)
+    if session_id in models.keys():
+      learner = models[session_id]
+      inference = infer(learner,x_label)
+      decisions = label_decisions(inference,label_params.query_criterion,label_params.uncertainty_threshold).tolist()
+      uncertainty = inference[label_params.query_criterion]
+      predicted_labels = inference["predicted"].tolist()
+      version = model_version(learner)
+    else:
+      # No model yet, every row needs a label
+      inference = None
+      uncertainty = full(x_label.shape[0],1.0)
+      decisions = ["label"]*x_label.shape[0]
+      predicted_labels = [None]*x_label.shape[0]
+      version = 0
+    session = update_session(session_id,success=True,reserved=reserved,n=num_iterations)
+    committed = True
+    remaining_iterations = int(session["num_iterations"]-session["completed_iterations"])
+    response_dict = {"message":"Label request successful, {} rows labeled, {} compute iterations completed,\
+    {} iterations remaining in session.".format(x_label.shape[0],session["completed_iterations"],remaining_iterations),\
+    "decision":decisions,"uncertainty":uncertainty.tolist(),"predicted_label":predicted_labels,\
+    "query_criterion":label_params.query_criterion,\
+    "remaining_iterations":[remaining_iterations],"iterations_charged":num_iterations,"model_version":version}
+  except Exception as e:
+    print_exc()
+  if reserved and not committed:
+    update_session(session_id,success=False,reserved=reserved,n=num_iterations)
+
+  return response_dict
+
+def query_model(query_params:QueryParams=None,session_id:str=None,completed_iterations:int=None,\
+                reserved:bool=False,num_iterations:int=1):
+  """
+  Pool based query. Returns the indices of the k most informative rows of x_pool, optionally as a diverse batch.
+  Without x_pool the session's uploaded pool is queried ("next best index"), using scores cached per model version.
+  Without a trained model k random rows are returned.
+  The request costs num_iterations iterations. If they were reserved they are committed on success and refunded on failure.
+  Scoring an uploaded pool for a new model version also costs labeling every pool row, reserved here.
+  """
+  response_dict={"message":"Query unsuccessful. Internal error. You still have {} compute iterations in this session".format(completed_iterations)}
+  committed = False
+  try:
+    scores = exclude = None
+    if query_params.x_pool is None:
+      x_pool = candidate_pools.get(session_id)
+      if query_params.exclude_labeled:
+        exclude = labeled_indices(session_id)
+    else:
+      x_pool = asarray(query_params.x_pool,dtype=float)
+    if session_id in models.keys():
+      learner = models[session_id]
+      if query_params.x_pool is None:
+        if reserved and not candidate_pools.has_scores(session_id,learner,query_params.query_criterion):
+          scoring_iterations = max(label_batch_iterations(x_pool.shape[0])-num_iterations,0)
+          if scoring_iterations and not reserve_iterations(session_id,scoring_iterations):
+            update_session(session_id,success=False,reserved=reserved,n=num_iterations)
+            return {**response_dict,"error":"Scoring the pool's {} rows for model version {} needs {} more compute iterations, more than the session has remaining"\
+                    .format(x_pool.shape[0],model_version(learner),scoring_iterations)}
+          num_iterations += scoring_iterations
+        scores = candidate_pools.scores(session_id,learner,query_params.query_criterion)
+      query_dict = query_pool(learner,x_pool,query_params.k,query_params.query_criterion,query_params.diversity,\
+                              scores=scores,exclude=exclude)
+      version = model_version(learner)
+    else:
+      candidates = setdiff1d(arange(x_pool.shape[0]),exclude) if exclude is not None else arange(x_pool.shape[0])
+      k = min(query_params.k,candidates.shape[0])
+      query_dict = {"indices":random.choice(candidates,k,replace=False).tolist(),"scores":[1.0]*k}
+      version = 0
+    session = update_session(session_id,success=True,reserved=reserved,n=num_iterations)
+    committed = True
+    remaining_iterations = int(session["num_iterations"]-session["completed_iterations"])
+    response_dict = {"message":"Query successful, {} of {} rows selected, {} compute iterations completed,\
+    {} iterations remaining in session.".format(len(query_dict["indices"]),x_pool.shape[0],session["completed_iterations"],remaining_iterations),\
+    "indices":query_dict["indices"],"scores":query_dict["scores"],"query_criterion":query_params.query_criterion,\
+    "diversity":query_params.diversity,"remaining_iterations":[remaining_iterations],\
+    "iterations_charged":num_iterations,"model_version":version}
+  except Exception as e:
+    print_exc()
+  if reserved and not committed:
+    update_session(session_id,success=False,reserved=reserved,n=num_iterations)
+
+  return response_dict
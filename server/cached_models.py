@@ -1 +1,219 @@
-models = dict()
\ No newline at end of file
+import os, sys, threading, time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from traceback import print_exc
+from dotenv import load_dotenv
+from .model_registry import ModelRegistry, LocalDiskModelRegistry, StaleModelError, model_version, bump_model_version
+from .sample_log import SampleLog, sample_log
+
+load_dotenv('./envvars.env')
+
+ALSATS_DIR = os.environ.get('ALSATS_DIR','~/lightning/alsats')
+ALSATS_MODEL_CACHE_BYTES = int(os.environ.get('ALSATS_MODEL_CACHE_BYTES',1<<30))
+ALSATS_MODEL_CACHE_TTL = float(os.environ.get('ALSATS_MODEL_CACHE_TTL',3600))
+ALSATS_MODEL_REGISTRY_DIR = os.environ.get('ALSATS_MODEL_REGISTRY_DIR',ALSATS_DIR+'/server/model_registry')
+# "local": learners are written to the registry only when spilled.
+# "shared": every trained version is published and cached copies are checked for staleness,
+# for several uvicorn workers or nodes sharing the registry directory.
+ALSATS_MODEL_REGISTRY = os.environ.get('ALSATS_MODEL_REGISTRY','local')
+
+def learner_nbytes(learner)->int:
+    """
+    Estimates the resident memory of a learner: its accumulated training data plus the nodes of its trees.
+    """
+    nbytes = 0
+    if hasattr(learner,'training_nbytes'):
+        # Growable buffers hold spare capacity beyond the X_training/y_training views
+        nbytes += learner.training_nbytes()
+    else:
+        for attr in ('X_training','y_training'):
+            nbytes += getattr(getattr(learner,attr,None),'nbytes',0)
+    estimators = getattr(getattr(learner,'estimator',None),'estimators_',[])
+    for estimator in getattr(estimators,'ravel',lambda: estimators)():
+        tree = getattr(estimator,'tree_',None)
+        if tree is not None:
+            # ~64 bytes per node plus its class value array
+            nbytes += tree.node_count*(64+8*tree.n_outputs*int(max(tree.n_classes)))
+    return max(nbytes,sys.getsizeof(learner))
+
+
+class ModelCache(MutableMapping):
+    """
+    Bounded cache of session learners, keyed by session ID, backed by a model registry.
+    Least recently used learners are spilled to the registry when the memory budget is exceeded
+    or when they have been idle for longer than ttl seconds, and rehydrated on their next access.
+    Spilled learners still count as members, so "session_id in models" is unchanged.
+    With shared=True every assignment publishes the learner's version, and a cached learner
+    older than the registry's latest version is reloaded instead of served.
+    With a sample_log, a learner that is neither resident nor newer in the registry (e.g. after a restart)
+    is rebuilt by replaying the session's logged batches.
+    """
+
+    def __init__(self,max_bytes:int=ALSATS_MODEL_CACHE_BYTES,ttl:float=ALSATS_MODEL_CACHE_TTL,\
+                 registry:ModelRegistry=None,shared:bool=False,sample_log:SampleLog=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.registry = registry if registry is not None else LocalDiskModelRegistry(ALSATS_MODEL_REGISTRY_DIR)
+        self.shared = shared
+        self.sample_log = sample_log
+        self._lock = threading.RLock()
+        self._resident = OrderedDict() # session_id -> [learner, nbytes, last_used]
+        self._resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self.rehydrations = 0
+
+    def __getitem__(self,session_id:str):
+        with self._lock:
+            entry = self._resident.get(session_id)
+            if entry is not None and self.shared and self.registry.latest_version(session_id)>model_version(entry[0]):
+                # Another worker trained this session since it was cached here
+                self.stale += 1
+                self._remove_resident(session_id)
+                entry = None
+            if entry is not None:
+                self.hits += 1
+                entry[2] = time.monotonic()
+                self._resident.move_to_end(session_id)
+                return entry[0]
+            self.misses += 1
+        # Loaded without the lock, so a long replay doesn't hold up the other sessions
+        learner, pending = self._load(session_id)
+        with self._lock:
+            entry = self._resident.get(session_id)
+            if entry is not None and model_version(entry[0])>=model_version(learner):
+                # Loaded or trained by another thread meanwhile, e.g. a background retrain
+                return entry[0]
+            self._remove_resident(session_id)
+            self.rehydrations += 1
+            self._insert(session_id,learner)
+        if pending:
+            self._rebuffer(session_id,learner,pending)
+        return learner
+
+    def _load(self,session_id:str)->tuple:
+        """
+        Loads a learner from the registry, or replays its sample log if the log has batches the registry lacks.
+        Returns the learner and the logged batches that were buffered for a retrain after its version.
+        """
+        if self.sample_log is None or not self.sample_log.exists(session_id):
+            return self.registry.load(session_id), []
+        version = self.registry.latest_version(session_id)
+        if version<self.sample_log.logged_version(session_id):
+            return self.sample_log.replay(session_id), []
+        return self.registry.load(session_id), self.sample_log.buffered(session_id,version)
+
+    def _rebuffer(self,session_id:str,learner,pending:list):
+        """ Hands batches buffered before a restart back to the retrain scheduler, instead of refitting on load """
+        # Imported here since the retrain scheduler imports the model cache
+        from .retrain_scheduler import RetrainPolicy, retrain_scheduler
+        if not retrain_scheduler.idle(session_id):
+            # Still buffered in this process
+            return
+        taught = False
+        for params, X, y in pending:
+            policy = getattr(learner,'retrain_policy',None) or RetrainPolicy.from_params(params)
+            if policy is None:
+                learner.teach(X,y)
+                taught = True
+            else:
+                retrain_scheduler.buffer(session_id,policy,X,y)
+        if taught:
+            bump_model_version(learner)
+            self[session_id] = learner # Updates the learner's size and version, like a train
+
+    def __setitem__(self,session_id:str,learner):
+        """ Adds or replaces a learner. Reassign a learner after training it to update its size and version """
+        with self._lock:
+            if model_version(learner)==0:
+                bump_model_version(learner)
+            if self.shared:
+                try:
+                    self.registry.publish(session_id,learner)
+                except Exception:
+                    # learner may have been trained in place, drop it so the next access reloads the registry's copy
+                    self._remove_resident(session_id)
+                    raise
+            self._remove_resident(session_id)
+            self._insert(session_id,learner)
+
+    def __delitem__(self,session_id:str):
+        with self._lock:
+            if session_id not in self:
+                raise KeyError(session_id)
+            self._remove_resident(session_id)
+            self.registry.delete(session_id)
+            if self.sample_log is not None:
+                self.sample_log.delete(session_id)
+
+    def __contains__(self,session_id)->bool:
+        with self._lock:
+            return session_id in self._resident or self.registry.latest_version(session_id)>0 or \
+                   (self.sample_log is not None and self.sample_log.exists(session_id))
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._resident.keys()))
+
+    def __len__(self)->int:
+        with self._lock:
+            return len(self._resident)
+
+    def stats(self)->dict:
+        """ Cache counters """
+        with self._lock:
+            return {"hits":self.hits,"misses":self.misses,"stale":self.stale,"evictions":self.evictions,\
+                    "rehydrations":self.rehydrations,"resident":len(self._resident),"resident_bytes":self._resident_bytes,\
+                    "max_bytes":self.max_bytes}
+
+    def _insert(self,session_id:str,learner):
+        nbytes = learner_nbytes(learner)
+        self._resident[session_id] = [learner,nbytes,time.monotonic()]
+        self._resident_bytes += nbytes
+        self._evict()
+
+    def _remove_resident(self,session_id:str):
+        entry = self._resident.pop(session_id,None)
+        if entry is not None:
+            self._resident_bytes -= entry[1]
+        return entry
+
+    def _evict(self):
+        """ Spills idle learners, then least recently used learners until the cache is within budget """
+        now = time.monotonic()
+        for session_id in list(self._resident.keys())[:-1]:
+            if now-self._resident[session_id][2]>self.ttl:
+                self._spill(session_id)
+        # The most recently used learner always stays resident
+        while self._resident_bytes>self.max_bytes and len(self._resident)>1:
+            if not self._spill(next(iter(self._resident))):
+                break
+
+    def _spill(self,session_id:str)->bool:
+        entry = self._remove_resident(session_id)
+        try:
+            self.registry.publish(session_id,entry[0])
+            self.evictions += 1
+            return True
+        except StaleModelError:
+            # Another worker published a newer learner, which is loaded on the next access
+            print_exc()
+            self.stale += 1
+            return True
+        except Exception:
+            # Keep the learner in memory rather than losing it
+            print_exc()
+            self._resident[session_id] = entry
+            self._resident.move_to_end(session_id,last=False)
+            self._resident_bytes += entry[1]
+            return False
+
+
+models = ModelCache(shared=ALSATS_MODEL_REGISTRY=="shared",sample_log=sample_log)
+settled_invoices = set()
+
+def model_cache_stats()->dict:
+    """ Counters of this process's model cache """
+    return models.stats()
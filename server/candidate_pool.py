@@ -0,0 +1,168 @@
+import asyncio, os, threading
+from collections import OrderedDict
+import numpy as np
+from dotenv import load_dotenv
+from .model_registry import model_version
+from .pool_query import score_pool
+
+load_dotenv('./envvars.env')
+
+ALSATS_DIR = os.environ.get('ALSATS_DIR','~/lightning/alsats')
+ALSATS_POOL_DIR = os.environ.get('ALSATS_POOL_DIR',ALSATS_DIR+'/server/pools')
+ALSATS_POOL_MAX_BYTES = int(os.environ.get('ALSATS_POOL_MAX_BYTES',4<<30))
+# Number of sessions whose pool scores are kept per process
+ALSATS_POOL_SCORE_CACHE = int(os.environ.get('ALSATS_POOL_SCORE_CACHE',64))
+
+class PoolError(ValueError):
+    """ Raised for a missing or malformed candidate pool, or an index outside it """
+    pass
+
+def pool_path(session_id:str)->str:
+    return os.path.join(os.path.expanduser(ALSATS_POOL_DIR),session_id+'.npy')
+
+def validate_pool(path:str)->dict:
+    """ Checks that path holds a 2-D numeric .npy array. Returns its shape and dtype """
+    try:
+        pool = np.load(path,mmap_mode='r',allow_pickle=False)
+    except (ValueError, OSError) as e:
+        raise PoolError("Pool must be a .npy file of a 2-D numeric array: {}".format(e))
+    if pool.ndim!=2 or pool.dtype.kind not in 'fiub':
+        raise PoolError("Pool must be a 2-D numeric array, got {} dimensions of {}".format(pool.ndim,pool.dtype))
+    return {"rows":int(pool.shape[0]),"columns":int(pool.shape[1]),"dtype":str(pool.dtype)}
+
+async def save_pool(session_id:str,chunks)->dict:
+    """
+    Streams an uploaded .npy array (an async iterable of byte chunks) to the session's pool file.
+    The upload is written next to the pool and only replaces it once it is complete and valid.
+    """
+    # File writes and validation run in the default executor so they don't block the event loop
+    loop = asyncio.get_running_loop()
+    path = pool_path(session_id)
+    os.makedirs(os.path.dirname(path),exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(path,os.getpid())
+    nbytes = 0
+    try:
+        with open(tmp_path,'wb') as f:
+            async for chunk in chunks:
+                nbytes += len(chunk)
+                if nbytes>ALSATS_POOL_MAX_BYTES:
+                    raise PoolError("Pool is larger than {} bytes".format(ALSATS_POOL_MAX_BYTES))
+                await loop.run_in_executor(None,f.write,chunk)
+        return await loop.run_in_executor(None,_replace_pool,session_id,tmp_path,path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _replace_pool(session_id:str,tmp_path:str,path:str)->dict:
+    """ Validates a completed upload and moves it over the session's pool """
+    info = validate_pool(tmp_path)
+    os.replace(tmp_path,path)
+    # Labeled indices referred to the previous pool
+    if os.path.exists(labeled_path(session_id)):
+        os.remove(labeled_path(session_id))
+    return info
+
+def labeled_path(session_id:str)->str:
+    return os.path.join(os.path.expanduser(ALSATS_POOL_DIR),session_id+'.labeled')
+
+def mark_labeled(session_id:str,indices)->None:
+    """ Appends pool indices the session has trained on to its labeled file, shared by all workers """
+    with open(labeled_path(session_id),'ab') as f:
+        f.write(np.asarray(indices,dtype='<i8').ravel().tobytes())
+
+def labeled_indices(session_id:str)->np.ndarray:
+    """ Pool indices the session has trained on """
+    try:
+        return np.unique(np.fromfile(labeled_path(session_id),dtype='<i8'))
+    except FileNotFoundError:
+        return np.empty(0,dtype=np.int64)
+
+def delete_pool(session_id:str)->None:
+    for path in (pool_path(session_id),labeled_path(session_id)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class CandidatePools:
+    """
+    Memory maps of session pools and their scores, per process.
+    A pool is reopened when its file is replaced. Scores are cached per pool file, model version
+    and query criterion, so repeated next best queries between two trainings only rank cached scores.
+    """
+
+    def __init__(self,max_sessions:int=ALSATS_POOL_SCORE_CACHE):
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._pools = OrderedDict() # session_id -> (file key, memmap)
+        self._scores = OrderedDict() # session_id -> (file key, model version, criterion, scores)
+        self.score_hits = 0
+        self.score_misses = 0
+
+    def _file_key(self,session_id:str)->tuple:
+        try:
+            stat = os.stat(pool_path(session_id))
+        except FileNotFoundError:
+            raise PoolError("Session {} has no candidate pool. Upload one to /pool/{}".format(session_id,session_id))
+        return (stat.st_ino,stat.st_mtime_ns,stat.st_size)
+
+    def get(self,session_id:str)->np.ndarray:
+        """ The session's pool as a read only memory map """
+        key = self._file_key(session_id)
+        with self._lock:
+            entry = self._pools.get(session_id)
+            if entry is None or entry[0]!=key:
+                entry = (key,np.load(pool_path(session_id),mmap_mode='r',allow_pickle=False))
+                self._pools[session_id] = entry
+            self._pools.move_to_end(session_id)
+            while len(self._pools)>self.max_sessions:
+                self._pools.popitem(last=False)
+            return entry[1]
+
+    def rows(self,session_id:str,indices)->np.ndarray:
+        """ Rows of the session's pool, as a float array """
+        pool = self.get(session_id)
+        indices = np.asarray(indices,dtype=np.int64).ravel()
+        if indices.size==0 or indices.min()<0 or indices.max()>=pool.shape[0]:
+            raise PoolError("Pool indices must be between 0 and {}".format(pool.shape[0]-1))
+        return np.asarray(pool[indices],dtype=float)
+
+    def has_scores(self,session_id:str,learner,criterion:str="least_confidence")->bool:
+        """ True if scores would return cached scores instead of scoring every pool row """
+        key = self._file_key(session_id)
+        with self._lock:
+            entry = self._scores.get(session_id)
+            return entry is not None and entry[:3]==(key,model_version(learner),criterion)
+
+    def scores(self,session_id:str,learner,criterion:str="least_confidence")->np.ndarray:
+        """ Informativeness of every pool row under the learner's current version, computed once per version """
+        pool = self.get(session_id)
+        key = self._file_key(session_id)
+        version = model_version(learner)
+        with self._lock:
+            entry = self._scores.get(session_id)
+            if entry is not None and entry[:3]==(key,version,criterion):
+                self.score_hits += 1
+                self._scores.move_to_end(session_id)
+                return entry[3]
+            self.score_misses += 1
+        scores = score_pool(learner,pool,criterion)
+        with self._lock:
+            self._scores[session_id] = (key,version,criterion,scores)
+            self._scores.move_to_end(session_id)
+            while len(self._scores)>self.max_sessions:
+                self._scores.popitem(last=False)
+        return scores
+
+    def stats(self)->dict:
+        with self._lock:
+            return {"pools":len(self._pools),"scored_sessions":len(self._scores),\
+                    "score_hits":self.score_hits,"score_misses":self.score_misses}
+
+
+candidate_pools = CandidatePools()
+
+def candidate_pool_stats()->dict:
+    """ Counters of this process's candidate pools """
+    return candidate_pools.stats()
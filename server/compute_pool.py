@@ -0,0 +1,69 @@
+import asyncio, functools, multiprocessing, os, threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from hashlib import sha256
+from dotenv import load_dotenv
+
+load_dotenv('./envvars.env')
+
+ALSATS_COMPUTE_WORKERS = int(os.environ.get('ALSATS_COMPUTE_WORKERS',os.cpu_count() or 1))
+ALSATS_COMPUTE_MODE = os.environ.get('ALSATS_COMPUTE_MODE','process')
+
+def session_slot(session_id:str,num_slots:int)->int:
+    """ Stable mapping of a session ID to one of num_slots workers, identical in every process and on every node """
+    return int(sha256(session_id.encode()).hexdigest()[:8],16)%num_slots
+
+
+class ComputePool:
+    """
+    Runs training and inference off the event loop.
+    Every worker is a single threaded executor and a session is always sent to the same worker,
+    so its learner stays in that worker's model cache and its requests run one at a time.
+    mode is "process" (one process per worker) or "thread" (learners stay in this process).
+    """
+
+    def __init__(self,num_workers:int=ALSATS_COMPUTE_WORKERS,mode:str=ALSATS_COMPUTE_MODE):
+        if mode not in ("process","thread"):
+            raise ValueError("Compute mode must be process or thread, not {}".format(mode))
+        self.num_workers = max(int(num_workers),1)
+        self.mode = mode
+        self._executors = [None]*self.num_workers
+        self._lock = threading.Lock()
+
+    def _executor(self,slot:int):
+        with self._lock:
+            if self._executors[slot] is None:
+                if self.mode=="process":
+                    self._executors[slot] = ProcessPoolExecutor(max_workers=1,mp_context=multiprocessing.get_context("spawn"))
+                else:
+                    self._executors[slot] = ThreadPoolExecutor(max_workers=1,thread_name_prefix="alsats-compute-{}".format(slot))
+            return self._executors[slot]
+
+    async def _run_on_slot(self,slot:int,fn,*args,**kwargs):
+        executor = self._executor(slot)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor,functools.partial(fn,*args,**kwargs))
+        except BrokenProcessPool:
+            # The worker died (e.g. out of memory). Replace it so later requests get a fresh worker.
+            with self._lock:
+                if self._executors[slot] is executor:
+                    self._executors[slot] = None
+            raise
+
+    async def run(self,session_id:str,fn,*args,**kwargs):
+        """ Runs fn(*args,**kwargs) on the worker that owns session_id """
+        return await self._run_on_slot(session_slot(session_id,self.num_workers),fn,*args,**kwargs)
+
+    async def run_on_all(self,fn,*args,**kwargs)->list:
+        """ Runs fn on every worker, e.g. to collect per worker stats """
+        return await asyncio.gather(*[self._run_on_slot(slot,fn,*args,**kwargs) for slot in range(self.num_workers)])
+
+    def shutdown(self):
+        with self._lock:
+            for executor in self._executors:
+                if executor is not None:
+                    executor.shutdown(wait=False,cancel_futures=True)
+            self._executors = [None]*self.num_workers
+
+
+compute_pool = ComputePool()
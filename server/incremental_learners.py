@@ -0,0 +1,179 @@
+import numpy as np
+from sklearn.base import BaseEstimator, ClassifierMixin, clone
+from sklearn.ensemble import RandomForestClassifier
+import scipy.sparse as sp
+from .training_buffer import BufferedActiveLearner
+
+class HoeffdingTreeClassifier(BaseEstimator, ClassifierMixin):
+    """
+    sklearn style wrapper around river's streaming Hoeffding tree.
+    Every sample is learned once with learn_one, so partial_fit costs O(batch) regardless of the session's size.
+    river is optional and only imported when the "ht" algorithm is used.
+    """
+
+    def __init__(self,grace_period:int=200,delta:float=1e-7):
+        self.grace_period = grace_period
+        self.delta = delta
+
+    def _new_tree(self):
+        try:
+            from river.tree import HoeffdingTreeClassifier as RiverHoeffdingTree
+        except ImportError:
+            raise ValueError("The ht algorithm needs the river package (pip install river)")
+        return RiverHoeffdingTree(grace_period=self.grace_period,delta=self.delta)
+
+    def fit(self,X,y,classes=None):
+        self.tree_ = None
+        return self.partial_fit(X,y,classes)
+
+    def partial_fit(self,X,y,classes=None):
+        X = np.asarray(X,dtype=float)
+        y = np.asarray(y).ravel()
+        if getattr(self,'tree_',None) is None:
+            self.tree_ = self._new_tree()
+            self.classes_ = np.unique(y if classes is None else classes)
+        self.classes_ = np.union1d(self.classes_,y)
+        for x_row, y_row in zip(X,y):
+            self.tree_.learn_one(dict(enumerate(x_row.tolist())),y_row.item())
+        return self
+
+    def predict_proba(self,X):
+        X = np.asarray(X,dtype=float)
+        proba = np.zeros((X.shape[0],len(self.classes_)))
+        for i, x_row in enumerate(X):
+            class_proba = self.tree_.predict_proba_one(dict(enumerate(x_row.tolist())))
+            for j, label in enumerate(self.classes_):
+                proba[i,j] = class_proba.get(label.item(),0.0)
+            total = proba[i].sum()
+            proba[i] = proba[i]/total if total>0 else 1.0/len(self.classes_)
+        return proba
+
+    def predict(self,X):
+        return self.classes_[np.argmax(self.predict_proba(X),axis=1)]
+
+
+class GrowingForestClassifier(BaseEstimator, ClassifierMixin):
+    """
+    Random forest that grows instead of refitting.
+    The first fit trains n_estimators trees. Every partial_fit after that keeps the existing trees and uses
+    warm_start to add n_new_estimators trees fitted on the last window samples, retiring the oldest trees
+    beyond max_estimators. The latest sample of every class is added to each new fit so all trees share
+    the same classes. Training time per call is bounded by n_new_estimators and window, not the session size.
+    """
+
+    def __init__(self,n_estimators:int=100,n_new_estimators:int=10,max_estimators:int=100,window:int=256,random_state=None):
+        self.n_estimators = n_estimators
+        self.n_new_estimators = n_new_estimators
+        self.max_estimators = max_estimators
+        self.window = window
+        self.random_state = random_state
+
+    @property
+    def estimators_(self)->list:
+        return self.forest_.estimators_
+
+    @property
+    def classes_(self):
+        return self.forest_.classes_
+
+    def fit(self,X,y,classes=None):
+        self.forest_ = None
+        return self.partial_fit(X,y,classes)
+
+    def partial_fit(self,X,y,classes=None):
+        X = np.asarray(X,dtype=float)
+        y = np.asarray(y).ravel()
+        if getattr(self,'forest_',None) is None:
+            self.X_window_, self.y_window_ = X[:0], y[:0]
+            self.exemplars_ = {}
+        self.X_window_ = np.concatenate((self.X_window_,X))[-self.window:]
+        self.y_window_ = np.concatenate((self.y_window_,y))[-self.window:]
+        for x_row, y_row in zip(X,y):
+            self.exemplars_[y_row.item()] = x_row
+        if getattr(self,'forest_',None) is not None and not np.isin(y,self.forest_.classes_).all():
+            # A new class can't be mixed into trees fitted without it, start a new forest on the window
+            self.forest_ = None
+            X, y = self._window_with_exemplars()
+        if getattr(self,'forest_',None) is None:
+            self.forest_ = RandomForestClassifier(n_estimators=self.n_estimators,warm_start=True,random_state=self.random_state)
+            self.forest_.fit(X,y)
+            return self
+        keep = max(self.max_estimators-self.n_new_estimators,0)
+        if len(self.forest_.estimators_)>keep:
+            self.forest_.estimators_ = self.forest_.estimators_[len(self.forest_.estimators_)-keep:]
+        self.forest_.n_estimators = len(self.forest_.estimators_)+self.n_new_estimators
+        self.forest_.fit(*self._window_with_exemplars())
+        return self
+
+    def _window_with_exemplars(self)->tuple:
+        """ The recent window plus the latest sample of every class missing from it """
+        missing = [label for label in self.exemplars_ if not np.isin(label,self.y_window_)]
+        if not missing:
+            return self.X_window_, self.y_window_
+        X = np.concatenate((self.X_window_,np.array([self.exemplars_[label] for label in missing])))
+        y = np.concatenate((self.y_window_,np.array(missing,dtype=self.y_window_.dtype)))
+        return X, y
+
+    def predict_proba(self,X):
+        return self.forest_.predict_proba(X)
+
+    def predict(self,X):
+        return self.forest_.predict(X)
+
+
+def as_float64(X):
+    """
+    X as float64. Some estimators (e.g. SGDClassifier) can't partial_fit a different dtype than they were
+    first fit on, and compact storage (see training_buffer) can change the stored dtype during a session.
+    """
+    return X.astype(np.float64) if sp.issparse(X) else np.asarray(X,dtype=np.float64)
+
+
+class IncrementalActiveLearner(BufferedActiveLearner):
+    """
+    Active learner over an estimator with partial_fit.
+    Labeled samples are still added to X_training/y_training, but with only_new=True teach() only
+    calls partial_fit on the new batch instead of refitting on everything labeled so far.
+    classes are all labels the session can use, partial_fit needs them up front.
+    """
+
+    def __init__(self,estimator,classes=None,only_new:bool=True,**kwargs):
+        self.classes = None if classes is None else np.unique(classes)
+        self.only_new = only_new
+        super().__init__(estimator,**kwargs)
+
+    def _update_classes(self,y)->bool:
+        """ Adds labels in y to the known classes. Returns True if there was a new label """
+        y_classes = np.unique(np.asarray(y).ravel())
+        if self.classes is None:
+            self.classes = y_classes
+            return True
+        classes = np.union1d(self.classes,y_classes)
+        changed = len(classes)!=len(self.classes)
+        self.classes = classes
+        return changed
+
+    def _fit_to_known(self,bootstrap:bool=False,**fit_kwargs)->'IncrementalActiveLearner':
+        self._update_classes(self.y_training)
+        self.estimator = clone(self.estimator)
+        self.estimator.partial_fit(as_float64(self.X_training),np.asarray(self.y_training).ravel(),classes=self.classes,**fit_kwargs)
+        return self
+
+    def _fit_on_new(self,X,y,bootstrap:bool=False,**fit_kwargs)->'IncrementalActiveLearner':
+        if self._update_classes(y):
+            # partial_fit can't add a class to a fitted estimator, refit with the new label set
+            return self._fit_to_known(**fit_kwargs)
+        self.estimator.partial_fit(as_float64(X),np.asarray(y).ravel(),classes=self.classes,**fit_kwargs)
+        return self
+
+    def teach(self,X,y,bootstrap:bool=False,only_new:bool=None,**fit_kwargs)->None:
+        """
+        Adds X,y to the training data and updates the estimator.
+        only_new defaults to the learner's only_new setting.
+        """
+        only_new = self.only_new if only_new is None else only_new
+        self._add_training_data(X,y)
+        if only_new:
+            self._fit_on_new(X,y,**fit_kwargs)
+        else:
+            self._fit_to_known(**fit_kwargs)
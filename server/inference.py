@@ -0,0 +1,35 @@
+import numpy as np
+
+# Query criteria for label decisions and whether a higher value means a more uncertain prediction
+QUERY_CRITERIA = {"least_confidence":True,"margin":False,"entropy":True}
+
+def infer(learner,X)->dict:
+    """
+    Runs predict_proba once and derives everything a label decision needs from it.
+    Returns arrays with one value per row of X: probabilities, predicted class,
+    least confidence (1 - max probability), margin (top two probabilities' difference) and entropy.
+    """
+    X = np.asarray(X)
+    if X.ndim==1:
+        X = X.reshape(1,-1)
+    proba = np.asarray(learner.predict_proba(X))
+    top = np.sort(proba,axis=1)[:,::-1]
+    second = top[:,1] if proba.shape[1]>1 else np.zeros(proba.shape[0])
+    with np.errstate(divide="ignore",invalid="ignore"):
+        entropy = -np.sum(np.where(proba>0,proba*np.log(proba),0.0),axis=1)
+    return {"proba":proba,
+            "predicted":learner.estimator.classes_[np.argmax(proba,axis=1)],
+            "least_confidence":1-top[:,0],
+            "margin":top[:,0]-second,
+            "entropy":entropy}
+
+def label_decisions(inference:dict,criterion:str="least_confidence",threshold:float=0.5)->np.ndarray:
+    """
+    "label" for rows whose criterion is at least as uncertain as threshold, "do not label" otherwise.
+    For least_confidence and entropy higher values are more uncertain, for margin lower values are.
+    """
+    if criterion not in QUERY_CRITERIA:
+        raise ValueError("Unknown query criterion {}. Use one of {}".format(criterion,sorted(QUERY_CRITERIA)))
+    values = inference[criterion]
+    uncertain = values>=threshold if QUERY_CRITERIA[criterion] else values<=threshold
+    return np.where(uncertain,"label","do not label")
@@ -0,0 +1,63 @@
+import os, threading
+from collections import OrderedDict
+from hashlib import sha256
+import numpy as np
+from dotenv import load_dotenv
+from .inference import infer
+from .model_registry import model_version
+
+load_dotenv('./envvars.env')
+
+# Candidates whose inference is kept per process, over all sessions
+ALSATS_INFERENCE_CACHE = int(os.environ.get('ALSATS_INFERENCE_CACHE',65536))
+
+def feature_key(X)->str:
+    """ Hash of a candidate's features. Lists and arrays of any numeric dtype with equal values hash alike """
+    X = np.ascontiguousarray(X,dtype=float)
+    return sha256(str(X.shape).encode()+X.tobytes()).hexdigest()
+
+
+class InferenceCache:
+    """
+    Inference results (see inference.infer) of candidates sessions have asked about, keyed by a hash of the features.
+    Every entry records the version of the learner that produced it and is only used while the session's
+    learner still has that version, so training invalidates a session's entries without telling the cache.
+    Least recently used entries are dropped beyond max_entries.
+    """
+
+    def __init__(self,max_entries:int=ALSATS_INFERENCE_CACHE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # (session_id, feature hash) -> (model version, inference)
+        self.hits = 0
+        self.misses = 0
+
+    def infer(self,session_id:str,learner,X)->dict:
+        """ infer(learner,X), answered from the cache if the learner's current version already scored X """
+        key = (session_id,feature_key(X))
+        version = model_version(learner)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0]==version:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry[1]
+            self.misses += 1
+        inference = infer(learner,X)
+        with self._lock:
+            self._entries[key] = (version,inference)
+            self._entries.move_to_end(key)
+            while len(self._entries)>self.max_entries:
+                self._entries.popitem(last=False)
+        return inference
+
+    def stats(self)->dict:
+        with self._lock:
+            return {"entries":len(self._entries),"hits":self.hits,"misses":self.misses}
+
+
+inference_cache = InferenceCache()
+
+def inference_cache_stats()->dict:
+    """ Counters of this process's inference cache """
+    return inference_cache.stats()
@@ -0,0 +1,44 @@
+import asyncio, os
+from traceback import print_exc
+from . import server_utils
+
+ALSATS_INVOICE_LISTENER = os.environ.get("ALSATS_INVOICE_LISTENER","1")=="1"
+RECONNECT_DELAY_MAX = 60
+
+async def listen_for_settled_invoices():
+    """
+    Consumes LND's invoice subscription and flags sessions as paid as soon as their invoices settle,
+    so compute requests don't need to ask LND.
+    Reconnects with exponential backoff and resumes from the last settle index seen.
+    """
+    delay = 1
+    while True:
+        try:
+            settle_index = server_utils.get_settle_index()
+            async for invoice in server_utils.get_async_service().subscribe_invoices(settle_index):
+                delay = 1
+                if invoice.get("state")=="SETTLED" or invoice.get("settled")==True:
+                    server_utils.mark_invoice_settled(invoice)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            print_exc()
+        print("Invoice subscription closed. Reconnecting in {} seconds.".format(delay))
+        await asyncio.sleep(delay)
+        delay = min(2*delay,RECONNECT_DELAY_MAX)
+
+def start_invoice_listener():
+    """ Starts the invoice listener as a background task on the running event loop """
+    if not ALSATS_INVOICE_LISTENER:
+        return None
+    return asyncio.create_task(listen_for_settled_invoices())
+
+async def stop_invoice_listener(task:asyncio.Task=None):
+    """ Cancels the invoice listener task """
+    if task is None:
+        return
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
@@ -0,0 +1,132 @@
+import filecmp, os, pickle, weakref
+
+class StaleModelError(Exception):
+    """
+    Raised when publishing a learner whose version is older than the registry's latest version,
+    or a different learner under the latest version, i.e. one trained from an outdated copy
+    """
+    pass
+
+def model_version(learner)->int:
+    """ Version of a learner. Bumped every time training changes it """
+    return getattr(learner,'model_version',0)
+
+def bump_model_version(learner)->int:
+    """ Marks a learner as changed by training. Returns its new version """
+    learner.model_version = model_version(learner)+1
+    return learner.model_version
+
+
+class ModelRegistry:
+    """
+    Interface for versioned learner storage shared by the model caches of all workers.
+    Requests for a session should be routed to the same worker (see compute_pool.session_slot),
+    the registry makes a session survive landing on another worker and lets stale copies be detected.
+    """
+
+    def latest_version(self,session_id:str)->int:
+        """ Latest published version of a session's learner, 0 if there is none """
+        raise NotImplementedError
+
+    def load(self,session_id:str):
+        """ Loads the latest published learner of a session. Raises KeyError if there is none """
+        raise NotImplementedError
+
+    def publish(self,session_id:str,learner)->int:
+        """
+        Stores a learner under its model_version. Publishing the latest version again is a no-op
+        if it's the same learner. Raises StaleModelError if a newer version has been published,
+        or a different learner under the same version.
+        """
+        raise NotImplementedError
+
+    def delete(self,session_id:str)->None:
+        """ Removes all versions of a session's learner """
+        raise NotImplementedError
+
+
+class LocalDiskModelRegistry(ModelRegistry):
+    """
+    Registry on a local (or shared network) filesystem: <root>/<session_id>/<version>.pkl.
+    Versions are created with an exclusive hard link, so two workers can't both publish the same version.
+    Only the newest keep_versions versions are kept.
+    A learner republished under the latest version is compared with the stored pickle,
+    unless it's the object this registry last loaded or published for the session.
+    """
+
+    def __init__(self,root:str,keep_versions:int=2):
+        self.root = os.path.expanduser(root)
+        self.keep_versions = keep_versions
+        self._known = {} # session_id -> (version, weak reference to the learner last loaded or published)
+
+    def _remember(self,session_id:str,version:int,learner):
+        try:
+            self._known[session_id] = (version,weakref.ref(learner))
+        except TypeError:
+            self._known.pop(session_id,None)
+
+    def _is_known(self,session_id:str,version:int,learner)->bool:
+        known = self._known.get(session_id)
+        return known is not None and known[0]==version and known[1]() is learner
+
+    def _session_dir(self,session_id:str)->str:
+        return os.path.join(self.root,session_id)
+
+    def _versions(self,session_id:str)->list:
+        try:
+            names = os.listdir(self._session_dir(session_id))
+        except FileNotFoundError:
+            return []
+        return sorted(int(name[:-4]) for name in names if name.endswith('.pkl') and name[:-4].isdigit())
+
+    def latest_version(self,session_id:str)->int:
+        versions = self._versions(session_id)
+        return versions[-1] if versions else 0
+
+    def load(self,session_id:str):
+        version = self.latest_version(session_id)
+        if version==0:
+            raise KeyError(session_id)
+        with open(os.path.join(self._session_dir(session_id),'{:010d}.pkl'.format(version)),'rb') as f:
+            learner = pickle.load(f)
+        learner.model_version = version
+        self._remember(session_id,version,learner)
+        return learner
+
+    def publish(self,session_id:str,learner)->int:
+        version = model_version(learner)
+        latest = self.latest_version(session_id)
+        if version<latest:
+            raise StaleModelError("Session {} learner version {} is older than published version {}".format(session_id,version,latest))
+        if version==latest and self._is_known(session_id,version,learner):
+            return version
+        session_dir = self._session_dir(session_id)
+        os.makedirs(session_dir,exist_ok=True)
+        path = os.path.join(session_dir,'{:010d}.pkl'.format(version))
+        tmp_path = os.path.join(session_dir,'{:010d}.{}.tmp'.format(version,os.getpid()))
+        with open(tmp_path,'wb') as f:
+            pickle.dump(learner,f,protocol=pickle.HIGHEST_PROTOCOL)
+        try:
+            os.link(tmp_path,path)
+        except FileExistsError:
+            # Fine for the same model, e.g. a spilled copy that wasn't trained since it was loaded
+            if not filecmp.cmp(tmp_path,path,shallow=False):
+                raise StaleModelError("Session {} learner version {} was already published by another worker".format(session_id,version))
+            self._remember(session_id,version,learner)
+            return version
+        finally:
+            os.remove(tmp_path)
+        self._remember(session_id,version,learner)
+        for old_version in self._versions(session_id)[:-self.keep_versions]:
+            try:
+                os.remove(os.path.join(session_dir,'{:010d}.pkl'.format(old_version)))
+            except FileNotFoundError:
+                pass
+        return version
+
+    def delete(self,session_id:str)->None:
+        for version in self._versions(session_id):
+            try:
+                os.remove(os.path.join(self._session_dir(session_id),'{:010d}.pkl'.format(version)))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,185 @@
+import hashlib, os, pickle, secrets, tempfile, threading, time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from traceback import print_exc
+from boto3.s3.transfer import TransferConfig
+from dotenv import load_dotenv
+from .model_registry import model_version
+
+load_dotenv('./envvars.env')
+
+ALSATS_DIR = os.environ.get('ALSATS_DIR','~/lightning/alsats')
+ALSATS_MODEL_BUCKET = os.environ.get('ALSATS_MODEL_BUCKET','alsats-models-test')
+# Pickled learners wait here for their upload
+ALSATS_UPLOAD_SPOOL_DIR = os.environ.get('ALSATS_UPLOAD_SPOOL_DIR',ALSATS_DIR+'/server/upload_spool')
+# Uploads running at once in a process, later jobs wait in the queue
+ALSATS_UPLOAD_WORKERS = int(os.environ.get('ALSATS_UPLOAD_WORKERS',2))
+# Parts of one multipart upload sent at once, and the part size
+ALSATS_UPLOAD_CONCURRENCY = int(os.environ.get('ALSATS_UPLOAD_CONCURRENCY',4))
+ALSATS_UPLOAD_PART_BYTES = int(os.environ.get('ALSATS_UPLOAD_PART_BYTES',8<<20))
+# Presigned download URLs are valid this many seconds, and are signed anew this many seconds before they expire
+ALSATS_PRESIGN_EXPIRES = int(os.environ.get('ALSATS_PRESIGN_EXPIRES',3600))
+ALSATS_PRESIGN_REFRESH = int(os.environ.get('ALSATS_PRESIGN_REFRESH',300))
+
+# A job is queued until an upload worker picks it up, then uploading, then done or failed
+JOB_STATUSES = ("queued","uploading","done","failed")
+
+def snapshot_key(sha256:str)->str:
+    """ Content addressed key of a pickled learner """
+    return "models/"+sha256+".pkl"
+
+
+class _HashingWriter:
+    """ File wrapper hashing what is written through it """
+
+    def __init__(self,f):
+        self.f = f
+        self.hash = hashlib.sha256()
+
+    def write(self,data)->int:
+        self.hash.update(data)
+        return self.f.write(data)
+
+
+class UploadQueue:
+    """
+    Uploads pickled learners to object storage in the background, tracked as jobs in the session store,
+    so any uvicorn worker can report a job's status.
+    submit pickles the learner straight into a spool file, so the pickle is never held in memory next to the live learner,
+    and returns at once. At most `workers` spool files are uploaded at a time, each as a multipart upload
+    with up to `concurrency` parts in flight, and removed once uploaded.
+    Snapshots are stored under the sha256 of their pickle, and the store's manifest maps a session's model version
+    to its snapshot: a version is pickled once, and a pickle already uploaded isn't uploaded again.
+    """
+
+    def __init__(self,client,store,bucket:str=ALSATS_MODEL_BUCKET,spool_dir:str=ALSATS_UPLOAD_SPOOL_DIR,\
+                 workers:int=ALSATS_UPLOAD_WORKERS,concurrency:int=ALSATS_UPLOAD_CONCURRENCY,part_bytes:int=ALSATS_UPLOAD_PART_BYTES):
+        self.client = client
+        self.store = store # Callable returning the SessionStore, opened on first use
+        self.bucket = bucket
+        self.spool_dir = os.path.expanduser(spool_dir)
+        self.workers = max(int(workers),1)
+        self.config = TransferConfig(multipart_threshold=part_bytes,multipart_chunksize=part_bytes,max_concurrency=concurrency)
+        self._lock = threading.Lock()
+        self._executor = None
+        self.uploads = 0
+        self.failures = 0
+        self.uploaded_bytes = 0
+        self.unchanged = 0 # Saves of a version already saved or being saved
+        self.deduplicated = 0 # Pickles identical to an uploaded snapshot
+
+    def submit(self,session_id:str,learner)->dict:
+        """
+        Saves the learner's current model version. Returns the job storing it, which is the earlier job
+        if that version is already uploaded or being uploaded, or else a new job that is queued,
+        or done if an identical pickle is already uploaded.
+        Call it from the session's compute worker, so no training runs while the learner is pickled.
+        """
+        store = self.store()
+        version = model_version(learner)
+        snapshot = store.get_snapshot(session_id,version)
+        if snapshot is not None and snapshot["status"] in ("queued","uploading","done"):
+            with self._lock:
+                self.unchanged += 1
+            return store.get_job(snapshot["job_id"])
+        os.makedirs(self.spool_dir,exist_ok=True)
+        fd, path = tempfile.mkstemp(suffix='.pkl',dir=self.spool_dir)
+        try:
+            with os.fdopen(fd,'wb') as f:
+                writer = _HashingWriter(f)
+                pickle.dump(learner,writer,protocol=pickle.HIGHEST_PROTOCOL)
+            sha256 = writer.hash.hexdigest()
+            key = snapshot_key(sha256)
+            stored = store.stored_object(sha256) is not None
+            now = time.time()
+            job = {"job_id":secrets.token_hex(16),"session_id":session_id,"object_key":key,"status":"done" if stored else "queued",\
+                   "nbytes":os.path.getsize(path),"error":None,"created":now,"updated":now}
+            store.insert_job(job)
+            store.put_snapshot(session_id,version,sha256,key,job["job_id"])
+        except Exception:
+            os.remove(path)
+            raise
+        if stored:
+            os.remove(path)
+            with self._lock:
+                self.deduplicated += 1
+            return job
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers,thread_name_prefix="alsats-upload")
+            self._executor.submit(self._upload,job["job_id"],key,path)
+        return job
+
+    def _upload(self,job_id:str,key:str,path:str):
+        store = self.store()
+        try:
+            store.update_job(job_id,status="uploading",updated=time.time())
+            with open(path,'rb') as f:
+                self.client.upload_fileobj(f,self.bucket,key,Config=self.config)
+            nbytes = os.path.getsize(path)
+            store.update_job(job_id,status="done",updated=time.time())
+            with self._lock:
+                self.uploads += 1
+                self.uploaded_bytes += nbytes
+        except Exception as e:
+            print_exc()
+            with self._lock:
+                self.failures += 1
+            try:
+                store.update_job(job_id,status="failed",error=str(e),updated=time.time())
+            except Exception:
+                print_exc()
+        finally:
+            os.remove(path)
+
+    def stats(self)->dict:
+        with self._lock:
+            return {"uploads":self.uploads,"failures":self.failures,"uploaded_bytes":self.uploaded_bytes,\
+                    "unchanged":self.unchanged,"deduplicated":self.deduplicated}
+
+    def shutdown(self,wait:bool=True):
+        """ Stops taking jobs. With wait, returns once the queued uploads are done """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+class PresignedUrls:
+    """
+    Presigned download URLs by key, reused until refresh seconds before they expire.
+    Snapshot keys are content addressed, so a URL serves the same model for as long as it's valid.
+    """
+
+    def __init__(self,client,bucket:str=ALSATS_MODEL_BUCKET,expires:int=ALSATS_PRESIGN_EXPIRES,\
+                 refresh:int=ALSATS_PRESIGN_REFRESH,max_entries:int=4096):
+        self.client = client
+        self.bucket = bucket
+        self.expires = expires
+        self.refresh = min(refresh,expires)
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._urls = OrderedDict() # key -> (url, expiry time)
+        self.hits = 0
+        self.signed = 0
+
+    def url(self,key:str)->str:
+        now = time.time()
+        with self._lock:
+            entry = self._urls.get(key)
+            if entry is not None and now<entry[1]-self.refresh:
+                self._urls.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+        url = self.client.generate_presigned_url("get_object",Params={"Bucket":self.bucket,"Key":key},ExpiresIn=self.expires)
+        with self._lock:
+            self._urls[key] = (url,now+self.expires)
+            self._urls.move_to_end(key)
+            while len(self._urls)>self.max_entries:
+                self._urls.popitem(last=False)
+            self.signed += 1
+        return url
+
+    def stats(self)->dict:
+        with self._lock:
+            return {"cached":len(self._urls),"hits":self.hits,"signed":self.signed}
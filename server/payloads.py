@@ -0,0 +1,151 @@
+import io, json, struct
+import numpy as np
+from pydantic import BaseModel
+
+NPY_CONTENT_TYPE = "application/x-npy"
+ARROW_CONTENT_TYPES = ("application/vnd.apache.arrow.stream","application/vnd.apache.arrow.file")
+MSGPACK_CONTENT_TYPES = ("application/msgpack","application/x-msgpack")
+# Fields holding arrays, in the order .npy bodies fill them
+ARRAY_FIELDS = ("x_train","y_train","x_label","x_pool")
+
+class PayloadError(ValueError):
+    """ Raised for a body that can't be decoded. unsupported is True for an unknown content type """
+    def __init__(self,message:str,unsupported:bool=False):
+        super().__init__(message)
+        self.unsupported = unsupported
+
+def decode_npy(body:bytes)->list:
+    """
+    Decodes one or more concatenated .npy arrays (np.save output) without copying their data.
+    The arrays are read only views into body.
+    """
+    arrays = []
+    offset = 0
+    while offset<len(body):
+        if body[offset:offset+6]!=b"\x93NUMPY":
+            raise PayloadError("Body is not a sequence of .npy arrays")
+        if offset+8>len(body):
+            raise PayloadError(".npy header is truncated")
+        major = body[offset+6]
+        if major not in (1,2,3):
+            raise PayloadError("Unsupported .npy format version {}".format(major))
+        length_end = offset+(10 if major==1 else 12)
+        if length_end>len(body):
+            raise PayloadError(".npy header is truncated")
+        header_end = length_end+struct.unpack("<H" if major==1 else "<I",body[offset+8:length_end])[0]
+        if header_end>len(body):
+            raise PayloadError(".npy header is truncated")
+        header = io.BytesIO(body[offset:header_end])
+        np.lib.format.read_magic(header)
+        try:
+            if major==1:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(header)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(header)
+        except ValueError as e:
+            raise PayloadError("Malformed .npy header: {}".format(e))
+        if dtype.hasobject:
+            raise PayloadError(".npy arrays must not hold Python objects")
+        count = int(np.prod(shape))
+        if header_end+count*dtype.itemsize>len(body):
+            raise PayloadError(".npy array is truncated")
+        array = np.frombuffer(body,dtype=dtype,count=count,offset=header_end)
+        arrays.append(array.reshape(shape,order="F" if fortran_order else "C"))
+        offset = header_end+array.nbytes
+    return arrays
+
+def decode_arrow(body:bytes)->dict:
+    """
+    Decodes an Arrow IPC stream or file into arrays. A "y" (or "y_train") column holds labels,
+    every other column is one feature of x. Unlike .npy and msgpack bodies this copies:
+    the feature columns are stacked into one x array. Needs pyarrow.
+    """
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise PayloadError("Arrow bodies need the pyarrow package",unsupported=True)
+    try:
+        table = pa.ipc.open_stream(pa.py_buffer(body)).read_all()
+    except pa.ArrowInvalid:
+        try:
+            table = pa.ipc.open_file(pa.py_buffer(body)).read_all()
+        except pa.ArrowException as e:
+            raise PayloadError("Body is not an Arrow IPC stream or file: {}".format(e))
+    label_columns = [name for name in table.column_names if name in ("y","y_train")]
+    feature_columns = [name for name in table.column_names if name not in label_columns]
+    if not feature_columns:
+        raise PayloadError("Arrow table has no feature columns besides the labels")
+    arrays = {"x":np.column_stack([table.column(name).to_numpy() for name in feature_columns])}
+    if label_columns:
+        arrays["y"] = table.column(label_columns[0]).to_numpy()
+    return arrays
+
+def decode_msgpack(body:bytes)->dict:
+    """
+    Decodes a msgpack map. Array fields are maps of {"dtype":str,"shape":[...],"data":bytes}
+    and are read with np.frombuffer. Other fields are passed through. Needs msgpack.
+    """
+    try:
+        import msgpack
+    except ImportError:
+        raise PayloadError("msgpack bodies need the msgpack package",unsupported=True)
+    try:
+        fields = msgpack.unpackb(body,raw=False)
+    except Exception as e:
+        raise PayloadError("Malformed msgpack body: {}".format(e))
+    if not isinstance(fields,dict):
+        raise PayloadError("msgpack body must be a map")
+    for name, value in fields.items():
+        if isinstance(value,dict) and "data" in value and "dtype" in value:
+            try:
+                dtype = np.dtype(value["dtype"])
+            except TypeError as e:
+                raise PayloadError("Array {} has an invalid dtype: {}".format(name,e))
+            if dtype.hasobject:
+                raise PayloadError("Arrays must not hold Python objects")
+            try:
+                fields[name] = np.frombuffer(value["data"],dtype=dtype).reshape(value.get("shape",-1))
+            except (ValueError, TypeError) as e:
+                raise PayloadError("Array {} doesn't match its dtype and shape: {}".format(name,e))
+    return fields
+
+def parse_body(model:type,body:bytes,content_type:str=None,query_params:dict=None)->BaseModel:
+    """
+    Builds a request params model (e.g. TrainParams) from a request body.
+    JSON bodies are validated as before. For .npy, Arrow and msgpack bodies the array fields are numpy arrays
+    decoded from the body without per element Python objects (zero copy for .npy and msgpack, see decode_arrow),
+    and scalar fields come from the msgpack map or from the URL query (e.g. ?algorithm=rf). Returns None for an empty body.
+    """
+    if not body:
+        return None
+    content_type = (content_type or "application/json").split(";")[0].strip().lower()
+    if content_type in ("application/json",""):
+        return model.model_validate_json(body)
+    array_fields = [name for name in ARRAY_FIELDS if name in model.model_fields]
+    if content_type==NPY_CONTENT_TYPE:
+        arrays = decode_npy(body)
+        if len(arrays)>len(array_fields):
+            raise PayloadError("Expected at most {} arrays ({}), got {}".format(len(array_fields),", ".join(array_fields),len(arrays)))
+        fields = dict(zip(array_fields,arrays))
+    elif content_type in ARROW_CONTENT_TYPES:
+        arrays = decode_arrow(body)
+        fields = {array_fields[0]:arrays["x"]}
+        if "y" in arrays and len(array_fields)>1:
+            fields[array_fields[1]] = arrays["y"]
+    elif content_type in MSGPACK_CONTENT_TYPES:
+        fields = decode_msgpack(body)
+    else:
+        raise PayloadError("Unsupported content type {}".format(content_type),unsupported=True)
+    scalars = {name:value for name,value in {**(query_params or {}),**fields}.items() if name not in array_fields}
+    if isinstance(scalars.get("params"),str):
+        try:
+            scalars["params"] = json.loads(scalars["params"])
+        except ValueError:
+            raise PayloadError("params must be a JSON object")
+    # Validate the scalar fields, then attach the arrays without converting them to lists
+    params = model.model_validate(scalars)
+    for name in array_fields:
+        if name in fields:
+            value = fields[name]
+            setattr(params,name,value if isinstance(value,np.ndarray) else model.model_validate({name:value}).__dict__[name])
+    return params
@@ -0,0 +1,131 @@
+import os
+import numpy as np
+import scipy.sparse as sp
+from dotenv import load_dotenv
+from sklearn.cluster import KMeans
+from sklearn.metrics import pairwise_distances, pairwise_distances_argmin_min
+from .inference import QUERY_CRITERIA, infer
+
+load_dotenv('./envvars.env')
+
+ALSATS_POOL_CHUNK_ROWS = int(os.environ.get('ALSATS_POOL_CHUNK_ROWS',65536))
+DIVERSITY_MODES = (None,"ranked","cluster")
+# Diverse batches are picked from the SHORTLIST_FACTOR*k most informative rows of the pool
+SHORTLIST_FACTOR = 10
+
+def informativeness(inference:dict,criterion:str="least_confidence")->np.ndarray:
+    """ A criterion's values oriented so that higher is more informative """
+    if criterion not in QUERY_CRITERIA:
+        raise ValueError("Unknown query criterion {}. Use one of {}".format(criterion,sorted(QUERY_CRITERIA)))
+    values = inference[criterion]
+    return values if QUERY_CRITERIA[criterion] else -values
+
+def pool_rows(X_pool,idx)->np.ndarray:
+    """ Rows idx of X_pool, read in ascending order so a memory mapped pool is read sequentially """
+    order = np.argsort(idx)
+    rows = np.asarray(X_pool[idx[order]])
+    return rows[np.argsort(order)]
+
+def _keep_top(idx,scores,m:int,exclude=None)->tuple:
+    if exclude is not None and len(exclude):
+        keep = ~np.isin(idx,exclude)
+        idx, scores = idx[keep], scores[keep]
+    if scores.shape[0]>m:
+        keep = np.argpartition(-scores,m-1)[:m]
+        idx, scores = idx[keep], scores[keep]
+    return idx, scores
+
+def top_uncertain(learner,X_pool,m:int,criterion:str="least_confidence",chunk_size:int=ALSATS_POOL_CHUNK_ROWS,exclude=None)->tuple:
+    """
+    Scores the pool chunk by chunk and keeps a running top m, so memory is bounded by chunk_size+m rows of scores
+    no matter how large the pool is. X_pool can be a memory map. Row indices in exclude are skipped.
+    Returns (indices, scores) sorted from most to least informative.
+    """
+    best_idx = np.empty(0,dtype=np.int64)
+    best_scores = np.empty(0)
+    for start in range(0,X_pool.shape[0],chunk_size):
+        chunk = np.asarray(X_pool[start:start+chunk_size])
+        scores = informativeness(infer(learner,chunk),criterion)
+        idx = np.concatenate((best_idx,np.arange(start,start+chunk.shape[0])))
+        best_idx, best_scores = _keep_top(idx,np.concatenate((best_scores,scores)),m,exclude)
+    order = np.argsort(-best_scores,kind="stable")
+    return best_idx[order], best_scores[order]
+
+def score_pool(learner,X_pool,criterion:str="least_confidence",chunk_size:int=ALSATS_POOL_CHUNK_ROWS)->np.ndarray:
+    """ Informativeness of every row of X_pool as float32, scored chunk by chunk """
+    scores = np.empty(X_pool.shape[0],dtype=np.float32)
+    for start in range(0,X_pool.shape[0],chunk_size):
+        scores[start:start+chunk_size] = informativeness(infer(learner,np.asarray(X_pool[start:start+chunk_size])),criterion)
+    return scores
+
+def ranked_batch(X_candidates,scores,k:int,X_labeled=None,num_unlabeled:int=None)->np.ndarray:
+    """
+    Ranked batch-mode selection (Cardoso et al., as in modAL's uncertainty_batch_sampling).
+    Each pick maximizes alpha*(1-similarity)+(1-alpha)*uncertainty, where similarity is 1/(1+distance)
+    to the closest labeled or already picked row and alpha is the unlabeled share of the data.
+    Returns positions into X_candidates.
+    """
+    X_candidates = np.asarray(X_candidates,dtype=float)
+    num_labeled = 0 if X_labeled is None else X_labeled.shape[0]
+    num_unlabeled = X_candidates.shape[0] if num_unlabeled is None else num_unlabeled
+    alpha = num_unlabeled/(num_unlabeled+num_labeled)
+    uncertainty = (scores-scores.min())/(np.ptp(scores) or 1.0)
+    if num_labeled:
+        # Sessions can store their labeled rows as CSR (see training_buffer), which the distance takes as is
+        X_labeled = X_labeled if sp.issparse(X_labeled) else np.asarray(X_labeled,dtype=float)
+        min_distance = pairwise_distances_argmin_min(X_candidates,X_labeled)[1]
+    else:
+        min_distance = np.full(X_candidates.shape[0],np.inf)
+    picked = []
+    for _ in range(min(k,X_candidates.shape[0])):
+        rank = alpha*(1-1/(1+min_distance))+(1-alpha)*uncertainty
+        rank[picked] = -np.inf
+        pick = int(np.argmax(rank))
+        picked.append(pick)
+        min_distance = np.minimum(min_distance,pairwise_distances(X_candidates,X_candidates[pick:pick+1]).ravel())
+    return np.array(picked,dtype=np.int64)
+
+def cluster_batch(X_candidates,scores,k:int,random_state=0)->np.ndarray:
+    """
+    Clusters the candidates into k groups and picks the most informative row of each.
+    Returns positions into X_candidates, most informative first.
+    """
+    X_candidates = np.asarray(X_candidates,dtype=float)
+    if X_candidates.shape[0]<=k:
+        return np.argsort(-scores,kind="stable")
+    clusters = KMeans(n_clusters=k,n_init=1,random_state=random_state).fit_predict(X_candidates)
+    picked = [np.flatnonzero(clusters==c)[np.argmax(scores[clusters==c])] for c in np.unique(clusters)]
+    return np.array(sorted(picked,key=lambda i: -scores[i]),dtype=np.int64)
+
+def query_pool(learner,X_pool,k:int=1,criterion:str="least_confidence",diversity:str=None,\
+               chunk_size:int=ALSATS_POOL_CHUNK_ROWS,scores=None,exclude=None)->dict:
+    """
+    Returns the k most informative row indices of X_pool and their scores.
+    diversity None ranks rows by the criterion alone. "ranked" and "cluster" pick a diverse batch
+    from the SHORTLIST_FACTOR*k most informative rows, so that k labelers don't all get near duplicates.
+    scores are precomputed informativeness values of every row (see score_pool), exclude are row indices to skip,
+    e.g. rows that are already labeled.
+    """
+    if diversity not in DIVERSITY_MODES:
+        raise ValueError("Unknown diversity mode {}. Use one of {}".format(diversity,DIVERSITY_MODES))
+    if exclude is not None:
+        exclude = np.unique(np.asarray(exclude,dtype=np.int64))
+        exclude = exclude[(exclude>=0)&(exclude<X_pool.shape[0])]
+    num_candidates = X_pool.shape[0]-(0 if exclude is None else len(exclude))
+    k = max(min(int(k),num_candidates),0)
+    if k==0:
+        return {"indices":[],"scores":[]}
+    m = k if diversity is None else min(SHORTLIST_FACTOR*k,num_candidates)
+    if scores is None:
+        idx, scores = top_uncertain(learner,X_pool,m,criterion,chunk_size,exclude)
+    else:
+        idx, scores = _keep_top(np.arange(X_pool.shape[0]),np.asarray(scores,dtype=float),m,exclude)
+        order = np.argsort(-scores,kind="stable")
+        idx, scores = idx[order], scores[order]
+    if diversity=="ranked":
+        picked = ranked_batch(pool_rows(X_pool,idx),scores,k,getattr(learner,'X_training',None),X_pool.shape[0])
+    elif diversity=="cluster":
+        picked = cluster_batch(pool_rows(X_pool,idx),scores,k)
+    else:
+        picked = np.arange(k)
+    return {"indices":idx[picked].tolist(),"scores":scores[picked].tolist()}
@@ -0,0 +1,211 @@
+import copy, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from traceback import print_exc
+import numpy as np
+from sklearn.base import clone
+from .cached_models import models
+from .model_registry import bump_model_version
+
+@dataclass(frozen=True)
+class RetrainPolicy:
+    """
+    When a session's buffered labels are trained on. Any condition that is set triggers a retrain:
+    every buffered labels, interval seconds after the first buffered label,
+    or a mean uncertainty of the buffered labels (under the model that scored them) above uncertainty.
+    """
+    every:int = None
+    interval:float = None
+    uncertainty:float = None
+
+    @classmethod
+    def from_params(cls,params:dict=None)->'RetrainPolicy':
+        """
+        Reads retrain_every, retrain_interval and retrain_uncertainty from TrainParams.params.
+        Returns None if none of them is set, i.e. train immediately.
+        """
+        params = params or {}
+        policy = cls(every=int(params["retrain_every"]) if params.get("retrain_every") else None,
+                     interval=float(params["retrain_interval"]) if params.get("retrain_interval") else None,
+                     uncertainty=float(params["retrain_uncertainty"]) if params.get("retrain_uncertainty") is not None else None)
+        if policy.every is None and policy.interval is None and policy.uncertainty is None:
+            return None
+        return policy
+
+    def due(self,num_buffered:int,age:float,mean_uncertainty:float)->bool:
+        if num_buffered==0:
+            return False
+        return (self.every is not None and num_buffered>=self.every) or \
+               (self.interval is not None and age>=self.interval) or \
+               (self.uncertainty is not None and mean_uncertainty>self.uncertainty)
+
+
+def _fork(learner):
+    """
+    A copy of learner to teach in the background. Only the estimator is copied, cloned unfitted if teach refits it.
+    The training data is shared, growable buffers are forked so the copy's new rows go past the live learner's.
+    The live learner isn't taught while its session's retrain runs, its new samples are buffered.
+    """
+    fork = copy.copy(learner)
+    fork.estimator = copy.deepcopy(learner.estimator) if getattr(learner,'only_new',False) else clone(learner.estimator)
+    for key in ("_X_buffer","_y_buffer"):
+        if learner.__dict__.get(key) is not None:
+            setattr(fork,key,learner.__dict__[key].fork())
+    return fork
+
+class _SessionBuffer:
+    def __init__(self,policy:RetrainPolicy):
+        self.policy = policy
+        self.X = []
+        self.y = []
+        self.uncertainties = []
+        self.first_at = None
+        self.timer = None
+        self.future = None
+
+    def __len__(self)->int:
+        return sum(len(y) for y in self.y)
+
+    def due(self)->bool:
+        age = time.monotonic()-self.first_at if self.first_at is not None else 0.0
+        mean_uncertainty = float(np.mean(self.uncertainties)) if self.uncertainties else 0.0
+        return self.policy.due(len(self),age,mean_uncertainty)
+
+
+class RetrainScheduler:
+    """
+    Buffers labeled samples of sessions with a retrain policy and retrains them in the background.
+    A retrain teaches a copy of the session's learner (see _fork) and then swaps it into the model cache,
+    so label requests keep using the latest completed model while it runs.
+    Buffers live in the process that owns the session (see compute_pool) and are not persisted.
+    """
+
+    def __init__(self,models=models,max_workers:int=1):
+        self.models = models
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._buffers = {} # session_id -> _SessionBuffer
+        self._executor = None
+        self.retrains = 0
+        self.failures = 0
+
+    def buffer(self,session_id:str,policy:RetrainPolicy,X,y,uncertainty=None)->int:
+        """ Adds labeled samples to a session's buffer. Returns the number of samples waiting for a retrain """
+        with self._lock:
+            entry = self._buffers.get(session_id)
+            if entry is None:
+                entry = self._buffers[session_id] = _SessionBuffer(policy)
+            entry.policy = policy
+            entry.X.append(np.asarray(X))
+            entry.y.append(np.asarray(y))
+            if uncertainty is not None:
+                entry.uncertainties.extend(np.ravel(uncertainty).tolist())
+            if entry.first_at is None:
+                entry.first_at = time.monotonic()
+            if entry.due():
+                self._schedule(session_id,entry)
+            else:
+                self._arm_timer(session_id,entry)
+            return len(entry)
+
+    def pending(self,session_id:str)->int:
+        """ Number of buffered samples not yet trained on """
+        with self._lock:
+            entry = self._buffers.get(session_id)
+            return len(entry) if entry is not None else 0
+
+    def idle(self,session_id:str)->bool:
+        """ True if the session has no buffered samples and no retrain running, i.e. its cached learner has seen every sample """
+        with self._lock:
+            entry = self._buffers.get(session_id)
+            return entry is None or (len(entry)==0 and entry.future is None)
+
+    def flush(self,session_id:str):
+        """ Retrains a session on its buffered samples now. Returns the retrain's future, None if nothing is buffered """
+        with self._lock:
+            entry = self._buffers.get(session_id)
+            if entry is None or (len(entry)==0 and entry.future is None):
+                return None
+            if len(entry)>0:
+                self._schedule(session_id,entry)
+            return entry.future
+
+    def wait(self,session_id:str,timeout:float=None)->None:
+        """ Waits for a session's buffered samples to be trained on """
+        while True:
+            with self._lock:
+                entry = self._buffers.get(session_id)
+                future = entry.future if entry is not None else None
+            if future is None:
+                return
+            future.result(timeout)
+
+    def stats(self)->dict:
+        with self._lock:
+            return {"sessions":len(self._buffers),"buffered":sum(len(entry) for entry in self._buffers.values()),\
+                    "retrains":self.retrains,"failures":self.failures}
+
+    def shutdown(self):
+        with self._lock:
+            for entry in self._buffers.values():
+                if entry.timer is not None:
+                    entry.timer.cancel()
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+    def _schedule(self,session_id:str,entry:_SessionBuffer):
+        """ Starts a retrain unless one is running, in which case it picks up the buffer when it's done """
+        if entry.timer is not None:
+            entry.timer.cancel()
+            entry.timer = None
+        if entry.future is not None:
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers,thread_name_prefix="alsats-retrain")
+        entry.future = self._executor.submit(self._retrain,session_id)
+
+    def _arm_timer(self,session_id:str,entry:_SessionBuffer):
+        """ Retrains an interval policy's buffer when its first sample is interval seconds old """
+        if entry.policy.interval is None or entry.timer is not None or entry.future is not None or len(entry)==0:
+            return
+        delay = max(entry.policy.interval-(time.monotonic()-entry.first_at),0.0)
+        entry.timer = threading.Timer(delay,self.flush,args=(session_id,))
+        entry.timer.daemon = True
+        entry.timer.start()
+
+    def _retrain(self,session_id:str):
+        with self._lock:
+            entry = self._buffers[session_id]
+            X, y = entry.X, entry.y
+            entry.X, entry.y, entry.uncertainties, entry.first_at = [], [], [], None
+        failed = False
+        try:
+            learner = _fork(self.models[session_id])
+            learner.teach(np.concatenate(X),np.concatenate(y))
+            bump_model_version(learner)
+            self.models[session_id] = learner
+            self.retrains += 1
+        except Exception:
+            print_exc()
+            failed = True
+            self.failures += 1
+        with self._lock:
+            entry.future = None
+            if failed:
+                # Keep the samples for the next retrain, which the next buffered sample or the timer triggers
+                entry.X, entry.y = X+entry.X, y+entry.y
+                entry.first_at = time.monotonic()
+                self._arm_timer(session_id,entry)
+            elif entry.due():
+                self._schedule(session_id,entry)
+            elif len(entry)==0:
+                del self._buffers[session_id]
+            else:
+                self._arm_timer(session_id,entry)
+
+retrain_scheduler = RetrainScheduler()
+
+def retrain_stats()->dict:
+    """ Counters of this process's retrain scheduler """
+    return retrain_scheduler.stats()
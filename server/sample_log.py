@@ -0,0 +1,324 @@
+import asyncio, io, json, os, pickle, re, struct, threading, zlib
+from concurrent.futures import ThreadPoolExecutor
+from traceback import print_exc
+import numpy as np
+from dotenv import load_dotenv
+from .compute_pool import compute_pool
+from .payloads import PayloadError, decode_npy
+from .training_buffer import fits_uint8
+
+load_dotenv('./envvars.env')
+
+ALSATS_DIR = os.environ.get('ALSATS_DIR','~/lightning/alsats')
+ALSATS_SAMPLE_LOG_DIR = os.environ.get('ALSATS_SAMPLE_LOG_DIR',ALSATS_DIR+'/server/sample_log')
+# "off" disables the log, learners are then only persisted by the model registry and /save
+ALSATS_SAMPLE_LOG = os.environ.get('ALSATS_SAMPLE_LOG','on')
+# A session's log is compacted into a snapshot once it holds this many bytes, which bounds replay time
+ALSATS_SAMPLE_LOG_COMPACT_BYTES = int(os.environ.get('ALSATS_SAMPLE_LOG_COMPACT_BYTES',32<<20))
+# fsync every append. Without it an append survives a server crash but not a power loss
+ALSATS_SAMPLE_LOG_FSYNC = os.environ.get('ALSATS_SAMPLE_LOG_FSYNC','off')=='on'
+
+# Record: header length, body length, crc32 of header and body, then a JSON header and the .npy arrays X and y
+_RECORD = struct.Struct('<III')
+_LOG_NAME = re.compile(r'log-(\d{10})\.bin$')
+_SNAPSHOT_NAME = re.compile(r'snapshot-(\d{10})-(\d{10})\.pkl$')
+
+def compact_array(X)->np.ndarray:
+    """ X in the smallest dtype that holds its values exactly: uint8 for integers from 0 to 255, else float32 if lossless """
+    X = np.asarray(X)
+    if fits_uint8(X):
+        return X.astype(np.uint8)
+    if X.dtype==np.float64 and X.size and np.all(X.astype(np.float32)==X):
+        return X.astype(np.float32)
+    return X
+
+def encode_record(header:dict,X,y)->bytes:
+    body = io.BytesIO()
+    np.save(body,compact_array(X),allow_pickle=False)
+    np.save(body,np.asarray(y),allow_pickle=False)
+    header = json.dumps(header,separators=(',',':')).encode()
+    body = body.getvalue()
+    return _RECORD.pack(len(header),len(body),zlib.crc32(body,zlib.crc32(header)))+header+body
+
+def read_records(path:str):
+    """
+    Yields (header, X, y, end offset) for the complete records of a log file.
+    Stops at the first torn or corrupt record, e.g. one cut short by a crash.
+    """
+    with open(path,'rb') as f:
+        data = f.read()
+    offset = 0
+    while offset+_RECORD.size<=len(data):
+        header_len, body_len, crc = _RECORD.unpack_from(data,offset)
+        start = offset+_RECORD.size
+        end = start+header_len+body_len
+        if end>len(data) or zlib.crc32(data[start+header_len:end],zlib.crc32(data[start:start+header_len]))!=crc:
+            return
+        try:
+            header = json.loads(data[start:start+header_len])
+            X, y = decode_npy(data[start+header_len:end])
+        except (ValueError, PayloadError):
+            return
+        yield header, X, y, end
+        offset = end
+
+
+class _SessionLog:
+    def __init__(self):
+        self.generation = 0 # log file appended to, and the newest snapshot it follows
+        self.version = 0 # model version after the last logged batch
+        self.nbytes = 0 # bytes of the current log
+
+
+class SampleLog:
+    """
+    Append only, per session log of the batches /train accepted, so learners survive a restart.
+    <dir>/<session_id>/log-<g>.bin holds the batches after snapshot-<g>-<version>.pkl, a pickled learner.
+    A learner missing from memory is rebuilt from the newest snapshot and the logs from its generation on (see replay).
+    Once a log holds compact_bytes it is compacted after the /train response (see schedule_compaction): appends move on
+    to the next generation, and its snapshot is written in the background. Older snapshots and logs are only removed after the new snapshot is in place.
+    Sessions are owned by one compute worker (see compute_pool), so a session's log has a single writer.
+    """
+
+    def __init__(self,root:str=ALSATS_SAMPLE_LOG_DIR,compact_bytes:int=ALSATS_SAMPLE_LOG_COMPACT_BYTES,fsync:bool=ALSATS_SAMPLE_LOG_FSYNC):
+        self.root = os.path.expanduser(root)
+        self.compact_bytes = compact_bytes
+        self.fsync = fsync
+        self._lock = threading.RLock()
+        self._sessions = {} # session_id -> _SessionLog
+        self._executor = None
+        self.appends = 0
+        self.replays = 0
+        self.compactions = 0
+
+    def _session_dir(self,session_id:str)->str:
+        return os.path.join(self.root,session_id)
+
+    def _log_path(self,session_id:str,generation:int)->str:
+        return os.path.join(self._session_dir(session_id),'log-{:010d}.bin'.format(generation))
+
+    def _files(self,session_id:str)->tuple:
+        """ ([(generation, path)] of logs, [(generation, version, path)] of snapshots), oldest first """
+        try:
+            names = os.listdir(self._session_dir(session_id))
+        except FileNotFoundError:
+            return [], []
+        logs, snapshots = [], []
+        for name in names:
+            path = os.path.join(self._session_dir(session_id),name)
+            if _LOG_NAME.match(name):
+                logs.append((int(_LOG_NAME.match(name).group(1)),path))
+            elif _SNAPSHOT_NAME.match(name):
+                match = _SNAPSHOT_NAME.match(name)
+                snapshots.append((int(match.group(1)),int(match.group(2)),path))
+        return sorted(logs), sorted(snapshots)
+
+    def _state(self,session_id:str)->_SessionLog:
+        """
+        The session's log state, read from disk the first time this process touches the session.
+        A torn record at the end of the current log is cut off so new records follow the last complete one.
+        """
+        state = self._sessions.get(session_id)
+        if state is None:
+            state = _SessionLog()
+            logs, snapshots = self._files(session_id)
+            if snapshots:
+                state.generation, state.version = snapshots[-1][:2]
+            if logs:
+                state.generation = max(state.generation,logs[-1][0])
+                end = 0
+                for header, X, y, end in read_records(logs[-1][1]):
+                    state.version = header.get("model_version",state.version)
+                with open(logs[-1][1],'r+b') as f:
+                    f.truncate(end)
+                state.nbytes = end
+            self._sessions[session_id] = state
+        return state
+
+    def exists(self,session_id:str)->bool:
+        """ True if the session has logged batches or a snapshot """
+        return os.path.isdir(self._session_dir(session_id))
+
+    def logged_version(self,session_id:str)->int:
+        """ Model version of the session's learner after its last logged batch, 0 if nothing is logged """
+        with self._lock:
+            return self._state(session_id).version
+
+    def append(self,session_id:str,op:str,X,y,algorithm:str=None,params:dict=None,version:int=0,buffered:bool=False)->int:
+        """
+        Appends a batch accepted by /train. op is "init" for the batch a learner was created with, "teach" otherwise.
+        buffered marks a batch waiting for a background retrain, version is then the version it wasn't trained into yet.
+        Returns the size of the session's current log.
+        """
+        record = encode_record({"op":op,"algorithm":algorithm,"params":params,"model_version":version,"buffered":buffered},X,y)
+        with self._lock:
+            state = self._state(session_id)
+            os.makedirs(self._session_dir(session_id),exist_ok=True)
+            with open(self._log_path(session_id,state.generation),'ab') as f:
+                f.write(record)
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            state.nbytes += len(record)
+            state.version = version
+            self.appends += 1
+            return state.nbytes
+
+    def compaction_due(self,session_id:str)->bool:
+        with self._lock:
+            return self._state(session_id).nbytes>=self.compact_bytes
+
+    def compact(self,session_id:str,learner)->bool:
+        """
+        Compacts the session's log if it has grown past compact_bytes. learner must include every logged batch,
+        i.e. no batch may still be waiting for a background retrain. Returns True if a compaction was started.
+        Call it from the session's compute worker, the learner is pickled there so no training runs meanwhile.
+        """
+        with self._lock:
+            state = self._state(session_id)
+            if state.nbytes<self.compact_bytes:
+                return False
+        snapshot = pickle.dumps(learner,protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            generation = state.generation+1
+            state.generation, state.nbytes = generation, 0
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1,thread_name_prefix="alsats-sample-log")
+            self._executor.submit(self._write_snapshot,session_id,generation,state.version,snapshot)
+            return True
+
+    def _write_snapshot(self,session_id:str,generation:int,version:int,snapshot:bytes):
+        path = os.path.join(self._session_dir(session_id),'snapshot-{:010d}-{:010d}.pkl'.format(generation,version))
+        try:
+            with open(path+'.tmp','wb') as f:
+                f.write(snapshot)
+                f.flush()
+                os.fsync(f.fileno())
+            with self._lock:
+                os.replace(path+'.tmp',path)
+                logs, snapshots = self._files(session_id)
+                for old_generation, old_path in logs:
+                    if old_generation<generation:
+                        os.remove(old_path)
+                for old_generation, old_version, old_path in snapshots:
+                    if old_generation<generation:
+                        os.remove(old_path)
+                self.compactions += 1
+        except Exception:
+            # The older snapshot and logs are still complete
+            print_exc()
+
+    def replay(self,session_id:str):
+        """
+        Rebuilds a session's learner from its newest snapshot and the batches logged since.
+        Batches are taught one at a time to incremental learners, other learners are refit once on all of them.
+        The rebuilt learner gets a version newer than the last logged one. Raises KeyError if nothing is logged.
+        """
+        # Imported here since active_learning_utils and retrain_scheduler import the model cache, which uses the log
+        from .active_learning_utils import get_learner
+        from .incremental_learners import IncrementalActiveLearner
+        from .retrain_scheduler import RetrainPolicy
+        with self._lock:
+            state = self._state(session_id)
+            logs, snapshots = self._files(session_id)
+            learner, generation = None, 0
+            if snapshots:
+                generation, version, path = snapshots[-1]
+                with open(path,'rb') as f:
+                    learner = pickle.load(f)
+            records = [record for log_generation, path in logs if log_generation>=generation for record in read_records(path)]
+        if learner is None and not records:
+            raise KeyError(session_id)
+        pending_X, pending_y = [], []
+        for header, X, y, _ in records:
+            if header["op"]=="init" or learner is None:
+                if header["op"]!="init":
+                    raise KeyError("Sample log of session {} doesn't start with its first batch".format(session_id))
+                learner = get_learner(X,y,header["algorithm"],header["params"])
+                learner.retrain_policy = RetrainPolicy.from_params(header["params"])
+                pending_X, pending_y = [], []
+                continue
+            learner.retrain_policy = RetrainPolicy.from_params(header["params"]) or getattr(learner,'retrain_policy',None)
+            if isinstance(learner,IncrementalActiveLearner):
+                learner.teach(X,y)
+            else:
+                pending_X.append(X)
+                pending_y.append(y)
+        if pending_X:
+            learner.teach(np.concatenate(pending_X),np.concatenate(pending_y))
+        learner.model_version = max(state.version,getattr(learner,'model_version',0))+1
+        with self._lock:
+            self.replays += 1
+        return learner
+
+    def buffered(self,session_id:str,version:int)->list:
+        """
+        [(params, X, y)] of the batches logged since the newest snapshot that were buffered for a retrain
+        of a learner at version, i.e. that a learner loaded at that version hasn't trained on.
+        """
+        with self._lock:
+            # Cuts off a torn record before the logs are read
+            self._state(session_id)
+            logs, snapshots = self._files(session_id)
+            generation = snapshots[-1][0] if snapshots else 0
+            return [(header["params"],X,y) for log_generation, path in logs if log_generation>=generation \
+                    for header, X, y, _ in read_records(path) if header.get("buffered") and header["model_version"]==version]
+
+    def delete(self,session_id:str)->None:
+        with self._lock:
+            self._sessions.pop(session_id,None)
+            logs, snapshots = self._files(session_id)
+            for path in [path for _, path in logs]+[path for _, _, path in snapshots]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            try:
+                os.rmdir(self._session_dir(session_id))
+            except OSError:
+                pass
+
+    def stats(self)->dict:
+        with self._lock:
+            return {"sessions":len(self._sessions),"appends":self.appends,"replays":self.replays,"compactions":self.compactions}
+
+    def shutdown(self):
+        """ Waits for snapshots being written """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+sample_log = SampleLog() if ALSATS_SAMPLE_LOG!='off' else None
+
+def compact_session(session_id:str)->bool:
+    """ Compacts the session's log if it's due and the learner has trained on every logged batch. Runs on its compute worker """
+    # Imported here since the model cache and the retrain scheduler use the log
+    from .cached_models import models
+    from .retrain_scheduler import retrain_scheduler
+    if models.sample_log is None or session_id not in models or not retrain_scheduler.idle(session_id):
+        return False
+    return models.sample_log.compact(session_id,models[session_id])
+
+_compactions = set() # Running compaction tasks, referenced until they're done
+
+def schedule_compaction(session_id:str,response_dict:dict)->None:
+    """
+    Queues compact_session behind the session's current request if a /train response asks for it,
+    so the learner is pickled after the response is sent and not during the request. Call it on the event loop.
+    """
+    if not response_dict or not response_dict.pop("compact_sample_log",False):
+        return
+    task = asyncio.get_running_loop().create_task(compute_pool.run(session_id,compact_session,session_id))
+    _compactions.add(task)
+    task.add_done_callback(_compaction_done)
+
+def _compaction_done(task):
+    _compactions.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        print("Sample log compaction failed: {!r}".format(task.exception()))
+
+def sample_log_stats()->dict:
+    """ Counters of this process's sample log """
+    return sample_log.stats() if sample_log is not None else {}
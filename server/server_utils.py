@@ -1,17 +1,19 @@
-import base64, codecs, json, requests, os
+import base64, binascii, codecs, hmac, json, requests, os, ssl, threading
+import httpx
+from requests.adapters import HTTPAdapter
 from json import dumps, loads
 from hashlib import sha256
 from datetime import datetime
 from numpy.random import randint
-from tinydb import TinyDB, Query
-from tinydb.operations import increment
 from traceback import print_exc
 import boto3
-from .cached_models import models
-import pickle
+from .cached_models import models, settled_invoices
+from .compute_pool import compute_pool
+from .model_registry import model_version
+from .model_uploads import UploadQueue, PresignedUrls
+from .session_store import SessionStore, SQLiteSessionStore
+from .system_params import SystemParams, SystemParamsLoader
 
-#from tinydb_constraint import ConstraintTable
-#TinyDB.table_class = ConstraintTable
 import os
 from dotenv import load_dotenv
 
@@ -23,68 +25,118 @@ load_dotenv('./envvars.env')
 ALSATS_DIR = os.environ.get('ALSATS_DIR','~/lightning/alsats')
 ALSATS_AWS_ACCESS_KEY_ID = os.environ.get("ALSATS_AWS_ACCESS_KEY_ID")
 ALSATS_AWS_SECRET_KEY = os.environ.get("ALSATS_AWS_SECRET_KEY")
+ALSATS_LND_POOL_SIZE = int(os.environ.get("ALSATS_LND_POOL_SIZE",10))
+ALSATS_ADMIN_TOKEN = os.environ.get("ALSATS_ADMIN_TOKEN")
 
-session_db = TinyDB(ALSATS_DIR+'/server/session_info.json')
-#session_db.set_schema({'session_id':str,'session_type':str,'payment_request':str,'r_hash':str,'num_iterations':int,'start_time':str,'end_time':str,'completed_iterations':int})
+ALSATS_SESSION_DB = os.environ.get('ALSATS_SESSION_DB',ALSATS_DIR+'/server/session_info.db')
 
 s3_client = boto3.client("s3",aws_access_key_id=ALSATS_AWS_ACCESS_KEY_ID,aws_secret_access_key=ALSATS_AWS_SECRET_KEY)
 
+def saved_snapshot(session_id:str)->dict:
+    """ Manifest entry of the session's current model version, None if that version wasn't saved """
+    return get_session_store().get_snapshot(session_id,model_version(models[session_id]))
+
 def model_exists(session_id:str,preimage:str)->bool:
-    """ Check if model exists in S3 """
-    response = s3_client.list_objects(Bucket="alsats-models-test",Prefix="models/"+session_id+"_"+preimage+".pkl")
-    if "Contents" in response.keys():
-        return True
-    return False
+    """ Check if the session's current model is in S3, from the local manifest """
+    snapshot = saved_snapshot(session_id) if session_id in models.keys() else None
+    return snapshot is not None and snapshot["status"]=="done"
 
 def save_model(session_id:str,preimage:str)->dict:
-    """ Save a model in S3"""
-    # 1. Create a folder corresponding to sesssion_id and preimage if it doesn't exist. 
-    # 2. Pickle model and save to s3.
-
+    """
+    Queues a background upload of the session's model to S3 and returns its "job_id", see job_status.
+    Runs on the session's compute worker, which only pickles the model to a spool file.
+    A model version that was already saved isn't pickled or uploaded again.
+    """
     save_result = {"Status":None}
     
     if session_id in models.keys():
         try:
-            pickled_model = pickle.dumps(models[session_id])
-            s3_client.put_object(Body=pickled_model, Bucket='alsats-models-test', Key="models/"+session_id+"_"+preimage+".pkl")
-            save_result = {"Status": "Success"}
+            job = model_uploads.submit(session_id,models[session_id])
+            save_result = {"Status":"Success" if job["status"]=="done" else "Queued","job_id":job["job_id"]}
         except Exception as e:
-            save_result = {"Status":"Failed: Exception -  "+e}
+            print_exc()
+            save_result = {"Status":"Failed: Exception - "+str(e)}
     else:
         save_result = {"Status":"Failed: Model not yet created"}
     
     return save_result
 
 def download_model(session_id:str,preimage:str)->dict:
-    """ Download model from S3 if it exists """
-    # 1. Check if model has been saved
-    # 2. If not, save model
-    # 3. Once saved, generate presigned URL and return to user
-    download_result = {"Status":"Success"}
-    # If the model doesn't exist on s3 then try saving it first
-    if model_exists(session_id,preimage)==False:
+    """
+    Returns a presigned URL of the session's current model. If that version isn't in S3 yet its upload is queued,
+    or the running upload's job is returned, with Status "Pending". Retry once the job is done.
+    """
+    if session_id not in models.keys():
+        return {"Status":"Failed: Model not yet created"}
+    snapshot = saved_snapshot(session_id)
+    if snapshot is None or snapshot["status"]!="done":
         save_result = save_model(session_id, preimage)
-        download_result["Status"] = save_result["Status"]
-    # Once we try saving it try downloading it
-    if "Success" in download_result["Status"]:
-        download_result["download_payload"] = s3_client.generate_presigned_url("get_object",\
-            Params={"Bucket": "alsats-models-test","Key": "models/"+session_id+"_"+preimage+".pkl"},ExpiresIn=3600)
-    return download_result
+        if save_result["Status"]!="Success":
+            return {"Status":"Pending","job_id":save_result["job_id"]} if save_result["Status"]=="Queued" else save_result
+        snapshot = saved_snapshot(session_id)
+    return {"Status":"Success","download_payload":presigned_urls.url(snapshot["object_key"])}
+
+def job_status(job_id:str)->dict:
+    """ Status of a background job (queued, uploading, done or failed), None if there's no such job """
+    job = get_session_store().get_job(job_id)
+    if job is None:
+        return None
+    return {column:job[column] for column in ('job_id','status','nbytes','error','created','updated')}
+
+def model_upload_stats()->dict:
+    """ Counters of this process's upload queue """
+    return {**model_uploads.stats(),"presigned_urls":presigned_urls.stats()}
 
 
+system_params_loader = SystemParamsLoader(os.path.expanduser(ALSATS_DIR+"/server/system_params.json"))
+
 def get_system_params()->dict:
     
     """ Fetches system parameters as a dictionary"""
 
-    f = open(ALSATS_DIR+"/server/system_params.json","r")
-    system_params = loads(f.read())
-    f.close()
-    return system_params
+    return system_params_loader.get().to_dict()
+
+def get_pricing()->SystemParams:
+
+    """ Returns the cached, immutable system parameters. Reloaded when system_params.json changes """
+
+    return system_params_loader.get()
+
+def reload_system_params()->dict:
+
+    """ Forces a reload of system_params.json """
+
+    return system_params_loader.reload().to_dict()
+
+def is_admin(admin_token:str=None)->bool:
+    """ Checks an admin token against ALSATS_ADMIN_TOKEN. Admin endpoints are disabled when it isn't set """
+    if not ALSATS_ADMIN_TOKEN or admin_token is None:
+        return False
+    return hmac.compare_digest(admin_token.encode(),ALSATS_ADMIN_TOKEN.encode())
+
+_session_store = None
+_session_store_lock = threading.Lock()
+
+def get_session_store()->SessionStore:
+    """
+    Returns the process wide session store.
+    Sessions from the legacy TinyDB session_info.json are imported the first time the store is opened.
+    """
+    global _session_store
+    if _session_store is None:
+        with _session_store_lock:
+            if _session_store is None:
+                store = SQLiteSessionStore(os.path.expanduser(ALSATS_SESSION_DB))
+                store.migrate_from_tinydb(os.path.expanduser(ALSATS_DIR+'/server/session_info.json'),r_hash_hex)
+                _session_store = store
+    return _session_store
+
+model_uploads = UploadQueue(s3_client,get_session_store)
+presigned_urls = PresignedUrls(s3_client)
 
 def get_session_info(session_id:str=None)->dict:
     """ Reads a row corresponding session info from the DB """
-    session = session_db.search(Query().session_id==session_id)
-    return session[0] # should correspond to a single session
+    return get_session_store().get(session_id)
 
 def get_session_id()->str:
     
@@ -98,41 +150,166 @@ def get_continuous_mode_fixed_payment()->int:
     
     """ Returns fixed payment corresponding to continuous mode session"""
     
-    system_params = get_system_params()
-    return system_params["continuous_mode_fixed_payment"]
+    return get_pricing().continuous_mode_fixed_payment
+
+def label_batch_iterations(num_rows:int)->int:
+    """ Returns the number of compute iterations a batch label request of num_rows rows costs """
+    return get_pricing().label_batch_iterations(num_rows)
 
-def update_session(session_id:str=None,success=False)->dict:
-    """ Updates a session and returns the session object """
+def update_session(session_id:str=None,success=False,reserved=False,n:int=1)->dict:
+    """
+    Updates a session by n iterations and returns the session object.
+    If iterations were reserved for the compute, success commits the reservation and failure refunds it.
+    """
     session=None
-    if session_id is not None and success==True:
-        session_db.update(increment('completed_iterations'),Query()['session_id']==session_id)
+    if session_id is not None:
+        if reserved==True:
+            if success==True:
+                commit_iterations(session_id,n)
+            else:
+                refund_iterations(session_id,n)
+        elif success==True:
+            get_session_store().increment_completed(session_id,n)
     session = get_session_info(session_id)
     return session
 
+def reserve_iterations(session_id:str=None,n:int=1)->bool:
+    """ Reserves n compute iterations of a session's quota before compute runs. Returns False if the quota is used up """
+    return get_session_store().reserve(session_id,n)
+
+def commit_iterations(session_id:str=None,n:int=1)->bool:
+    """ Counts n reserved iterations as completed """
+    return get_session_store().commit(session_id,n)
+
+def refund_iterations(session_id:str=None,n:int=1)->bool:
+    """ Returns n reserved iterations to a session's quota """
+    return get_session_store().refund(session_id,n)
+
+async def run_reserved(session_id:str,n:int,fn,*args,**kwargs):
+    """
+    Runs a compute function that commits or refunds the n iterations reserved for it on the session's compute worker.
+    If the worker fails to run it (e.g. it died) the reservation is refunded here, and None is returned.
+    """
+    try:
+        return await compute_pool.run(session_id,fn,*args,**kwargs)
+    except Exception:
+        print_exc()
+        refund_iterations(session_id,n)
+        return None
+
+def r_hash_hex(r_hash:str=None)->str:
+    """
+    Normalizes a payment hash to a hex string.
+    LND's REST API returns base64 encoded r_hash values, older sessions store hex.
+    Returns None if r_hash can't be decoded.
+    """
+    if r_hash is None:
+        return None
+    if len(r_hash)==64:
+        try:
+            return bytes.fromhex(r_hash).hex()
+        except ValueError:
+            pass
+    try:
+        return base64.b64decode(r_hash,validate=True).hex()
+    except (binascii.Error, ValueError):
+        return None
+
+def preimage_payment_hashes(preimage:str=None)->list:
+    """
+    Returns the hex encoded payment hashes a preimage could correspond to.
+    Tries both base64 decoding and hex decoding for preimage.
+    """
+    payment_hashes = []
+    if preimage is None:
+        return payment_hashes
+    try:
+        payment_hashes.append(sha256(base64.b64decode(preimage)).hexdigest())
+    except (binascii.Error, ValueError):
+        pass
+    try:
+        payment_hashes.append(sha256(bytes.fromhex(preimage)).hexdigest())
+    except ValueError:
+        pass
+    return payment_hashes
+
 def is_valid_preimage(preimage:str=None,r_hash:str=None):
     """
     Verifies that the preimage produces a valid r_hash.
     Tries both base64 decoding and hex decoding for preimage.
-    ASsumes that r_hash is hex encoded.
+    r_hash may be hex or base64 encoded.
     """
     if preimage is None or r_hash is None:
         return False
+    return r_hash_hex(r_hash) in preimage_payment_hashes(preimage)
 
-    # Check base64 decoding
-    preimage_bytes_b64 = base64.b64decode(preimage)
-    payhash_bytes_b64 = sha256(preimage_bytes_b64).digest()
-    r_hash_str_b64 = payhash_bytes_b64.hex()
-    if r_hash_str_b64 == r_hash:
+def invoice_settled(r_hash:str=None,preimage:str=None,session_id:str=None)->bool:
+    """
+    Checks that the preimage hashes to r_hash and that the corresponding invoice is settled.
+    The preimage check is local. LND is only asked until it reports the invoice as settled,
+    a settled invoice can never become unsettled so the result is cached from then on.
+    """
+    if not is_valid_preimage(preimage,r_hash):
+        return False
+    payment_hash = r_hash_hex(r_hash)
+    if payment_hash in settled_invoices:
         return True
-    
-    # Check hex decoding
-    preimage_bytes_hex = bytes.fromhex(preimage)
-    payhash_bytes_hex = sha256(preimage_bytes_hex).digest()
-    r_hash_str_hex = payhash_bytes_hex.hex()
-    if r_hash_str_hex == r_hash:
+    return record_settlement(payment_hash,get_service().invoice_settled(payment_hash),session_id)
+
+async def async_invoice_settled(r_hash:str=None,preimage:str=None,session_id:str=None)->bool:
+    """ Same as invoice_settled, but awaits LND instead of blocking the event loop """
+    if not is_valid_preimage(preimage,r_hash):
+        return False
+    payment_hash = r_hash_hex(r_hash)
+    if payment_hash in settled_invoices:
         return True
-    
-    return False
+    return record_settlement(payment_hash,await get_async_service().invoice_settled(payment_hash),session_id)
+
+def session_paid(session:dict,preimage:str=None)->bool:
+    """ Sessions flagged paid by the invoice listener only need the local preimage check """
+    if session.get('paid')==True:
+        return is_valid_preimage(preimage,session['r_hash'])
+    return invoice_settled(session['r_hash'],preimage,session['session_id'])
+
+async def async_session_paid(session:dict,preimage:str=None)->bool:
+    """ Same as session_paid, but awaits LND instead of blocking the event loop """
+    if session.get('paid')==True:
+        return is_valid_preimage(preimage,session['r_hash'])
+    return await async_invoice_settled(session['r_hash'],preimage,session['session_id'])
+
+def record_settlement(payment_hash:str,settled:bool,session_id:str=None)->bool:
+    """ Caches a settled payment hash and flags its session as paid. Returns settled """
+    if settled:
+        settled_invoices.add(payment_hash)
+        if session_id is not None:
+            mark_session_paid(session_id,payment_hash)
+    return settled
+
+def mark_session_paid(session_id:str=None,payment_hash:str=None)->int:
+    """
+    Flags the session paying for payment_hash as paid.
+    Sessions are matched by session ID (the invoice memo) and payment hash, falling back to payment hash alone.
+    Returns the number of sessions updated.
+    """
+    return get_session_store().mark_paid(session_id,payment_hash)
+
+def mark_invoice_settled(invoice:dict)->int:
+    """ Handles a settled invoice from LND's invoice subscription """
+    payment_hash = r_hash_hex(invoice.get('r_hash'))
+    if payment_hash is not None:
+        settled_invoices.add(payment_hash)
+    updated = mark_session_paid(invoice.get('memo'),payment_hash)
+    if invoice.get('settle_index') is not None:
+        save_settle_index(int(invoice['settle_index']))
+    return updated
+
+def get_settle_index()->int:
+    """ Returns the settle index of the last settled invoice seen on LND's invoice subscription """
+    return get_session_store().get_meta('settle_index',0)
+
+def save_settle_index(settle_index:int):
+    """ Saves the settle index of the last settled invoice, so a resubscription resumes from it """
+    get_session_store().advance_meta('settle_index',settle_index)
     
 
 def save_session_info(session_id:str=None,\
@@ -142,10 +319,19 @@ def save_session_info(session_id:str=None,\
                         num_iterations:int=1,\
                         start_time:str=None,\
                         end_time:str=None,\
-                        completed_iterations:int=0):
-    """ Save a session into DB """
+                        completed_iterations:int=0,\
+                        algorithm:str=None):
+    """ Save a session into DB. algorithm is the one its iterations were priced for, None for the default price """
     # TODO: Create session info object and save from there
-    session_db.insert({'session_id':session_id,'session_type':session_type,'payment_request':payment_request,'r_hash':r_hash,'num_iterations':num_iterations,'start_time':start_time,'end_time':end_time,'completed_iterations':completed_iterations})
+    get_session_store().insert({'session_id':session_id,'session_type':session_type,'payment_request':payment_request,'r_hash':r_hash,'payment_hash':r_hash_hex(r_hash),'num_iterations':num_iterations,'start_time':start_time,'end_time':end_time,'completed_iterations':completed_iterations,'algorithm':algorithm})
+
+def algorithm_paid(session_id:str,algorithm:str)->bool:
+    """ True if a session's iterations were priced at least as high as an iteration of algorithm """
+    session = get_session_info(session_id)
+    if session is None:
+        return False
+    pricing = get_pricing()
+    return pricing.iteration_payment(algorithm)<=pricing.iteration_payment(session.get('algorithm'))
 
 
 def session_validity_info(session_id:str=None,preimage:str=None)->dict:
@@ -157,91 +343,172 @@ def session_validity_info(session_id:str=None,preimage:str=None)->dict:
         4. Invoice preimage corresponds to a valid payment hash for that session ID
         5. The number of remaining iterations is not zero
     """
-    session_validity_info={"valid_session": False, "completed_iterations" : -1}
-    service = Service()
-    # Condition 3
+    session_validity_info, session = lookup_session_validity(session_id)
     try:
-        session = session_db.search(Query().session_id==session_id)
-        if session and type(session)==list:
-            session = session[0] 
-            session_validity_info['completed_iterations'] = session['completed_iterations']
-            # Condition 4
-            #if is_valid_preimage(preimage,session["r_hash"]):
-            if service.invoice_paid(preimage)==True or service.invoice_paid_hex_preim(preimage)==True:
-                remaining_iterations = int(session['num_iterations']-session['completed_iterations'])
-                # Condition 5
-                if remaining_iterations >= 0:
-                    session_validity_info['valid_session'] = True
+        # Condition 4
+        if session and session_paid(session,preimage):
+            session_validity_info['valid_session'] = has_remaining_iterations(session)
     except Exception:
         print_exc()
     print(session_validity_info)    
     return session_validity_info
+
+async def async_session_validity_info(session_id:str=None,preimage:str=None)->dict:
+    """ Same as session_validity_info, but awaits LND instead of blocking the event loop """
+    session_validity_info, session = lookup_session_validity(session_id)
+    try:
+        # Condition 4
+        if session and await async_session_paid(session,preimage):
+            session_validity_info['valid_session'] = has_remaining_iterations(session)
+    except Exception:
+        print_exc()
+    print(session_validity_info)    
+    return session_validity_info
+
+def lookup_session_validity(session_id:str=None)->tuple:
+    """
+    Reads a session for validity checks (Condition 3).
+    Returns an invalid session validity info dict filled with completed iterations, and the session or None.
+    """
+    session_validity_info={"valid_session": False, "completed_iterations" : -1}
+    session = None
+    try:
+        session = get_session_info(session_id)
+        if session:
+            session_validity_info['completed_iterations'] = session['completed_iterations']
+    except Exception:
+        print_exc()
+    return session_validity_info, session
+
+def has_remaining_iterations(session:dict)->bool:
+    """ Condition 5 of session validity """
+    remaining_iterations = int(session['num_iterations']-session['completed_iterations'])
+    return remaining_iterations > 0
     
 def initialize_continuous_mode()->dict:
     
     """ Initializes a fixed price (100 sats) continuous mode session """
     
     continuous_mode_dict = {}
-    service = Service()
     session_id = get_session_id()
     session_type = "continuous"
     try:
         # Fetch payment required per continuous mode session and create invoice with session id as memo
-        invoice_dict = service.create_invoice(sats=get_continuous_mode_fixed_payment(),memo=session_id)
-        
-        # TODO: Check if invoice_dict is empty. Raise exception.
-
-        # Fetch payment request that needs to be sent back in returned dict. Also fetch r_hash.
-        payment_request = invoice_dict['payment_request']
-        r_hash = invoice_dict['r_hash'] 
-        start_time=datetime.now().isoformat()
-        # Save session info (session_id-->payment_request,r_hash,n_iterations,start_time,proj_end_time) in database
-        save_session_info(session_id,session_type,payment_request,r_hash,start_time=start_time)
-        # Return response dict 
-        continuous_mode_dict = {"session_id":session_id,"payment_request":payment_request, "start_time":start_time}
+        invoice_dict = get_service().create_invoice(sats=get_continuous_mode_fixed_payment(),memo=session_id)
+        continuous_mode_dict = save_invoiced_session(session_id,session_type,invoice_dict)
     except Exception as e:
         print(e)
     
     return continuous_mode_dict
 
-def initialize_iterations_mode(num_iterations:int=1)->dict:
+def initialize_iterations_mode(num_iterations:int=1,algorithm:str=None)->dict:
     
-    """ Initializes a session for a fixed number of AL iterations. Payment per iteration is fixed. """
+    """ Initializes a session for a fixed number of AL iterations. Payment per iteration is fixed, optionally per algorithm. """
     
     iterations_mode_dict = {}
-    service = Service()
     session_id = get_session_id()
     session_type = "iterations"
     try:
-        # payment = (fixed continuous mode payment * num_iterations) and create invoice with session id as memo
-        invoice_dict = service.create_invoice(sats=num_iterations*get_continuous_mode_fixed_payment(),memo=session_id)
-        
-        # TODO: Check if invoice_dict is empty. Raise exception.
-
-        # Fetch payment request that needs to be sent back in returned dict. Also fetch r_hash.
-        payment_request = invoice_dict['payment_request']
-        r_hash = invoice_dict['r_hash'] 
-        start_time=datetime.now().isoformat()
-        # Save session info (session_id-->payment_request,r_hash,n_iterations,start_time,proj_end_time) in database
-        save_session_info(session_id,session_type,payment_request,r_hash,num_iterations,start_time=start_time)
-        # Return response dict 
-        iterations_mode_dict = {"session_id":session_id,"payment_request":payment_request,"start_time":start_time}
+        # payment = (fixed per iteration payment * num_iterations) and create invoice with session id as memo
+        invoice_dict = get_service().create_invoice(sats=num_iterations*get_pricing().iteration_payment(algorithm),memo=session_id)
+        iterations_mode_dict = save_invoiced_session(session_id,session_type,invoice_dict,num_iterations,algorithm)
+    except Exception as e:
+        print_exc()
+    
+    return iterations_mode_dict
+
+async def async_initialize_iterations_mode(num_iterations:int=1,algorithm:str=None)->dict:
+    
+    """ Same as initialize_iterations_mode, but awaits LND instead of blocking the event loop """
+    
+    iterations_mode_dict = {}
+    session_id = get_session_id()
+    session_type = "iterations"
+    try:
+        invoice_dict = await get_async_service().create_invoice(sats=num_iterations*get_pricing().iteration_payment(algorithm),memo=session_id)
+        iterations_mode_dict = save_invoiced_session(session_id,session_type,invoice_dict,num_iterations,algorithm)
     except Exception as e:
         print_exc()
     
     return iterations_mode_dict
 
+def save_invoiced_session(session_id:str,session_type:str,invoice_dict:dict,num_iterations:int=1,algorithm:str=None)->dict:
+
+    """ Saves a session for a freshly created invoice and returns the response dict for the customer """
+
+    # TODO: Check if invoice_dict is empty. Raise exception.
+
+    # Fetch payment request that needs to be sent back in returned dict. Also fetch r_hash.
+    payment_request = invoice_dict['payment_request']
+    r_hash = invoice_dict['r_hash'] 
+    start_time=datetime.now().isoformat()
+    # Save session info (session_id-->payment_request,r_hash,n_iterations,start_time,proj_end_time) in database
+    save_session_info(session_id,session_type,payment_request,r_hash,num_iterations,start_time=start_time,algorithm=algorithm)
+    # Return response dict 
+    return {"session_id":session_id,"payment_request":payment_request,"start_time":start_time}
+
+
+_service = None
+_async_service = None
+_service_lock = threading.Lock()
+
+def get_service()->'Service':
+    """ Returns the process wide LND client. Connections to LND are pooled and kept alive. """
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = Service()
+    return _service
+
+def get_async_service()->'AsyncService':
+    """ Returns the process wide async LND client for use inside the FastAPI event loop """
+    global _async_service
+    if _async_service is None:
+        _async_service = AsyncService()
+    return _async_service
+
+async def close_async_service():
+    """ Closes the async LND client's connection pool """
+    global _async_service
+    if _async_service is not None:
+        await _async_service.aclose()
+        _async_service = None
+
+
+def read_lnd_credentials()->dict:
+    """ Reads LND connection settings from the environment and the macaroon from disk """
+    lnd_port = os.environ['SERVICE_LND_PORT']
+    macaroon_path = os.environ['SERVICE_MACAROON_PATH']
+    return {"lnd_dir": os.environ['SERVICE_LND_DIR'],
+            "tls_cert": os.environ['SERVICE_LND_CERT'],
+            "lnd_port": lnd_port,
+            "macaroon_path": macaroon_path,
+            "lnd_base_url": "https://localhost:"+lnd_port+"/",
+            "macaroon": codecs.encode(open(macaroon_path, 'rb').read(), 'hex')}
+
 
 class Service:
     def __init__(self):
-        self.lnd_dir = os.environ['SERVICE_LND_DIR']
-        self.tls_cert = os.environ['SERVICE_LND_CERT']
-        self.lnd_port = os.environ['SERVICE_LND_PORT']
-        self.macaroon_path = os.environ['SERVICE_MACAROON_PATH']
-        self.lnd_base_url = "https://localhost:"+self.lnd_port+"/"
-        self.macaroon = codecs.encode(open(self.macaroon_path, 'rb').read(), 'hex')
+        credentials = read_lnd_credentials()
+        self.lnd_dir = credentials['lnd_dir']
+        self.tls_cert = credentials['tls_cert']
+        self.lnd_port = credentials['lnd_port']
+        self.macaroon_path = credentials['macaroon_path']
+        self.lnd_base_url = credentials['lnd_base_url']
+        self.macaroon = credentials['macaroon']
         self.headers={'Grpc-Metadata-macaroon': self.macaroon}
-        self.balance = self.get_wallet_balance()
+        # Keep-alive connection pool shared by all requests to LND
+        self.session = requests.Session()
+        self.session.mount("https://",HTTPAdapter(pool_connections=1,pool_maxsize=ALSATS_LND_POOL_SIZE))
+        self._balance = None
+
+    @property
+    def balance(self):
+        """ Wallet balance, fetched from LND on first use """
+        if self._balance is None:
+            self._balance = self.get_wallet_balance()
+        return self._balance
     
 
     def create_invoice(self,sats:int,memo:str=None):
@@ -251,7 +518,7 @@ class Service:
         invoice_dict={}
         api_endpoint = self.lnd_base_url+'v1/invoices'
         data = dumps({"value":sats,"memo":memo})
-        r = requests.post(api_endpoint,headers=self.headers,verify=self.tls_cert,data=data)
+        r = self.session.post(api_endpoint,headers=self.headers,verify=self.tls_cert,data=data)
         if r.status_code==200:
             invoice_dict=r.json()
         else:
@@ -263,7 +530,7 @@ class Service:
         """ Decode invoice to find details of payment """
         payreq_dict={}
         api_endpoint = self.lnd_base_url+'v1/payreq/'+payment_request
-        r =  requests.get(api_endpoint,headers=self.headers,verify = self.tls_cert)
+        r =  self.session.get(api_endpoint,headers=self.headers,verify = self.tls_cert)
         if r.status_code==200:
             payreq_dict=r.json()
         else:
@@ -271,6 +538,21 @@ class Service:
             print(r.text)
         return payreq_dict
          
+    def invoice_settled(self,r_hash_str:str)->bool:
+
+        """ Checks if the invoice with a hex encoded payment hash was settled """
+
+        paid = False
+        api_endpoint = self.lnd_base_url+'v1/invoice/'+r_hash_str
+        r =  self.session.get(api_endpoint,headers=self.headers,verify = self.tls_cert)
+        if r.status_code==200:
+            payreq_dict=r.json()
+            if payreq_dict['settled']==True:
+                paid = True
+        else:
+            print("Unable to locate invoice {}. Status Code {} returned.".format(r_hash_str,r.status_code))
+        return paid
+
     def invoice_paid(self,preimage:str)->bool:
         
         """ Checks if invoice was paid. PreImage is a Base64 encoded string"""
@@ -280,19 +562,9 @@ class Service:
         #3. Use payment hash encoded string to lookup the right invoice
         #4. Check if invoice is settled 
         
-        paid = False
         preimage_bytes= base64.b64decode(preimage)
         payhash_bytes = sha256(preimage_bytes).digest()
-        r_hash_str = payhash_bytes.hex()
-        api_endpoint = self.lnd_base_url+'v1/invoice/'+r_hash_str
-        r =  requests.get(api_endpoint,headers=self.headers,verify = self.tls_cert)
-        if r.status_code==200:
-            payreq_dict=r.json()
-            if payreq_dict['settled']==True:
-                paid = True
-        else:
-            print("Unable to locate invoice using non-hex preimage. Status Code {} returned.".format(r.status_code))
-        return paid
+        return self.invoice_settled(payhash_bytes.hex())
 
     def invoice_paid_hex_preim(self,preimage:str)->bool:
         
@@ -302,27 +574,16 @@ class Service:
         #3. Use payment hash encoded string to lookup the right invoice
         #4. Check if invoice is settled 
         
-        paid = False
         preimage_bytes = bytes.fromhex(preimage)
         payhash_bytes = sha256(preimage_bytes).digest()
-        r_hash_str = payhash_bytes.hex()
-        api_endpoint = self.lnd_base_url+'v1/invoice/'+r_hash_str
-        r =  requests.get(api_endpoint,headers=self.headers,verify = self.tls_cert)
-        if r.status_code==200:
-            payreq_dict=r.json()
-            if payreq_dict['settled']==True:
-                paid = True
-        else:
-            print("Status Code {} returned.".format(r.status_code))
-            print(r.text)
-        return paid       
+        return self.invoice_settled(payhash_bytes.hex())
 
     def get_wallet_balance(self):
         
         """ Compute Service Wallet Balance in Satoshis """
         
         api_endpoint = self.lnd_base_url+'v1/balance/blockchain'
-        r =  requests.get(api_endpoint,headers=self.headers,verify = self.tls_cert)
+        r =  self.session.get(api_endpoint,headers=self.headers,verify = self.tls_cert)
         if r.status_code==200:
             response_dict = r.json()
             try:
@@ -349,7 +610,7 @@ class Service:
         """ Compute net local balance over all incoming channels """
         total_balance=None
         api_endpoint = self.lnd_base_url+'v1/balance/channels'
-        r =  requests.get(api_endpoint,headers=self.headers,verify = self.tls_cert)
+        r =  self.session.get(api_endpoint,headers=self.headers,verify = self.tls_cert)
         if r.status_code==200:
             response_dict = r.json()
             try:
@@ -369,7 +630,7 @@ class Service:
         """ Compute net local balance over all outgoing channels """
         total_balance=None
         api_endpoint = self.lnd_base_url+'v1/balance/channels'
-        r =  requests.get(api_endpoint,headers=self.headers,verify = self.tls_cert)
+        r =  self.session.get(api_endpoint,headers=self.headers,verify = self.tls_cert)
         if r.status_code==200:
             response_dict = r.json()
             try:
@@ -389,4 +650,58 @@ class Service:
         
         """ Set a threshold for payment of invoices. Amounts above this threshold are not paid """
         
-        return None
\ No newline at end of file
+        return None
+
+
+class AsyncService:
+    """ Async LND client, awaited by the FastAPI handlers so LND round trips don't block the event loop """
+    def __init__(self):
+        credentials = read_lnd_credentials()
+        self.tls_cert = credentials['tls_cert']
+        self.lnd_base_url = credentials['lnd_base_url']
+        self.headers={'Grpc-Metadata-macaroon': credentials['macaroon'].decode()}
+        self.client = httpx.AsyncClient(base_url=self.lnd_base_url,headers=self.headers,\
+            verify=ssl.create_default_context(cafile=self.tls_cert),\
+            limits=httpx.Limits(max_keepalive_connections=ALSATS_LND_POOL_SIZE),timeout=None)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def create_invoice(self,sats:int,memo:str=None):
+        
+        """ Create Invoice for service """
+        
+        invoice_dict={}
+        r = await self.client.post('v1/invoices',content=dumps({"value":sats,"memo":memo}))
+        if r.status_code==200:
+            invoice_dict=r.json()
+        else:
+            print("Status Code {} returned.".format(r.status_code))
+            print(r.text)
+        return invoice_dict
+
+    async def invoice_settled(self,r_hash_str:str)->bool:
+
+        """ Checks if the invoice with a hex encoded payment hash was settled """
+
+        paid = False
+        r = await self.client.get('v1/invoice/'+r_hash_str)
+        if r.status_code==200:
+            if r.json()['settled']==True:
+                paid = True
+        else:
+            print("Unable to locate invoice {}. Status Code {} returned.".format(r_hash_str,r.status_code))
+        return paid
+
+    async def subscribe_invoices(self,settle_index:int=0):
+
+        """ Yields invoices from LND's invoice subscription, starting after settle_index """
+
+        params = {"settle_index":settle_index} if settle_index else {}
+        async with self.client.stream("GET",'v1/invoices/subscribe',params=params) as r:
+            if r.status_code!=200:
+                print("Status Code {} returned.".format(r.status_code))
+                return
+            async for line in r.aiter_lines():
+                if line.strip():
+                    yield loads(line).get("result",{})
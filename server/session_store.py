@@ -0,0 +1,265 @@
+import json, os, sqlite3, threading
+
+SESSION_COLUMNS = ('session_id','session_type','payment_request','r_hash','payment_hash','num_iterations',\
+                   'start_time','end_time','completed_iterations','reserved_iterations','paid','algorithm')
+INSERT_COLUMNS = "({}) VALUES ({})".format(",".join(SESSION_COLUMNS),",".join("?"*len(SESSION_COLUMNS)))
+JOB_COLUMNS = ('job_id','session_id','object_key','status','nbytes','error','created','updated')
+
+class SessionStore:
+    """
+    Interface for session storage backends.
+    Sessions are dicts with the fields in SESSION_COLUMNS. payment_hash is the hex encoded r_hash.
+    """
+
+    def insert(self,session:dict)->None:
+        """ Saves a new session """
+        raise NotImplementedError
+
+    def get(self,session_id:str)->dict:
+        """ Returns the session with session_id or None """
+        raise NotImplementedError
+
+    def increment_completed(self,session_id:str,n:int=1)->bool:
+        """ Atomically adds n to a session's completed iterations. Returns False if the session doesn't exist """
+        raise NotImplementedError
+
+    def reserve(self,session_id:str,n:int=1)->bool:
+        """
+        Atomically reserves n iterations of a session's quota before compute runs.
+        Succeeds only while the session has iterations remaining, counting iterations already reserved.
+        """
+        raise NotImplementedError
+
+    def commit(self,session_id:str,n:int=1)->bool:
+        """ Turns n reserved iterations into completed iterations after compute succeeded """
+        raise NotImplementedError
+
+    def refund(self,session_id:str,n:int=1)->bool:
+        """ Releases n reserved iterations after compute failed """
+        raise NotImplementedError
+
+    def mark_paid(self,session_id:str=None,payment_hash:str=None)->int:
+        """
+        Flags the session paying for payment_hash as paid. Matches on session ID and payment hash,
+        falling back to payment hash alone. Returns the number of sessions updated.
+        """
+        raise NotImplementedError
+
+    def get_meta(self,name:str,default:int=None)->int:
+        """ Returns a server wide integer value, e.g. the last invoice settle index """
+        raise NotImplementedError
+
+    def advance_meta(self,name:str,value:int)->None:
+        """ Atomically raises a server wide integer value to value, never lowers it """
+        raise NotImplementedError
+
+    def insert_job(self,job:dict)->None:
+        """ Saves a new background job, a dict with the fields in JOB_COLUMNS """
+        raise NotImplementedError
+
+    def update_job(self,job_id:str,**fields)->bool:
+        """ Updates fields of a job. Returns False if the job doesn't exist """
+        raise NotImplementedError
+
+    def get_job(self,job_id:str)->dict:
+        """ Returns the job with job_id or None """
+        raise NotImplementedError
+
+    def put_snapshot(self,session_id:str,model_version:int,sha256:str,object_key:str,job_id:str)->None:
+        """ Records in the manifest that a session's model at model_version is stored under object_key by job_id """
+        raise NotImplementedError
+
+    def get_snapshot(self,session_id:str,model_version:int)->dict:
+        """ Returns the manifest entry of a session's model at model_version, with its job's status, or None """
+        raise NotImplementedError
+
+    def stored_object(self,sha256:str)->str:
+        """ Returns the key of an uploaded object with content hash sha256, or None """
+        raise NotImplementedError
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Session store backed by SQLite in WAL mode.
+    Lookups use the session_id primary key, counters are updated in place with single statements,
+    and every thread/process gets its own connection, so it is safe across uvicorn workers.
+    """
+
+    def __init__(self,path:str):
+        self.path = path
+        self._local = threading.local()
+        self._create_schema()
+
+    def _connection(self)->sqlite3.Connection:
+        """ Per thread connection, reopened after a fork """
+        connection = getattr(self._local,'connection',None)
+        if connection is None or self._local.pid!=os.getpid():
+            connection = sqlite3.connect(self.path,timeout=30,isolation_level=None,check_same_thread=False)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _create_schema(self):
+        connection = self._connection()
+        connection.execute("""CREATE TABLE IF NOT EXISTS sessions (
+                                session_id TEXT PRIMARY KEY,
+                                session_type TEXT,
+                                payment_request TEXT,
+                                r_hash TEXT,
+                                payment_hash TEXT,
+                                num_iterations INTEGER NOT NULL DEFAULT 1,
+                                start_time TEXT,
+                                end_time TEXT,
+                                completed_iterations INTEGER NOT NULL DEFAULT 0,
+                                reserved_iterations INTEGER NOT NULL DEFAULT 0,
+                                paid INTEGER NOT NULL DEFAULT 0,
+                                algorithm TEXT)""")
+        columns = [row['name'] for row in connection.execute("PRAGMA table_info(sessions)")]
+        if 'reserved_iterations' not in columns:
+            connection.execute("ALTER TABLE sessions ADD COLUMN reserved_iterations INTEGER NOT NULL DEFAULT 0")
+        if 'algorithm' not in columns:
+            connection.execute("ALTER TABLE sessions ADD COLUMN algorithm TEXT")
+        connection.execute("CREATE INDEX IF NOT EXISTS sessions_payment_hash ON sessions (payment_hash)")
+        connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+        connection.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                                job_id TEXT PRIMARY KEY,
+                                session_id TEXT,
+                                object_key TEXT,
+                                status TEXT NOT NULL,
+                                nbytes INTEGER,
+                                error TEXT,
+                                created REAL,
+                                updated REAL)""")
+        connection.execute("CREATE INDEX IF NOT EXISTS jobs_object_key ON jobs (object_key)")
+        connection.execute("""CREATE TABLE IF NOT EXISTS snapshots (
+                                session_id TEXT NOT NULL,
+                                model_version INTEGER NOT NULL,
+                                sha256 TEXT NOT NULL,
+                                object_key TEXT NOT NULL,
+                                job_id TEXT,
+                                PRIMARY KEY (session_id, model_version))""")
+        connection.execute("CREATE INDEX IF NOT EXISTS snapshots_sha256 ON snapshots (sha256)")
+
+    def _row_to_session(self,row:sqlite3.Row)->dict:
+        if row is None:
+            return None
+        session = dict(row)
+        session['paid'] = bool(session['paid'])
+        return session
+
+    def _session_values(self,session:dict)->list:
+        values = [session.get(column) for column in SESSION_COLUMNS]
+        values[SESSION_COLUMNS.index('completed_iterations')] = session.get('completed_iterations') or 0
+        values[SESSION_COLUMNS.index('reserved_iterations')] = session.get('reserved_iterations') or 0
+        values[SESSION_COLUMNS.index('paid')] = int(bool(session.get('paid')))
+        return values
+
+    def insert(self,session:dict)->None:
+        self._connection().execute("INSERT INTO sessions "+INSERT_COLUMNS,self._session_values(session))
+
+    def get(self,session_id:str)->dict:
+        row = self._connection().execute("SELECT * FROM sessions WHERE session_id=?",(session_id,)).fetchone()
+        return self._row_to_session(row)
+
+    def increment_completed(self,session_id:str,n:int=1)->bool:
+        cursor = self._connection().execute("UPDATE sessions SET completed_iterations=completed_iterations+? WHERE session_id=?",(n,session_id))
+        return cursor.rowcount==1
+
+    def reserve(self,session_id:str,n:int=1)->bool:
+        # Never more than num_iterations completed and reserved, evaluated inside one UPDATE
+        cursor = self._connection().execute("""UPDATE sessions SET reserved_iterations=reserved_iterations+?
+                                               WHERE session_id=? AND completed_iterations+reserved_iterations+?<=num_iterations""",(n,session_id,n))
+        return cursor.rowcount==1
+
+    def commit(self,session_id:str,n:int=1)->bool:
+        cursor = self._connection().execute("""UPDATE sessions SET reserved_iterations=reserved_iterations-?,completed_iterations=completed_iterations+?
+                                               WHERE session_id=? AND reserved_iterations>=?""",(n,n,session_id,n))
+        return cursor.rowcount==1
+
+    def refund(self,session_id:str,n:int=1)->bool:
+        cursor = self._connection().execute("""UPDATE sessions SET reserved_iterations=reserved_iterations-?
+                                               WHERE session_id=? AND reserved_iterations>=?""",(n,session_id,n))
+        return cursor.rowcount==1
+
+    def mark_paid(self,session_id:str=None,payment_hash:str=None)->int:
+        if payment_hash is None:
+            return 0
+        connection = self._connection()
+        updated = 0
+        if session_id:
+            updated = connection.execute("UPDATE sessions SET paid=1 WHERE session_id=? AND payment_hash=?",(session_id,payment_hash)).rowcount
+        if not updated:
+            updated = connection.execute("UPDATE sessions SET paid=1 WHERE payment_hash=?",(payment_hash,)).rowcount
+        return updated
+
+    def get_meta(self,name:str,default:int=None)->int:
+        row = self._connection().execute("SELECT value FROM meta WHERE name=?",(name,)).fetchone()
+        return default if row is None else row['value']
+
+    def advance_meta(self,name:str,value:int)->None:
+        self._connection().execute("""INSERT INTO meta (name,value) VALUES (?,?)
+                                      ON CONFLICT(name) DO UPDATE SET value=max(value,excluded.value)""",(name,value))
+
+    def insert_job(self,job:dict)->None:
+        self._connection().execute("INSERT INTO jobs ({}) VALUES ({})".format(",".join(JOB_COLUMNS),",".join("?"*len(JOB_COLUMNS))),\
+                                   [job.get(column) for column in JOB_COLUMNS])
+
+    def update_job(self,job_id:str,**fields)->bool:
+        columns = [column for column in fields if column in JOB_COLUMNS and column!='job_id']
+        if not columns:
+            return self.get_job(job_id) is not None
+        cursor = self._connection().execute("UPDATE jobs SET {} WHERE job_id=?".format(",".join(column+"=?" for column in columns)),\
+                                            [fields[column] for column in columns]+[job_id])
+        return cursor.rowcount==1
+
+    def get_job(self,job_id:str)->dict:
+        row = self._connection().execute("SELECT * FROM jobs WHERE job_id=?",(job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def put_snapshot(self,session_id:str,model_version:int,sha256:str,object_key:str,job_id:str)->None:
+        self._connection().execute("INSERT OR REPLACE INTO snapshots (session_id,model_version,sha256,object_key,job_id) VALUES (?,?,?,?,?)",\
+                                   (session_id,model_version,sha256,object_key,job_id))
+
+    def get_snapshot(self,session_id:str,model_version:int)->dict:
+        row = self._connection().execute("""SELECT snapshots.*, jobs.status FROM snapshots LEFT JOIN jobs ON snapshots.job_id=jobs.job_id
+                                            WHERE snapshots.session_id=? AND snapshots.model_version=?""",(session_id,model_version)).fetchone()
+        return dict(row) if row is not None else None
+
+    def stored_object(self,sha256:str)->str:
+        row = self._connection().execute("""SELECT snapshots.object_key FROM snapshots JOIN jobs ON snapshots.job_id=jobs.job_id
+                                            WHERE snapshots.sha256=? AND jobs.status='done' LIMIT 1""",(sha256,)).fetchone()
+        return row['object_key'] if row is not None else None
+
+    def migrate_from_tinydb(self,json_path:str,payment_hash=None)->int:
+        """
+        One-shot import of sessions from the TinyDB session_info.json file this store replaces.
+        payment_hash maps a stored r_hash to its hex encoding.
+        Returns the number of sessions imported, 0 if the migration already ran.
+        """
+        if not os.path.exists(json_path):
+            return 0
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if connection.execute("SELECT value FROM meta WHERE name='tinydb_migrated'").fetchone() is not None:
+                connection.execute("ROLLBACK")
+                return 0
+            with open(json_path,"r") as f:
+                text = f.read()
+            tables = json.loads(text) if text.strip() else {}
+            imported = 0
+            for session in tables.get('_default',{}).values():
+                session = dict(session)
+                session['payment_hash'] = payment_hash(session.get('r_hash')) if payment_hash else None
+                imported += connection.execute("INSERT OR IGNORE INTO sessions "+INSERT_COLUMNS,self._session_values(session)).rowcount
+            for row in tables.get('invoice_subscription',{}).values():
+                connection.execute("INSERT OR REPLACE INTO meta (name,value) VALUES (?,?)",(row['name'],row['value']))
+            connection.execute("INSERT INTO meta (name,value) VALUES ('tinydb_migrated',1)")
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        return imported
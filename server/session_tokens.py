@@ -0,0 +1,73 @@
+import base64, binascii, hmac, os, secrets, time
+from hashlib import sha256
+from json import dumps, loads
+
+_secret = None
+
+def get_token_secret()->bytes:
+    """
+    Returns the HMAC key for session tokens from ALSATS_TOKEN_SECRET.
+    Falls back to a random per process key, which only works with a single server process.
+    """
+    global _secret
+    if _secret is None:
+        secret = os.environ.get("ALSATS_TOKEN_SECRET")
+        if secret:
+            _secret = secret.encode()
+        else:
+            print("ALSATS_TOKEN_SECRET not set. Session tokens will only be valid in this process.")
+            _secret = secrets.token_bytes(32)
+    return _secret
+
+def _b64encode(raw:bytes)->str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+def _b64decode(text:str)->bytes:
+    return base64.urlsafe_b64decode(text+"="*(-len(text)%4))
+
+def _sign(body:str)->str:
+    return _b64encode(hmac.new(get_token_secret(),body.encode(),sha256).digest())
+
+def mint_session_token(session_id:str,payment_hash:str,num_iterations:int,ttl:int=None)->dict:
+    """
+    Mints a bearer token for a paid session, signed by the server.
+    The token carries the session ID, payment hash, iteration quota and expiry so it can be checked
+    without reading the session store.
+    """
+    if ttl is None:
+        ttl = int(os.environ.get("ALSATS_TOKEN_TTL",7*24*3600))
+    claims = {"session_id":session_id,"payment_hash":payment_hash,"num_iterations":num_iterations,"expires":int(time.time())+ttl}
+    body = _b64encode(dumps(claims,separators=(",",":")).encode())
+    return {"token":body+"."+_sign(body),"expires":claims["expires"]}
+
+def verify_session_token(token:str=None,session_id:str=None)->dict:
+    """
+    Checks a session token's signature and expiry, and that it was minted for session_id.
+    Returns the token's claims, or None if the token isn't valid.
+    """
+    if token is None or token.count(".")!=1:
+        return None
+    body, signature = token.split(".")
+    # Compared as bytes, compare_digest raises TypeError for str holding non ASCII characters
+    if not hmac.compare_digest(signature.encode("utf-8","replace"),_sign(body).encode()):
+        return None
+    try:
+        claims = loads(_b64decode(body))
+    except (binascii.Error, ValueError):
+        return None
+    if not isinstance(claims,dict):
+        return None
+    if claims.get("expires",0)<time.time():
+        return None
+    if session_id is not None and claims.get("session_id")!=session_id:
+        return None
+    return claims
+
+def bearer_token(authorization:str=None)->str:
+    """ Extracts the token from an "Authorization: Bearer <token>" header """
+    if authorization is None:
+        return None
+    scheme, _, token = authorization.strip().partition(" ")
+    if scheme.lower()!="bearer" or not token.strip():
+        return None
+    return token.strip()
@@ -0,0 +1,110 @@
+import asyncio, json, os
+from dotenv import load_dotenv
+from pydantic import ValidationError
+from . import active_learning_utils as al
+from . import server_utils as server
+from .sample_log import schedule_compaction
+
+load_dotenv('./envvars.env')
+
+# Messages read ahead of the one being computed. When they're all waiting the channel stops reading,
+# so a client that sends faster than its session computes is held back by the connection's flow control
+ALSATS_STREAM_QUEUE = int(os.environ.get('ALSATS_STREAM_QUEUE',32))
+
+# op -> (params model, compute function). Messages carry the same fields as the /label, /label/batch and /train bodies
+STREAM_OPS = {"label":(al.LabelParams,al.fetch_label),
+              "label_batch":(al.BatchLabelParams,al.fetch_label_batch),
+              "train":(al.TrainParams,al.train_model)}
+
+def missing_fields(op:str,params)->str:
+    """ Describes the required fields a message lacks, None if it has them """
+    if op=="train":
+        if (params.x_train is None and params.indices is None) or params.y_train is None:
+            return "\"x_train\" (or pool \"indices\") and \"y_train\""
+    elif (params.x_label is None or len(params.x_label)==0) and (params.indices is None or len(params.indices)==0):
+        return "\"x_label\" (or pool \"indices\")"
+    elif op=="label" and params.indices is not None and len(params.indices)!=1:
+        return "a single pool index in \"indices\", label several with a \"label_batch\" message"
+    return None
+
+def message_iterations(op:str,params)->int:
+    """ Compute iterations a message costs, the same as the matching HTTP request """
+    if op=="label_batch":
+        return server.label_batch_iterations(len(params.indices if params.indices is not None else params.x_label))
+    return 1
+
+async def process_message(session_id:str,completed_iterations:int,seq:int,message)->dict:
+    """
+    Validates one message, reserves its iterations and runs it on the session's compute worker.
+    Returns the reply, the HTTP endpoint's response with the message's "seq" and "op", or an "error".
+    """
+    try:
+        message = json.loads(message)
+    except ValueError:
+        return {"seq":seq,"error":"Message is not JSON"}
+    op = message.pop("op",None) if isinstance(message,dict) else None
+    if op not in STREAM_OPS:
+        return {"seq":seq,"op":op,"error":"Message needs an \"op\", one of {}".format(sorted(STREAM_OPS))}
+    model, fn = STREAM_OPS[op]
+    try:
+        params = model.model_validate(message)
+    except ValidationError as e:
+        return {"seq":seq,"op":op,"error":str(e)}
+    missing = missing_fields(op,params)
+    if missing is not None:
+        return {"seq":seq,"op":op,"error":"Message must contain {}".format(missing)}
+    if op!="train" and params.query_criterion not in al.QUERY_CRITERIA:
+        return {"seq":seq,"op":op,"error":"query_criterion must be one of {}".format(sorted(al.QUERY_CRITERIA))}
+    num_iterations = message_iterations(op,params)
+    # Metered like the HTTP endpoints: reserved before compute, committed or refunded by the compute function
+    if not server.reserve_iterations(session_id,num_iterations):
+        return {"seq":seq,"op":op,"error":"Session doesn't have {} compute iterations remaining".format(num_iterations)}
+    kwargs = {"num_iterations":num_iterations} if op=="label_batch" else {}
+    # A compute failure, e.g. the worker dying, refunds the reservation and keeps the channel open for the next message
+    response_dict = await server.run_reserved(session_id,num_iterations,fn,params,session_id,completed_iterations,reserved=True,**kwargs)
+    if op=="train":
+        schedule_compaction(session_id,response_dict)
+    if not response_dict:
+        return {"seq":seq,"op":op,"error":"Compute failed"}
+    return {"seq":seq,"op":op,**response_dict}
+
+async def serve(session_id:str,completed_iterations:int,messages,queue_size:int=ALSATS_STREAM_QUEUE):
+    """
+    Processes an async iterable of JSON messages of an authenticated session and yields one reply per message, in order.
+    Messages are read ahead into a bounded queue while earlier ones compute, and nothing is computed
+    until the previous reply has been taken, so neither side can buffer without bound.
+    """
+    queue = asyncio.Queue(maxsize=queue_size)
+
+    async def read():
+        try:
+            async for message in messages:
+                await queue.put((message,None))
+            await queue.put((None,None))
+        except Exception as e:
+            await queue.put((None,e))
+
+    reader = asyncio.create_task(read())
+    try:
+        seq = 0
+        while True:
+            message, error = await queue.get()
+            if error is not None:
+                raise error
+            if message is None:
+                return
+            yield await process_message(session_id,completed_iterations,seq,message)
+            seq += 1
+    finally:
+        reader.cancel()
+
+async def ndjson_messages(body:bytes):
+    """ The non empty lines of a newline delimited JSON body """
+    for line in body.splitlines():
+        if line.strip():
+            yield line
+
+async def ndjson_replies(replies):
+    """ Encodes replies as newline delimited JSON """
+    async for reply in replies:
+        yield json.dumps(reply)+"\n"
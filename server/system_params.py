@@ -0,0 +1,82 @@
+import os, threading, time
+from dataclasses import dataclass, field, fields
+from json import loads
+from types import MappingProxyType
+
+@dataclass(frozen=True)
+class SystemParams:
+    """
+    Pricing parameters in sats, read from system_params.json.
+    algorithm_payment overrides the per iteration price for an algorithm.
+    label_batch_rows is the number of rows of a batch label request one iteration covers,
+    0 bills a whole batch as a single iteration.
+    """
+    continuous_mode_fixed_payment:int = 1
+    save_payment:int = 2
+    algorithm_payment:MappingProxyType = field(default_factory=lambda: MappingProxyType({}))
+    label_batch_rows:int = 1
+
+    @classmethod
+    def from_dict(cls,params:dict)->'SystemParams':
+        known = {f.name for f in fields(cls)}
+        unknown = set(params.keys())-known
+        if unknown:
+            print("Ignoring unknown system params {}".format(sorted(unknown)))
+        return cls(continuous_mode_fixed_payment=int(params.get("continuous_mode_fixed_payment",cls.continuous_mode_fixed_payment)),
+                   save_payment=int(params.get("save_payment",cls.save_payment)),
+                   algorithm_payment=MappingProxyType({str(k):int(v) for k,v in params.get("algorithm_payment",{}).items()}),
+                   label_batch_rows=int(params.get("label_batch_rows",cls.label_batch_rows)))
+
+    def to_dict(self)->dict:
+        return {"continuous_mode_fixed_payment":self.continuous_mode_fixed_payment,
+                "save_payment":self.save_payment,
+                "algorithm_payment":dict(self.algorithm_payment),
+                "label_batch_rows":self.label_batch_rows}
+
+    def iteration_payment(self,algorithm:str=None)->int:
+        """ Price of one compute iteration with algorithm """
+        return self.algorithm_payment.get(algorithm,self.continuous_mode_fixed_payment)
+
+    def label_batch_iterations(self,num_rows:int)->int:
+        """ Iterations charged for labeling a batch of num_rows rows """
+        if self.label_batch_rows<=0:
+            return 1
+        return max(-(-num_rows//self.label_batch_rows),1)
+
+
+class SystemParamsLoader:
+    """
+    Keeps the parsed system_params.json in memory.
+    The file's mtime is checked at most every check_interval seconds and the params reloaded when it changed,
+    so price changes apply without a restart.
+    """
+
+    def __init__(self,path:str,check_interval:float=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._params = None
+        self._mtime = None
+        self._checked_at = 0.0
+
+    def get(self)->SystemParams:
+        now = time.monotonic()
+        if self._params is None or now-self._checked_at>=self.check_interval:
+            with self._lock:
+                self._checked_at = now
+                mtime = os.stat(self.path).st_mtime_ns
+                if self._params is None or mtime!=self._mtime:
+                    self._load(mtime)
+        return self._params
+
+    def reload(self)->SystemParams:
+        """ Rereads the params file regardless of its mtime """
+        with self._lock:
+            self._checked_at = time.monotonic()
+            self._load(os.stat(self.path).st_mtime_ns)
+        return self._params
+
+    def _load(self,mtime:int):
+        with open(self.path,"r") as f:
+            self._params = SystemParams.from_dict(loads(f.read()))
+        self._mtime = mtime
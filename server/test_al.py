@@ -4,7 +4,10 @@
 # (x,y)=(a/2,a/2) everything outside is 0.
 from .active_learning_utils import *
 from .server_utils import *
+from .inference import *
+from .pool_query import *
 from numpy import linspace, random
+from pytest import raises
 
 
 def test_create_dataset():
@@ -34,6 +37,113 @@ def test_al_iteration():
     assert bool(uncertainty_dict) == True
 
 
+def test_incremental_learners():
+    """
+    Test that incremental learners only partial_fit new samples and still learn the square
+    """
+    x,y = test_create_dataset()
+    x,y = array(x),array(y)
+    for algo in ("sgd","nb","ht"):
+        learner = get_learner(x[:2],y[:2],algo,{"classes":[0,1]})
+        assert isinstance(learner,IncrementalActiveLearner)
+        for idx in random.permutation(len(x)):
+            learner.teach(x[idx:idx+1],y[idx:idx+1])
+        assert learner.X_training.shape == (len(x)+2,2)
+        assert learner.predict_proba(x[:3]).shape == (3,2)
+        if algo != "sgd": # a linear model can't separate the square, its online fit is only checked to run
+            assert learner.score(x,y) > 0.9
+    # A label outside the declared classes triggers a refit instead of failing
+    learner = get_learner(x[[0,-1]],y[[0,-1]],"sgd")
+    learner.teach(array([[20.0,20.0]]),array([2]))
+    assert list(learner.estimator.classes_) == [0,1,2]
+
+def test_growing_forest():
+    """
+    Test that rf-grow adds a few trees per teach and retires the oldest ones
+    """
+    x,y = test_create_dataset()
+    x,y = array(x),array(y)
+    learner = get_learner(x[[0,-1]],y[[0,-1]],"rf-grow",{"n_estimators":20,"n_new_estimators":5,"max_estimators":30,"window":50})
+    assert len(learner.estimator.estimators_) == 20
+    learner.teach(x[1:2],y[1:2])
+    assert len(learner.estimator.estimators_) == 25
+    first_tree = learner.estimator.estimators_[0]
+    for idx in random.permutation(len(x))[:100]:
+        learner.teach(x[idx:idx+1],y[idx:idx+1])
+    assert len(learner.estimator.estimators_) == 30
+    assert first_tree not in learner.estimator.estimators_
+    assert len(learner.estimator.y_window_) == 50
+    assert list(learner.estimator.classes_) == [0,1]
+    assert learner.score(x,y) > 0.8
+
+def test_fetch_label_batch():
+    """
+    Test labeling a batch of rows with one reserved batch of iterations
+    """
+    x,y = test_create_dataset()
+    session_id = get_session_id()
+    save_session_info(session_id,'iterations',None,None,5)
+    label_params = BatchLabelParams(x_label=x[:3])
+    assert reserve_iterations(session_id,3) == True
+    response = fetch_label_batch(label_params,session_id,0,reserved=True,num_iterations=3)
+    assert response["decision"] == ["label"]*3
+    assert response["iterations_charged"] == 3
+    models[session_id] = get_learner(array(x),array(y),"rf")
+    label_params.x_label = [x[0],x[-1]]
+    label_params.uncertainty_threshold = 0.6
+    assert reserve_iterations(session_id,2) == True
+    response = fetch_label_batch(label_params,session_id,3,reserved=True,num_iterations=2)
+    assert response["predicted_label"] == [1,0]
+    assert response["decision"] == ["do not label"]*2
+    assert len(response["uncertainty"]) == 2
+    session = get_session_info(session_id)
+    assert session["completed_iterations"] == 5
+    assert session["reserved_iterations"] == 0
+    del models[session_id]
+
+def test_single_pass_inference():
+    """
+    Test that class, least confidence, margin and entropy come from one predict_proba call
+    """
+    class FixedProbaLearner:
+        calls = 0
+        estimator = RandomForestClassifier()
+        estimator.classes_ = array([0,1,2])
+        def predict_proba(self,X):
+            FixedProbaLearner.calls += 1
+            return array([[0.7,0.2,0.1],[0.4,0.35,0.25]])
+    inference = infer(FixedProbaLearner(),array([[0.0,0.0],[1.0,1.0]]))
+    assert FixedProbaLearner.calls == 1
+    assert list(inference["predicted"]) == [0,0]
+    assert abs(inference["least_confidence"][0]-0.3) < 1e-9
+    assert abs(inference["margin"][1]-0.05) < 1e-9
+    assert inference["entropy"][1] > inference["entropy"][0]
+    assert list(label_decisions(inference,"least_confidence",0.5)) == ["do not label","label"]
+    assert list(label_decisions(inference,"margin",0.1)) == ["do not label","label"]
+    assert list(label_decisions(inference,"entropy",1.0)) == ["do not label","label"]
+    with raises(ValueError):
+        label_decisions(inference,"random")
+
+def test_pool_query():
+    """
+    Test that chunked pool scoring finds the same top k rows and that diverse batches are distinct
+    """
+    x,y = test_create_dataset()
+    x,y = array(x),array(y)
+    learner = get_learner(x[::7],y[::7],"rf")
+    scores = 1-learner.predict_proba(x).max(axis=1)
+    top = query_pool(learner,x,5,chunk_size=16)
+    assert len(top["indices"]) == 5
+    assert sorted(top["scores"],reverse=True) == top["scores"]
+    assert abs(top["scores"][-1]-sorted(scores,reverse=True)[4]) < 1e-9
+    assert query_pool(learner,x,5)["scores"] == top["scores"]
+    for diversity in ("ranked","cluster"):
+        batch = query_pool(learner,x,5,"entropy",diversity,chunk_size=16)
+        assert len(set(batch["indices"])) == 5
+    assert query_pool(learner,x[:3],10)["indices"] != []
+    with raises(ValueError):
+        query_pool(learner,x,5,diversity="random")
+
 def test_init_model():
     """
     Use the test dataset created to initialize a session and save an AL model
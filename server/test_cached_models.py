@@ -0,0 +1,79 @@
+from .cached_models import *
+from .model_registry import *
+from numpy import zeros
+from pytest import raises
+
+class DummyLearner:
+    def __init__(self,n_rows:int):
+        self.X_training = zeros((n_rows,100))
+        self.y_training = zeros(n_rows)
+
+def test_lru_spill_and_rehydrate(tmp_path):
+    """
+    Tests that learners over the memory budget are spilled to disk and come back on access
+    """
+    cache = ModelCache(max_bytes=2*DummyLearner(100).X_training.nbytes+4096,ttl=3600,registry=LocalDiskModelRegistry(str(tmp_path)))
+    for session_id in ('a','b','c'):
+        cache[session_id] = DummyLearner(100)
+    stats = cache.stats()
+    assert stats["resident"] == 2
+    assert stats["evictions"] == 1
+    assert 'a' in cache.keys()
+    assert cache['a'].X_training.shape == (100,100)
+    stats = cache.stats()
+    assert stats["rehydrations"] == 1
+    assert stats["misses"] == 1
+    del cache['b']
+    assert 'b' not in cache
+
+def test_ttl_spill(tmp_path):
+    """
+    Tests that idle learners are spilled after the TTL
+    """
+    cache = ModelCache(max_bytes=1<<30,ttl=0,registry=LocalDiskModelRegistry(str(tmp_path)))
+    cache['a'] = DummyLearner(10)
+    cache['b'] = DummyLearner(10)
+    assert cache.stats()["evictions"] == 1
+    assert cache['a'].y_training.shape == (10,)
+    assert cache.stats()["hits"] == 0
+
+def test_shared_registry_staleness(tmp_path):
+    """
+    Tests that a worker serving a stale copy of a learner reloads the version another worker published
+    """
+    registry = LocalDiskModelRegistry(str(tmp_path))
+    worker_1 = ModelCache(registry=registry,shared=True)
+    worker_2 = ModelCache(registry=registry,shared=True)
+    worker_1['a'] = DummyLearner(10)
+    learner = worker_2['a']
+    assert model_version(learner) == 1
+    learner.X_training = zeros((20,100))
+    bump_model_version(learner)
+    worker_2['a'] = learner
+    assert worker_1['a'].X_training.shape == (20,100)
+    assert worker_1.stats()["stale"] == 1
+    # Publishing from an outdated copy is rejected
+    outdated = DummyLearner(5)
+    outdated.model_version = 1
+    with raises(StaleModelError):
+        registry.publish('a',outdated)
+
+def test_concurrent_publish_of_same_version(tmp_path):
+    """
+    Tests that a second, different learner published under the latest version is rejected and dropped from its cache
+    """
+    registry = LocalDiskModelRegistry(str(tmp_path))
+    worker_1 = ModelCache(registry=registry,shared=True)
+    worker_2 = ModelCache(registry=LocalDiskModelRegistry(str(tmp_path)),shared=True)
+    worker_1['a'] = DummyLearner(10)
+    learners = [worker_1['a'],worker_2['a']]
+    for rows, learner in zip((20,30),learners):
+        learner.X_training = zeros((rows,100))
+        bump_model_version(learner)
+    worker_1['a'] = learners[0]
+    # Republishing the same learner is a no-op
+    worker_1['a'] = learners[0]
+    with raises(StaleModelError):
+        worker_2['a'] = learners[1]
+    assert worker_2['a'].X_training.shape == (20,100)
+    assert worker_2.stats()["rehydrations"] == 2
@@ -0,0 +1,52 @@
+from . import candidate_pool
+from .candidate_pool import *
+from .active_learning_utils import get_learner
+from .model_registry import bump_model_version
+from pytest import raises
+import asyncio, io
+import numpy as np
+
+def upload(session_id:str,data:bytes)->dict:
+    async def chunks():
+        for start in range(0,len(data),100):
+            yield data[start:start+100]
+    return asyncio.run(save_pool(session_id,chunks()))
+
+def test_pool_upload_rows_and_scores(tmp_path,monkeypatch):
+    """
+    Tests uploading a pool, reading rows by index and caching its scores per model version
+    """
+    monkeypatch.setattr(candidate_pool,'ALSATS_POOL_DIR',str(tmp_path))
+    x1 = np.linspace(0,10,20)
+    X = np.array([[i,j] for i in x1 for j in x1],dtype=np.float32)
+    y = ((X[:,0]<=5)&(X[:,1]<=5)).astype(int)
+    buffer = io.BytesIO()
+    np.save(buffer,X)
+    assert upload('s',buffer.getvalue()) == {"rows":400,"columns":2,"dtype":"float32"}
+    with raises(PoolError):
+        upload('s',b'not an npy file')
+    with raises(PoolError):
+        buffer = io.BytesIO()
+        np.save(buffer,np.zeros(3))
+        upload('s',buffer.getvalue())
+    pools = CandidatePools()
+    assert pools.rows('s',[399,0]).tolist() == [[10.0,10.0],[0.0,0.0]]
+    with raises(PoolError):
+        pools.rows('s',[400])
+    with raises(PoolError):
+        pools.get('other')
+    learner = get_learner(X[::7],y[::7],"rf")
+    assert not pools.has_scores('s',learner)
+    scores = pools.scores('s',learner)
+    assert scores.shape == (400,)
+    assert pools.has_scores('s',learner) and not pools.has_scores('s',learner,"entropy")
+    assert pools.scores('s',learner) is scores
+    bump_model_version(learner)
+    assert not pools.has_scores('s',learner)
+    assert pools.scores('s',learner) is not scores
+    assert pools.stats()["score_hits"] == 1
+    mark_labeled('s',[3,5])
+    mark_labeled('s',[5])
+    assert labeled_indices('s').tolist() == [3,5]
+    delete_pool('s')
+    assert labeled_indices('s').tolist() == []
@@ -0,0 +1,29 @@
+from .compute_pool import *
+from asyncio import run
+from threading import get_ident
+
+def test_session_affinity_threads():
+    """
+    Tests that a session always runs on the same worker thread
+    """
+    pool = ComputePool(num_workers=4,mode="thread")
+    async def idents():
+        return [await pool.run(session_id,get_ident) for session_id in ('a','b','a','c','b','a')]
+    workers = run(idents())
+    pool.shutdown()
+    assert workers[0] == workers[2] == workers[5]
+    assert workers[1] == workers[4]
+
+def test_session_affinity_processes():
+    """
+    Tests that a session always runs in the same worker process, off the calling process
+    """
+    pool = ComputePool(num_workers=2,mode="process")
+    async def pids():
+        return [await pool.run(session_id,os.getpid) for session_id in ('a','b','a','b')]
+    workers = run(pids())
+    pool.shutdown()
+    assert os.getpid() not in workers
+    assert workers[0] == workers[2]
+    assert workers[1] == workers[3]
+    assert session_slot('a',2) == session_slot('a',2)
@@ -0,0 +1,31 @@
+from .inference_cache import *
+from .model_registry import bump_model_version
+from sklearn.ensemble import RandomForestClassifier
+import numpy as np
+
+def test_inference_cache():
+    """
+    Tests that repeated candidates skip predict_proba until the learner's version changes, and that the cache is bounded
+    """
+    class CountingLearner:
+        calls = 0
+        estimator = RandomForestClassifier()
+        estimator.classes_ = np.array([0,1])
+        def predict_proba(self,X):
+            CountingLearner.calls += 1
+            return np.tile([0.7,0.3],(len(X),1))
+    learner = CountingLearner()
+    bump_model_version(learner)
+    cache = InferenceCache(max_entries=2)
+    first = cache.infer('s',learner,np.array([[1.0,2.0]]))
+    assert cache.infer('s',learner,[[1,2]]) is first
+    assert CountingLearner.calls == 1
+    cache.infer('t',learner,[[1,2]])
+    assert CountingLearner.calls == 2
+    bump_model_version(learner)
+    cache.infer('s',learner,[[1,2]])
+    assert CountingLearner.calls == 3
+    cache.infer('s',learner,[[3,4]])
+    assert cache.stats() == {"entries":2,"hits":1,"misses":4}
+    assert feature_key([[1,2]]) == feature_key(np.array([[1,2]],dtype=np.float32))
+    assert feature_key([[1,2]]) != feature_key([[2,1]])
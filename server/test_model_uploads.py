@@ -0,0 +1,84 @@
+from .model_uploads import *
+from .session_store import SQLiteSessionStore
+from .active_learning_utils import get_learner
+import os, pickle, time
+import numpy as np
+
+class FakeS3:
+    def __init__(self,fail:bool=False):
+        self.objects = {}
+        self.fail = fail
+
+    def upload_fileobj(self,f,bucket,key,Config=None):
+        if self.fail:
+            raise IOError("connection reset")
+        self.objects[(bucket,key)] = f.read()
+
+def test_upload_job(tmp_path):
+    """
+    Tests that a queued upload spools the learner, uploads it in the background and records the job
+    """
+    store = SQLiteSessionStore(str(tmp_path/'sessions.db'))
+    client = FakeS3()
+    uploads = UploadQueue(client,lambda: store,bucket='b',spool_dir=str(tmp_path/'spool'),part_bytes=5<<20)
+    X = np.random.rand(50,3)
+    learner = get_learner(X,(X[:,0]>0.5).astype(int),"nb")
+    learner.model_version = 1
+    job = uploads.submit('s1',learner)
+    assert job["status"] == "queued" and store.get_snapshot('s1',1)["job_id"] == job["job_id"]
+    uploads.shutdown()
+    assert store.get_job(job["job_id"])["status"] == "done"
+    snapshot = store.get_snapshot('s1',1)
+    assert snapshot["status"] == "done" and snapshot["object_key"] == snapshot_key(snapshot["sha256"])
+    assert pickle.loads(client.objects[('b',snapshot["object_key"])]).X_training.shape == (50,3)
+    assert os.listdir(str(tmp_path/'spool')) == []
+    assert uploads.stats()["uploaded_bytes"] == job["nbytes"]
+
+def test_failed_upload(tmp_path):
+    """
+    Tests that a failed upload marks its job failed with the error and removes the spool file
+    """
+    store = SQLiteSessionStore(str(tmp_path/'sessions.db'))
+    uploads = UploadQueue(FakeS3(fail=True),lambda: store,bucket='b',spool_dir=str(tmp_path/'spool'))
+    job = uploads.submit('s1',{"weights":[1,2,3]})
+    uploads.shutdown()
+    job = store.get_job(job["job_id"])
+    assert job["status"] == "failed" and "connection reset" in job["error"]
+    assert os.listdir(str(tmp_path/'spool')) == []
+    assert uploads.stats()["failures"] == 1
+    assert store.stored_object(store.get_snapshot('s1',0)["sha256"]) is None
+
+def test_unchanged_models_not_uploaded(tmp_path):
+    """
+    Tests that a saved version isn't pickled again, and an identical pickle of a new version isn't uploaded again
+    """
+    store = SQLiteSessionStore(str(tmp_path/'sessions.db'))
+    client = FakeS3()
+    uploads = UploadQueue(client,lambda: store,bucket='b',spool_dir=str(tmp_path/'spool'))
+    learner = get_learner(np.eye(4),np.arange(4)%2,"nb")
+    learner.model_version = 3
+    job = uploads.submit('s1',learner)
+    assert uploads.submit('s1',learner)["job_id"] == job["job_id"]
+    uploads.shutdown()
+    assert uploads.submit('s1',learner)["job_id"] == job["job_id"]
+    # Same content under another session and version: recorded as done without an upload
+    other = uploads.submit('s2',learner)
+    assert other["status"] == "done" and store.get_snapshot('s2',3)["object_key"] == job["object_key"]
+    uploads.shutdown()
+    assert len(client.objects) == 1
+    assert uploads.stats()["unchanged"] == 2 and uploads.stats()["deduplicated"] == 1
+
+def test_presigned_urls():
+    """
+    Tests that presigned URLs are reused until shortly before they expire
+    """
+    class Signer:
+        signed = 0
+        def generate_presigned_url(self,op,Params=None,ExpiresIn=None):
+            Signer.signed += 1
+            return "https://b/{}?n={}".format(Params["Key"],Signer.signed)
+    urls = PresignedUrls(Signer(),bucket='b',expires=3600,refresh=300)
+    assert urls.url('k') == urls.url('k') == "https://b/k?n=1"
+    urls._urls['k'] = (urls._urls['k'][0],time.time()+200)
+    assert urls.url('k') == "https://b/k?n=2"
+    assert urls.stats() == {"cached":1,"hits":1,"signed":2}
@@ -0,0 +1,89 @@
+from .payloads import *
+from .active_learning_utils import TrainParams, BatchLabelParams
+from pytest import raises, importorskip
+import io
+import numpy as np
+
+def npy_body(*arrays)->bytes:
+    buffer = io.BytesIO()
+    for array in arrays:
+        np.save(buffer,array)
+    return buffer.getvalue()
+
+def test_decode_npy():
+    """
+    Tests that concatenated .npy arrays are decoded as views of the body
+    """
+    x = np.arange(12,dtype=np.float32).reshape(4,3)
+    y = np.array([0,1,1,0])
+    body = npy_body(x,y,np.asfortranarray(x))
+    arrays = decode_npy(body)
+    assert len(arrays) == 3
+    assert np.array_equal(arrays[0],x) and arrays[0].dtype == np.float32
+    assert np.array_equal(arrays[1],y)
+    assert np.array_equal(arrays[2],x)
+    assert arrays[0].base is not None and not arrays[0].flags.writeable
+    with raises(PayloadError):
+        decode_npy(body[:-4])
+    with raises(PayloadError):
+        decode_npy(b"not npy")
+    for truncated in (b"\x93NUMPY",b"\x93NUMPY\x01\x00\x76",body[:20]):
+        with raises(PayloadError):
+            decode_npy(truncated)
+
+def test_parse_body():
+    """
+    Tests building params models from JSON and binary bodies
+    """
+    params = parse_body(TrainParams,b'{"x_train":[[1,2]],"y_train":[1],"algorithm":"gbc"}')
+    assert params.x_train == [[1,2]] and params.algorithm == "gbc"
+    assert parse_body(TrainParams,b"") is None
+    x = np.ones((2,3))
+    params = parse_body(TrainParams,npy_body(x,np.array([1,0])),"application/x-npy",{"algorithm":"nb","params":'{"only_new":false}'})
+    assert isinstance(params.x_train,np.ndarray) and params.x_train.shape == (2,3)
+    assert params.y_train.tolist() == [1,0]
+    assert params.algorithm == "nb" and params.params == {"only_new":False}
+    params = parse_body(BatchLabelParams,npy_body(x),"application/x-npy",{"query_criterion":"entropy"})
+    assert params.x_label.shape == (2,3) and params.query_criterion == "entropy"
+    with raises(PayloadError):
+        parse_body(BatchLabelParams,npy_body(x,x),"application/x-npy")
+    with raises(PayloadError) as error:
+        parse_body(TrainParams,b"1,2","text/csv")
+    assert error.value.unsupported
+
+def test_parse_msgpack_and_arrow_bodies():
+    """
+    Tests msgpack and Arrow bodies when the optional packages are installed
+    """
+    msgpack = importorskip("msgpack")
+    body = msgpack.packb({"x_train":{"dtype":"<f4","shape":[1,2],"data":np.array([[1,2]],dtype="<f4").tobytes()},"y_train":[1]})
+    params = parse_body(TrainParams,body,"application/msgpack")
+    assert params.x_train.dtype == np.float32 and params.x_train.tolist() == [[1.0,2.0]]
+    assert params.y_train == [1]
+    pa = importorskip("pyarrow")
+    table = pa.table({"a":[1.0,2.0],"b":[3.0,4.0],"y":[0,1]})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink,table.schema) as writer:
+        writer.write_table(table)
+    params = parse_body(TrainParams,sink.getvalue().to_pybytes(),"application/vnd.apache.arrow.stream")
+    assert params.x_train.tolist() == [[1.0,3.0],[2.0,4.0]]
+    assert params.y_train.tolist() == [0,1]
+
+def test_malformed_msgpack_and_arrow_bodies():
+    """
+    Tests that malformed msgpack and Arrow bodies are payload errors
+    """
+    msgpack = importorskip("msgpack")
+    with raises(PayloadError):
+        parse_body(TrainParams,msgpack.packb({"x_train":{"dtype":"not a dtype","data":b"\x00"*8}}),"application/msgpack")
+    with raises(PayloadError):
+        parse_body(TrainParams,msgpack.packb({"x_train":{"dtype":"<f4","shape":"2x2","data":b"\x00"*8}}),"application/msgpack")
+    pa = importorskip("pyarrow")
+    with raises(PayloadError):
+        parse_body(TrainParams,b"not arrow","application/vnd.apache.arrow.stream")
+    table = pa.table({"y":[0,1]})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink,table.schema) as writer:
+        writer.write_table(table)
+    with raises(PayloadError):
+        parse_body(TrainParams,sink.getvalue().to_pybytes(),"application/vnd.apache.arrow.stream")
@@ -0,0 +1,86 @@
+from .retrain_scheduler import *
+from .model_registry import model_version
+from modAL.models import ActiveLearner
+from sklearn.ensemble import RandomForestClassifier
+from numpy import array
+import time
+
+def get_models():
+    learner = ActiveLearner(estimator=RandomForestClassifier(n_estimators=5),X_training=array([[0.0,0.0],[10.0,10.0]]),y_training=array([1,0]))
+    learner.model_version = 1
+    return {"s":learner}
+
+def test_retrain_policy_from_params():
+    """
+    Tests reading a retrain policy from train params
+    """
+    assert RetrainPolicy.from_params(None) is None
+    assert RetrainPolicy.from_params({"only_new":True}) is None
+    policy = RetrainPolicy.from_params({"retrain_every":3,"retrain_uncertainty":0.4})
+    assert policy == RetrainPolicy(every=3,uncertainty=0.4)
+    assert not policy.due(2,0.0,0.1)
+    assert policy.due(3,0.0,0.1)
+    assert policy.due(1,0.0,0.5)
+
+def test_retrain_every_k():
+    """
+    Tests that buffered labels are trained on in the background every k labels
+    """
+    models = get_models()
+    scheduler = RetrainScheduler(models)
+    policy = RetrainPolicy(every=2)
+    assert scheduler.buffer("s",policy,array([[1.0,1.0]]),array([1])) == 1
+    assert model_version(models["s"]) == 1
+    scheduler.buffer("s",policy,array([[9.0,9.0]]),array([0]))
+    scheduler.wait("s",timeout=30)
+    assert scheduler.pending("s") == 0
+    assert model_version(models["s"]) == 2
+    assert models["s"].X_training.shape == (4,2)
+    assert scheduler.stats()["retrains"] == 1
+    scheduler.shutdown()
+
+def test_retrain_interval():
+    """
+    Tests that an interval policy retrains without further labels arriving
+    """
+    models = get_models()
+    scheduler = RetrainScheduler(models)
+    scheduler.buffer("s",RetrainPolicy(interval=0.1),array([[1.0,1.0]]),array([1]))
+    deadline = time.monotonic()+30
+    while model_version(models["s"])==1 and time.monotonic()<deadline:
+        time.sleep(0.05)
+    assert model_version(models["s"]) == 2
+    scheduler.shutdown()
+
+def test_retrain_failure_keeps_samples():
+    """
+    Tests that samples are kept for the next retrain if a retrain fails
+    """
+    models = get_models()
+    scheduler = RetrainScheduler(models)
+    scheduler.buffer("s",RetrainPolicy(every=1),array([[1.0,1.0,1.0]]),array([1]))
+    scheduler.wait("s",timeout=30)
+    assert scheduler.stats()["failures"] == 1
+    assert scheduler.pending("s") == 1
+    assert model_version(models["s"]) == 1
+    scheduler.shutdown()
+
+def test_retrain_shares_training_data():
+    """
+    Tests that a retrain copies the estimator but not the live learner's buffered training data
+    """
+    from .active_learning_utils import get_learner
+    import numpy as np
+    live = get_learner(array([[0.0,0.0],[10.0,10.0]]),array([1,0]),"rf",{"storage":"float32"})
+    live.teach(array([[1.0,1.0]]),array([1]))
+    live.model_version = 1
+    models = {"s":live}
+    scheduler = RetrainScheduler(models)
+    scheduler.buffer("s",RetrainPolicy(every=1),array([[9.0,9.0]]),array([0]))
+    scheduler.wait("s",timeout=30)
+    retrained = models["s"]
+    assert retrained is not live and retrained.estimator is not live.estimator
+    assert np.shares_memory(retrained.X_training,live.X_training)
+    assert live.X_training.shape == (3,2) and retrained.X_training.shape == (4,2)
+    assert retrained.predict([[9.0,9.0]])[0] == 0
+    scheduler.shutdown()
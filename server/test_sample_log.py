@@ -0,0 +1,102 @@
+from .sample_log import *
+from .cached_models import ModelCache
+from .model_registry import LocalDiskModelRegistry
+from .active_learning_utils import get_learner
+from .retrain_scheduler import retrain_scheduler
+from pytest import raises
+import os
+import numpy as np
+
+def square(n:int=20):
+    x1 = np.linspace(0,10,n)
+    X = np.array([[i,j] for i in x1 for j in x1])
+    return X, ((X[:,0]<=5)&(X[:,1]<=5)).astype(int)
+
+def test_replay_after_restart(tmp_path):
+    """
+    Tests that a learner lost with its process is rebuilt from the logged batches, ignoring a torn last record
+    """
+    X, y = square()
+    log = SampleLog(str(tmp_path/'log'))
+    log.append('s',"init",X[[0,-1]],y[[0,-1]],"rf",{"retrain_every":5},1)
+    for i in range(1,len(X)-1,40):
+        log.append('s',"teach",X[i:min(i+40,len(X)-1)],y[i:min(i+40,len(X)-1)],"rf",None,1+i)
+    with open(os.path.join(str(tmp_path/'log'),'s','log-0000000000.bin'),'ab') as f:
+        f.write(b'\x10\x00\x00\x00torn')
+    # A new process: nothing resident, nothing in the registry
+    cache = ModelCache(registry=LocalDiskModelRegistry(str(tmp_path/'registry')),sample_log=SampleLog(str(tmp_path/'log')))
+    assert 's' in cache and 't' not in cache
+    learner = cache['s']
+    assert learner.X_training.shape == (len(X),2)
+    assert learner.retrain_policy.every == 5
+    assert learner.model_version > cache.sample_log.logged_version('s')
+    assert learner.score(X,y) > 0.95
+    # Appends continue after the last complete record
+    cache.sample_log.append('s',"teach",X[:1],y[:1],"rf",None,learner.model_version)
+    assert SampleLog(str(tmp_path/'log')).replay('s').X_training.shape == (len(X)+1,2)
+    del cache['s']
+    assert 's' not in cache
+    with raises(KeyError):
+        cache.sample_log.replay('s')
+
+def test_compaction(tmp_path):
+    """
+    Tests that a compacted log replays from its snapshot plus the batches logged after it
+    """
+    X, y = square()
+    log = SampleLog(str(tmp_path),compact_bytes=1024)
+    learner = get_learner(X[:2],y[:2],"nb")
+    log.append('s',"init",X[:2],y[:2],"nb",None,1)
+    assert not log.compact('s',learner)
+    for start in range(2,200,20):
+        learner.teach(X[start:start+20],y[start:start+20])
+        log.append('s',"teach",X[start:start+20],y[start:start+20],"nb",None,start)
+    assert log.compact('s',learner)
+    log.append('s',"teach",X[202:],y[202:],"nb",None,201)
+    log.shutdown()
+    assert sorted(os.listdir(str(tmp_path/'s'))) == ['log-0000000001.bin','snapshot-0000000001-0000000182.pkl']
+    rebuilt = SampleLog(str(tmp_path)).replay('s')
+    assert rebuilt.X_training.shape == (len(X),2)
+    assert rebuilt.model_version == 202
+    # Only lossless conversions: linspace values need float64
+    assert compact_array(X).dtype == np.float64 and compact_array(X.astype(np.float32).astype(np.float64)).dtype == np.float32
+    assert compact_array(X*0).dtype == np.uint8
+
+def test_buffered_batches_rebuffered(tmp_path):
+    """
+    Tests that a registry copy as new as the log is loaded as is, and batches buffered for its retrain go back to the scheduler
+    """
+    X, y = square()
+    registry = LocalDiskModelRegistry(str(tmp_path/'registry'))
+    learner = get_learner(X[:200],y[:200],"rf")
+    learner.model_version = 1
+    registry.publish('buffered-session',learner)
+    log = SampleLog(str(tmp_path/'log'))
+    log.append('buffered-session',"init",X[:200],y[:200],"rf",None,1)
+    log.append('buffered-session',"teach",X[200:220],y[200:220],"rf",{"retrain_every":1000},1,buffered=True)
+    assert [len(y) for _, X_, y in log.buffered('buffered-session',1)] == [20]
+    cache = ModelCache(registry=registry,sample_log=SampleLog(str(tmp_path/'log')))
+    try:
+        loaded = cache['buffered-session']
+        assert loaded.X_training.shape == (200,2) and loaded.model_version == 1
+        assert cache.sample_log.replays == 0
+        assert retrain_scheduler.pending('buffered-session') == 20
+    finally:
+        retrain_scheduler._buffers.pop('buffered-session',None)
+
+def test_buffered_batches_taught_without_policy(tmp_path):
+    """
+    Tests that buffered batches without a retrain policy are taught on load under a new model version
+    """
+    X, y = square()
+    registry = LocalDiskModelRegistry(str(tmp_path/'registry'))
+    learner = get_learner(X[:200],y[:200],"rf")
+    learner.model_version = 1
+    registry.publish('s',learner)
+    log = SampleLog(str(tmp_path/'log'))
+    log.append('s',"init",X[:200],y[:200],"rf",None,1)
+    log.append('s',"teach",X[200:220],y[200:220],"rf",None,1,buffered=True)
+    cache = ModelCache(registry=registry,sample_log=SampleLog(str(tmp_path/'log')))
+    loaded = cache['s']
+    assert loaded.X_training.shape == (220,2) and loaded.model_version == 2
+    assert cache['s'] is loaded
@@ -1,6 +1,8 @@
 from .server_utils import *
 from .cached_models import *
+from .session_tokens import *
 from datetime import datetime
+import asyncio
 
 def test_get_system_params():
     """
@@ -54,6 +56,99 @@ def test_update_session():
     session = get_session_info(session['session_id'])
     assert session["completed_iterations"] == 1
 
+def test_reserved_update_session():
+    """
+    Tests that reserved iterations are committed on success and refunded on failure.
+    """
+    session = test_save_session_info()
+    session_id = session['session_id']
+    assert reserve_iterations(session_id) == True
+    session = update_session(session_id,success=True,reserved=True)
+    assert session["completed_iterations"] == 1
+    assert session["reserved_iterations"] == 0
+    assert reserve_iterations(session_id) == True
+    session = update_session(session_id,success=False,reserved=True)
+    assert session["completed_iterations"] == 1
+    assert session["reserved_iterations"] == 0
+
+def test_run_reserved_refunds_failed_compute(monkeypatch):
+    """
+    Tests that iterations reserved for a compute that raises on the worker are refunded
+    """
+    from . import server_utils
+    from .compute_pool import ComputePool
+    def crash(*args,**kwargs):
+        raise RuntimeError("worker died")
+    monkeypatch.setattr(server_utils,"compute_pool",ComputePool(1,"thread"))
+    session_id = test_save_session_info()['session_id']
+    assert reserve_iterations(session_id,3) == True
+    assert asyncio.run(run_reserved(session_id,3,crash)) is None
+    session = get_session_info(session_id)
+    assert session["reserved_iterations"] == 0 and session["completed_iterations"] == 0
+
+def test_algorithm_paid(monkeypatch):
+    """
+    Tests that a session can only create learners priced at most like the algorithm it paid for
+    """
+    from . import server_utils
+    from types import MappingProxyType
+    monkeypatch.setattr(server_utils,"get_pricing",lambda: SystemParams(algorithm_payment=MappingProxyType({"gbc":3,"nb":1})))
+    cheap, paid = get_session_id(), get_session_id()
+    save_session_info(cheap,'iterations',None,None,5)
+    save_session_info(paid,'iterations',None,None,5,algorithm="gbc")
+    assert get_session_info(paid)["algorithm"] == "gbc"
+    assert algorithm_paid(cheap,"rf") and algorithm_paid(cheap,"nb")
+    assert not algorithm_paid(cheap,"gbc")
+    assert algorithm_paid(paid,"gbc") and algorithm_paid(paid,"rf")
+    assert not algorithm_paid(get_session_id(),"rf")
+
+def test_is_valid_preimage():
+    """
+    Tests local preimage verification against hex and base64 encoded payment hashes.
+    """
+    preimage = '310ebdd0717918ef86dd13e765f9e4d75d366ef752925ba73e8248ffb193d68e'
+    r_hash = sha256(bytes.fromhex(preimage)).hexdigest()
+    r_hash_b64 = base64.b64encode(bytes.fromhex(r_hash)).decode("utf-8")
+    preimage_b64 = base64.b64encode(bytes.fromhex(preimage)).decode("utf-8")
+    assert r_hash_hex(r_hash_b64) == r_hash
+    assert is_valid_preimage(preimage,r_hash) == True
+    assert is_valid_preimage(preimage,r_hash_b64) == True
+    assert is_valid_preimage(preimage_b64,r_hash) == True
+    assert is_valid_preimage('abcdefgh',r_hash) == False
+    assert is_valid_preimage('not a preimage!',r_hash) == False
+
+def test_settled_invoice_cache():
+    """
+    Tests that a session whose invoice is known to be settled validates without LND.
+    """
+    preimage = sha256(bytes(get_session_id(),'utf-8')).hexdigest()
+    r_hash = sha256(bytes.fromhex(preimage)).hexdigest()
+    session_id = get_session_id()
+    save_session_info(session_id,'iterations',None,r_hash,5,completed_iterations=0)
+    settled_invoices.add(r_hash)
+    session_valid_dict = session_validity_info(session_id,preimage)
+    assert session_valid_dict['valid_session']==True
+    # A preimage that doesn't hash to the session's r_hash is rejected locally
+    session_valid_dict = session_validity_info(session_id,preimage[::-1])
+    assert session_valid_dict['valid_session']==False
+
+def test_mark_invoice_settled():
+    """
+    Tests that a settled invoice from LND's subscription flags its session paid,
+    after which the session validates without LND.
+    """
+    preimage = sha256(bytes(get_session_id(),'utf-8')).hexdigest()
+    r_hash_b64 = base64.b64encode(sha256(bytes.fromhex(preimage)).digest()).decode("utf-8")
+    session_id = get_session_id()
+    save_session_info(session_id,'iterations',None,r_hash_b64,5,completed_iterations=0)
+    settle_index = get_settle_index()+1
+    invoice = {"memo":session_id,"r_hash":r_hash_b64,"state":"SETTLED","settled":True,"settle_index":str(settle_index)}
+    assert mark_invoice_settled(invoice) == 1
+    settled_invoices.clear()
+    assert get_session_info(session_id)["paid"] == True
+    assert get_settle_index() == settle_index
+    assert session_validity_info(session_id,preimage)['valid_session']==True
+
 def test_session_validity_info():
     """
     Tests if an invalid session is being returned as such.
@@ -69,8 +164,9 @@ def test_session_validity_info():
     # Create and pay invoice on alice. take hex encoded r_preimage from lncli listinvoices and paste it here.
     preimage = '310ebdd0717918ef86dd13e765f9e4d75d366ef752925ba73e8248ffb193d68e'  # Hex encoded payment preimage
     #preimage = base64.b64encode(bytes.fromhex(preimage_hex)).decode("utf-8") # Base64 encoded preimage
-    session = test_save_session_info()
-    session_valid_dict = session_validity_info(session['session_id'],preimage)
+    session_id = get_session_id()
+    save_session_info(session_id,'iterations',None,sha256(bytes.fromhex(preimage)).hexdigest(),5,completed_iterations=0)
+    session_valid_dict = session_validity_info(session_id,preimage)
     assert type(session_valid_dict) == dict
     assert session_valid_dict['valid_session']==True
 
@@ -99,4 +195,45 @@ def test_initialize_iterations():
     
     
 
-    
\ No newline at end of file
+    
+def test_system_params_reload(tmp_path):
+    """
+    Tests that cached system params pick up changes to the params file
+    """
+    params_path = tmp_path/'system_params.json'
+    params_path.write_text('{"continuous_mode_fixed_payment":1,"save_payment":2,"algorithm_payment":{"gbc":3}}')
+    loader = SystemParamsLoader(str(params_path),check_interval=0)
+    params = loader.get()
+    assert params.iteration_payment() == 1
+    assert params.iteration_payment("gbc") == 3
+    assert loader.get() is params
+    params_path.write_text('{"continuous_mode_fixed_payment":4,"save_payment":2}')
+    os.utime(params_path,ns=(0,0))
+    assert loader.get().continuous_mode_fixed_payment == 4
+
+def test_label_batch_iterations():
+    """
+    Tests per row and per batch billing of batch label requests
+    """
+    assert SystemParams().label_batch_iterations(10) == 10
+    assert SystemParams(label_batch_rows=4).label_batch_iterations(10) == 3
+    assert SystemParams(label_batch_rows=4).label_batch_iterations(1) == 1
+    assert SystemParams(label_batch_rows=0).label_batch_iterations(10000) == 1
+    assert SystemParams.from_dict({"label_batch_rows":0}).to_dict()["label_batch_rows"] == 0
+
+def test_session_tokens():
+    """
+    Tests minting and verifying signed session tokens
+    """
+    session_id = get_session_id()
+    token = mint_session_token(session_id,'ab'*32,5)["token"]
+    claims = verify_session_token(token,session_id)
+    assert claims["num_iterations"] == 5
+    assert verify_session_token(token,get_session_id()) is None
+    # Tampered tokens, e.g. with a non ASCII signature from a query string, are rejected rather than raising
+    assert verify_session_token(token.split(".")[0]+".sig\u00e9\u4e2d",session_id) is None
+    assert verify_session_token("\u4e2d."+token.split(".")[1],session_id) is None
+    assert verify_session_token(token[:-1]+('A' if token[-1]!='A' else 'B'),session_id) is None
+    assert verify_session_token(mint_session_token(session_id,'ab'*32,5,ttl=-1)["token"],session_id) is None
+    assert bearer_token("Bearer "+token) == token
+    assert bearer_token(token) is None
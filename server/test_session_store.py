@@ -0,0 +1,82 @@
+from .session_store import *
+from json import dumps
+from threading import Thread
+
+def new_session(session_id:str,num_iterations:int=5)->dict:
+    return {'session_id':session_id,'session_type':'iterations','payment_request':'lnbcrt1',\
+            'r_hash':'ab'*32,'payment_hash':'ab'*32,'num_iterations':num_iterations,'completed_iterations':0}
+
+def test_insert_get(tmp_path):
+    """
+    Tests that sessions round trip through the SQLite store
+    """
+    store = SQLiteSessionStore(str(tmp_path/'sessions.db'))
+    store.insert(new_session('s1'))
+    session = store.get('s1')
+    assert session['num_iterations'] == 5
+    assert session['completed_iterations'] == 0
+    assert session['paid'] == False
+    assert store.get('missing') is None
+
+def test_concurrent_increments(tmp_path):
+    """
+    Tests that increments from many threads are not lost
+    """
+    store = SQLiteSessionStore(str(tmp_path/'sessions.db'))
+    store.insert(new_session('s1'))
+    threads = [Thread(target=lambda: [store.increment_completed('s1') for i in range(25)]) for j in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert store.get('s1')['completed_iterations'] == 200
+
+def test_mark_paid_and_meta(tmp_path):
+    """
+    Tests flagging sessions paid and monotonic meta values
+    """
+    store = SQLiteSessionStore(str(tmp_path/'sessions.db'))
+    store.insert(new_session('s1'))
+    assert store.mark_paid('s1','cd'*32) == 0
+    assert store.mark_paid('other','ab'*32) == 1
+    assert store.get('s1')['paid'] == True
+    store.advance_meta('settle_index',5)
+    store.advance_meta('settle_index',3)
+    assert store.get_meta('settle_index') == 5
+    assert store.get_meta('missing',0) == 0
+
+def test_migrate_from_tinydb(tmp_path):
+    """
+    Tests the one-shot import of a TinyDB session_info.json file
+    """
+    json_path = tmp_path/'session_info.json'
+    json_path.write_text(dumps({"_default":{"1":new_session('s1'),"2":new_session('s2')},\
+                                "invoice_subscription":{"1":{"name":"settle_index","value":7}}}))
+    store = SQLiteSessionStore(str(tmp_path/'sessions.db'))
+    assert store.migrate_from_tinydb(str(json_path),lambda r_hash: r_hash.upper()) == 2
+    assert store.get('s2')['payment_hash'] == 'AB'*32
+    assert store.get_meta('settle_index') == 7
+    assert store.migrate_from_tinydb(str(json_path)) == 0
+
+def test_concurrent_reservations(tmp_path):
+    """
+    Tests that concurrent reservations never exceed a session's quota, and commit/refund keep counts consistent
+    """
+    store = SQLiteSessionStore(str(tmp_path/'sessions.db'))
+    store.insert(new_session('s1',num_iterations=20))
+    reservations = []
+    threads = [Thread(target=lambda: reservations.extend(store.reserve('s1') for i in range(10))) for j in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(reservations) == 20
+    assert store.get('s1')['reserved_iterations'] == 20
+    assert store.commit('s1',19) == True
+    assert store.refund('s1') == True
+    assert store.refund('s1') == False
+    session = store.get('s1')
+    assert session['completed_iterations'] == 19
+    assert session['reserved_iterations'] == 0
+    assert store.reserve('s1') == True
+    assert store.reserve('s1') == False
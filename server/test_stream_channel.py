@@ -0,0 +1,47 @@
+from . import stream_channel
+from .stream_channel import *
+from asyncio import run, sleep
+
+def test_stream_order_and_backpressure(monkeypatch):
+    """
+    Tests that replies come back in message order and that the channel reads only a bounded number of messages ahead
+    """
+    read = []
+    async def messages():
+        for i in range(20):
+            read.append(i)
+            yield str(i)
+    async def process(session_id,completed_iterations,seq,message):
+        await sleep(0.001*(seq%3))
+        return {"seq":seq,"message":message}
+    monkeypatch.setattr(stream_channel,"process_message",process)
+    async def consume():
+        replies = serve("session",0,messages(),queue_size=2)
+        first = await replies.__anext__()
+        await sleep(0.01)
+        num_read = len(read)
+        rest = [reply async for reply in replies]
+        return first, num_read, rest
+    first, num_read, rest = run(consume())
+    assert first == {"seq":0,"message":"0"}
+    assert num_read <= 4
+    assert [reply["seq"] for reply in rest] == list(range(1,20))
+    assert [reply["message"] for reply in rest] == [str(i) for i in range(1,20)]
+
+def test_stream_message_errors():
+    """
+    Tests that malformed messages get an error reply without using iterations
+    """
+    assert run(process_message("session",0,0,"junk"))["error"] == "Message is not JSON"
+    assert "op" in run(process_message("session",0,1,'{"x_label":[1.0]}'))["error"]
+    assert "x_label" in run(process_message("session",0,2,'{"op":"label"}'))["error"]
+    assert "y_train" in run(process_message("session",0,3,'{"op":"train","x_train":[[1.0]]}'))["error"]
+    assert "query_criterion" in run(process_message("session",0,4,'{"op":"label","x_label":[1.0],"query_criterion":"x"}'))["error"]
+
+def test_label_takes_one_index():
+    """
+    Tests that a label message with several pool indices is rejected instead of labeling only the first
+    """
+    assert missing_fields("label",al.LabelParams(indices=[3])) is None
+    assert "label_batch" in missing_fields("label",al.LabelParams(indices=[3,4]))
+    assert missing_fields("label_batch",al.BatchLabelParams(indices=[3,4])) is None
@@ -0,0 +1,85 @@
+from .training_buffer import *
+from .active_learning_utils import get_learner
+from sklearn.ensemble import RandomForestClassifier
+from pytest import raises
+import copy, pickle
+import numpy as np
+
+def test_growable_array():
+    """
+    Tests that appends double the capacity, keep earlier views intact and upcast only when needed
+    """
+    rows = GrowableArray(np.zeros((1,3),dtype=np.float32))
+    first = rows.array
+    for i in range(1,1000):
+        rows.append(np.full((1,3),i,dtype=np.float32))
+    assert len(rows) == 1000 and rows.capacity == 1024
+    assert rows.reallocations == 10
+    assert rows.array[:,0].tolist() == list(range(1000))
+    assert first.tolist() == [[0,0,0]]
+    rows.append(np.full((1,3),0.5,dtype=np.float16))
+    assert rows.array.dtype == np.float32
+    rows.append(np.ones((1,3),dtype=np.float64))
+    assert rows.array.dtype == np.float64 and len(rows) == 1002
+    with raises(ValueError):
+        rows.append(np.ones((1,2)))
+    copied = pickle.loads(pickle.dumps(rows))
+    assert copied.capacity == 1002 and np.array_equal(copied.array,rows.array)
+    fork = rows.fork()
+    fork.append(np.ones((1,3)))
+    assert len(rows) == 1002 and len(fork) == 1003 and np.shares_memory(fork.array,rows.array)
+
+def test_buffered_learner():
+    """
+    Tests that a buffered learner trains like modAL's ActiveLearner and survives copies
+    """
+    X = np.array([[0.0,0.0],[10.0,10.0]])
+    learner = get_learner(X,np.array([1,0]),"rf",{"storage":"float32"})
+    assert isinstance(learner,BufferedActiveLearner)
+    for i in range(20):
+        learner.teach(np.array([[i/10,i/10]]),np.array([1]))
+    assert learner.X_training.shape == (22,2) and learner.y_training.shape == (22,)
+    assert learner._X_buffer.reallocations == 4
+    assert learner.training_nbytes() >= learner.X_training.nbytes+learner.y_training.nbytes
+    assert learner.predict([[0.0,0.0]])[0] == 1
+    with raises(ValueError):
+        learner.teach(np.array([[1.0,2.0,3.0]]),np.array([1]))
+    assert learner.X_training.shape == (22,2) and learner.y_training.shape == (22,)
+    copied = copy.deepcopy(learner)
+    copied.teach(np.array([[9.0,9.0]]),np.array([0]))
+    assert learner.X_training.shape == (22,2) and copied.X_training.shape == (23,2)
+    # Learners pickled with plain X_training/y_training attributes still load
+    legacy = BufferedActiveLearner.__new__(BufferedActiveLearner)
+    legacy.__setstate__({"estimator":RandomForestClassifier(),"X_training":X,"y_training":np.array([1,0])})
+    assert legacy.X_training.tolist() == X.tolist()
+
+def test_compact_storage():
+    """
+    Tests that compact storage policies shrink the training data at least 4x without changing predictions
+    """
+    rng = np.random.default_rng(0)
+    X = ((rng.random((400,100))<0.1)*rng.integers(1,256,(400,100))).astype(float)
+    y = (X[:,:50].sum(axis=1)>X[:,50:].sum(axis=1)).astype(int)
+    assert choose_storage(X) == "sparse" and choose_storage(X,allow_sparse=False) == "uint8"
+    assert choose_storage(X/3,allow_sparse=False) == "float32"
+    learners = {}
+    for storage in ("float64","uint8","sparse","auto"):
+        learner = BufferedActiveLearner(RandomForestClassifier(n_estimators=10,random_state=0),storage=storage,\
+                                        allow_sparse=True,X_training=X[:10],y_training=y[:10])
+        for start in range(10,400,30):
+            learner.teach(X[start:start+30],y[start:start+30])
+        learners[storage] = learner
+    assert learners["auto"].storage == "sparse"
+    assert learners["sparse"].X_training.shape == (400,100) and learners["sparse"].X_training.dtype == np.uint8
+    for storage in ("uint8","sparse"):
+        assert learners["float64"].training_nbytes() >= 4*learners[storage].training_nbytes()
+        assert np.array_equal(learners[storage].predict(X),learners["float64"].predict(X))
+    # A value uint8 can't hold switches the session to float32
+    learners["uint8"].teach(X[:1]+0.5,y[:1])
+    assert learners["uint8"].storage == "float32" and learners["uint8"].X_training[-1,0] == X[0,0]+0.5
+    learners["sparse"].teach(X[:1]+0.5,y[:1])
+    assert learners["sparse"].X_training.dtype == np.float32 and learners["sparse"].X_training.shape == (401,100)
+    copied = pickle.loads(pickle.dumps(learners["sparse"]))
+    assert (copied.X_training != learners["sparse"].X_training).nnz == 0
+    with raises(ValueError):
+        BufferedActiveLearner(RandomForestClassifier(),storage="float16")
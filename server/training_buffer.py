@@ -0,0 +1,238 @@
+import numpy as np
+import scipy.sparse as sp
+from modAL.models import ActiveLearner
+from sklearn.utils import check_X_y
+
+# How a session's features are stored. "float64" keeps them as sent, "float32" and "uint8" store them dense
+# in that dtype, "sparse" as CSR rows, and "auto" picks the smallest of these from the session's first batch.
+# uint8 only holds integers from 0 to 255, other values switch the session to float32.
+STORAGE_POLICIES = ("auto","float64","float32","uint8","sparse")
+
+def fits_uint8(X)->bool:
+    """ True if every value of X is an integer from 0 to 255 """
+    values = X.data if sp.issparse(X) else np.asarray(X)
+    if values.size==0:
+        return True
+    if values.dtype.kind not in 'fiub':
+        return False
+    return bool(values.min()>=0 and values.max()<=255 and (values.dtype.kind!='f' or np.all(values==np.round(values))))
+
+def choose_storage(X,allow_sparse:bool=True)->str:
+    """
+    Picks the storage policy needing the fewest bytes for X: dense uint8 or float32,
+    or CSR rows (values plus a 4 byte column index per non zero) if X is sparse enough.
+    Non numeric features are kept as they are.
+    """
+    if sp.issparse(X):
+        return "sparse" if allow_sparse else ("uint8" if fits_uint8(X) else "float32")
+    X = np.asarray(X)
+    if X.dtype.kind not in 'fiub':
+        return "float64"
+    itemsize = 1 if fits_uint8(X) else 4
+    if allow_sparse and X.ndim==2 and np.count_nonzero(X)*(itemsize+4)+4*X.shape[0]<X.size*itemsize:
+        return "sparse"
+    return "uint8" if itemsize==1 else "float32"
+
+class GrowableArray:
+    """
+    Rows of an array kept in a preallocated buffer that doubles its capacity when it is full,
+    so appending n rows batch by batch copies O(n) rows in total instead of O(n^2).
+    The row shape is fixed by the first rows. Later rows are cast to the buffer's dtype, unless that would
+    lose information, in which case the buffer is upcast once.
+    """
+
+    def __init__(self,rows=None):
+        self._buffer = None
+        self._size = 0
+        self.reallocations = 0
+        if rows is not None:
+            self.append(rows)
+
+    def __len__(self)->int:
+        return self._size
+
+    @property
+    def array(self)->np.ndarray:
+        """ The filled rows, a view of the buffer """
+        return None if self._buffer is None else self._buffer[:self._size]
+
+    @property
+    def capacity(self)->int:
+        return 0 if self._buffer is None else self._buffer.shape[0]
+
+    @property
+    def nbytes(self)->int:
+        """ Bytes allocated, including the spare capacity """
+        return 0 if self._buffer is None else self._buffer.nbytes
+
+    def check(self,rows)->np.ndarray:
+        """ Returns rows as an array, raises ValueError if their shape doesn't match the rows so far """
+        rows = np.asarray(rows)
+        if rows.ndim==0:
+            rows = rows.reshape(1)
+        if self._buffer is not None and rows.shape[1:]!=self._buffer.shape[1:]:
+            raise ValueError("Rows of shape {} can't be added to rows of shape {}".format(rows.shape[1:],self._buffer.shape[1:]))
+        return rows
+
+    def append(self,rows)->np.ndarray:
+        """ Appends rows and returns all filled rows """
+        rows = self.check(rows)
+        if self._buffer is None:
+            self._buffer = np.empty(rows.shape,dtype=rows.dtype)
+        dtype = self._buffer.dtype if np.can_cast(rows.dtype,self._buffer.dtype) else np.promote_types(self._buffer.dtype,rows.dtype)
+        size = self._size+rows.shape[0]
+        if size>self.capacity or dtype!=self._buffer.dtype:
+            capacity = max(size,2*self.capacity) if size>self.capacity else self.capacity
+            buffer = np.empty((capacity,)+self._buffer.shape[1:],dtype=dtype)
+            buffer[:self._size] = self._buffer[:self._size]
+            self._buffer = buffer
+            self.reallocations += 1
+        # Only rows past the old size are written, so views handed out earlier never change
+        self._buffer[self._size:size] = rows
+        self._size = size
+        return self.array
+
+    def fork(self)->'GrowableArray':
+        """
+        A GrowableArray over the same buffer and rows, without copying them. Its appends write past
+        this array's rows, so this array must not be appended to while the fork is in use.
+        """
+        fork = GrowableArray()
+        fork._buffer, fork._size, fork.reallocations = self._buffer, self._size, self.reallocations
+        return fork
+
+    def __getstate__(self)->dict:
+        # Pickles (model saves and spills) carry the filled rows, not the spare capacity
+        return {"_buffer":self.array,"_size":self._size,"reallocations":self.reallocations}
+
+
+class SparseRows:
+    """
+    Rows of a CSR matrix whose values, column indices and row pointers are GrowableArrays,
+    so appending rows doesn't copy the rows so far. array is a CSR matrix over the buffers.
+    """
+
+    def __init__(self,rows=None):
+        self.num_features = None
+        self._data = GrowableArray()
+        self._indices = GrowableArray()
+        self._indptr = GrowableArray(np.zeros(1,dtype=np.int32))
+        if rows is not None:
+            self.append(rows)
+
+    def __len__(self)->int:
+        return len(self._indptr)-1
+
+    @property
+    def array(self)->sp.csr_matrix:
+        if self.num_features is None:
+            return None
+        return sp.csr_matrix((self._data.array,self._indices.array,self._indptr.array),shape=(len(self),self.num_features),copy=False)
+
+    @property
+    def nbytes(self)->int:
+        return self._data.nbytes+self._indices.nbytes+self._indptr.nbytes
+
+    def check(self,rows)->sp.csr_matrix:
+        """ Returns rows as a CSR matrix, raises ValueError if their width doesn't match the rows so far """
+        rows = sp.csr_matrix(rows if sp.issparse(rows) or np.ndim(rows)==2 else np.atleast_2d(rows))
+        if self.num_features is not None and rows.shape[1]!=self.num_features:
+            raise ValueError("Rows of {} features can't be added to rows of {} features".format(rows.shape[1],self.num_features))
+        return rows
+
+    def append(self,rows)->sp.csr_matrix:
+        rows = self.check(rows)
+        self.num_features = rows.shape[1]
+        offset = len(self._data)
+        self._data.append(rows.data)
+        # int32 indices keep scipy from copying them, the pointers are only upcast past 2**31 values
+        self._indices.append(rows.indices.astype(np.int32,copy=False))
+        self._indptr.append(rows.indptr[1:].astype(np.int64)+offset)
+        return self.array
+
+    def fork(self)->'SparseRows':
+        """ SparseRows over the same buffers, see GrowableArray.fork """
+        fork = SparseRows()
+        fork.num_features = self.num_features
+        fork._data, fork._indices, fork._indptr = self._data.fork(), self._indices.fork(), self._indptr.fork()
+        return fork
+
+
+class BufferedActiveLearner(ActiveLearner):
+    """
+    ActiveLearner whose labeled samples live in growable buffers instead of being stacked into
+    new arrays by every teach(). X_training and y_training are views of the filled rows,
+    and the estimator is fit on them.
+    storage is one of STORAGE_POLICIES. "auto" is resolved on the first batch, CSR storage is
+    only chosen with allow_sparse, i.e. for estimators that take sparse input.
+    """
+
+    def __init__(self,estimator,storage:str="float64",allow_sparse:bool=False,**kwargs):
+        if storage not in STORAGE_POLICIES:
+            raise ValueError("Unknown storage policy {}. Use one of {}".format(storage,STORAGE_POLICIES))
+        self.storage = storage
+        self.allow_sparse = allow_sparse
+        super().__init__(estimator,**kwargs)
+
+    @property
+    def X_training(self)->np.ndarray:
+        buffer = self.__dict__.get("_X_buffer")
+        return None if buffer is None else buffer.array
+
+    @X_training.setter
+    def X_training(self,X):
+        if X is None:
+            self._X_buffer = None
+            return
+        storage = self.storage = getattr(self,"storage","float64")
+        if storage=="auto":
+            storage = self.storage = choose_storage(X,self.allow_sparse)
+        # Dense uint8 and sparse storage start out as uint8 values, see _compact
+        self.storage_dtype = {"float64":None,"float32":np.dtype(np.float32)}.get(storage,np.dtype(np.uint8))
+        self._X_buffer = SparseRows() if storage=="sparse" else GrowableArray()
+        self._X_buffer.append(self._compact(X))
+
+    @property
+    def y_training(self)->np.ndarray:
+        buffer = self.__dict__.get("_y_buffer")
+        return None if buffer is None else buffer.array
+
+    @y_training.setter
+    def y_training(self,y):
+        self._y_buffer = None if y is None else GrowableArray(y)
+
+    def training_nbytes(self)->int:
+        """ Bytes allocated for the labeled samples, including spare capacity """
+        return sum(buffer.nbytes for buffer in (self._X_buffer,self._y_buffer) if buffer is not None)
+
+    def _compact(self,X):
+        """ X in the session's storage dtype. Values uint8 can't hold switch the session to float32 """
+        dtype = self.__dict__.get("storage_dtype")
+        if dtype is None:
+            return X
+        if dtype==np.uint8 and not fits_uint8(X):
+            dtype = self.storage_dtype = np.dtype(np.float32)
+            if self.storage=="uint8":
+                self.storage = "float32"
+        return X.astype(dtype) if sp.issparse(X) else np.asarray(X,dtype=dtype)
+
+    def _add_training_data(self,X,y)->None:
+        check_X_y(X,y,accept_sparse=True,ensure_2d=False,allow_nd=True,multi_output=True,dtype=None,
+                  force_all_finite=self.force_all_finite)
+        if self._X_buffer is None:
+            self.X_training, self.y_training = X, y
+            return
+        try:
+            X, y = self._X_buffer.check(self._compact(X)), self._y_buffer.check(y)
+        except ValueError:
+            raise ValueError('the dimensions of the new training data and label must '
+                             'agree with the training data and labels provided so far')
+        self._X_buffer.append(X)
+        self._y_buffer.append(y)
+
+    def __setstate__(self,state:dict):
+        # Learners pickled before the buffers kept X_training and y_training as plain attributes
+        legacy = {key:state.pop(key) for key in ("X_training","y_training") if key in state}
+        self.__dict__.update(state)
+        for key, value in legacy.items():
+            setattr(self,key,value)